@@ -0,0 +1,218 @@
+from fixed_load_model import create_fix_load_model
+from flex_pue_model import create_flex_pue_model
+from result_cache import get_result_key, load_cached_results, store_results
+from site_template import get_template_key, can_use_template, run_site_scenarios
+from results_processing import process_results_batch
+from results_store import read_result_block, write_breakdowns
+from profiling import start_profile, write_profile, profile_report, get_peak_rss_mb, get_rss_mb
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+import argparse
+import datetime
+import gc
+import os
+
+# memory of a model per hour of its horizon on top of the memory of the process, measured on the full year models of
+# the sample site (build, solve and results). The first jobs of a batch are scheduled with it, later jobs with the
+# peaks measured for the jobs of the same kind.
+memory_per_hour_kb = {'fixed': 20, 'flex': 24}
+
+
+def get_batch_jobs(args, mg_list, scenarios=None):
+    # one job per (scenario, mini-grid). scenarios maps a scenario name to the parameters it overrides,
+    # each scenario writes to its own results directory unless it sets results_dir itself.
+    if not scenarios:
+        scenarios = {'base': {}}
+    jobs = []
+    for scenario_name, overrides in scenarios.items():
+        job_args = argparse.Namespace(**vars(args))
+        if len(scenarios) > 1:
+            job_args.results_dir = os.path.join(args.results_dir, scenario_name)
+        job_args.scenario_name = scenario_name
+        for k, v in overrides.items():
+            setattr(job_args, k, v)
+        for mg_name in mg_list:
+            jobs.append((scenario_name, mg_name, job_args))
+    return jobs
+
+
+def run_job(args, scenario_name, mg_name, result_key=None):
+    job_start_time = datetime.datetime.now()
+    status, error = 'done', ''
+    start_profile(args, mg_name, result_key)
+    try:
+        if args.fixed_load_sce:
+            create_fix_load_model(args, mg_name)
+        else:
+            create_flex_pue_model(args, mg_name)
+        if result_key:
+            store_results(args, mg_name, result_key, job_start_time.timestamp())
+    except Exception as e:
+        status, error = 'failed', repr(e)
+    write_profile(args, status)
+    job_end_time = datetime.datetime.now()
+    return {'scenario': scenario_name, 'mg_name': mg_name, 'results_dir': args.results_dir, 'status': status,
+            'start_time': job_start_time, 'end_time': job_end_time,
+            'run_time_s': (job_end_time - job_start_time).total_seconds(), 'error': error, 'result_key': result_key,
+            'peak_rss_mb': get_peak_rss_mb()}
+
+
+def get_job_units(args, pending):
+    # pending scenarios of a site that differ only in scenario flags, costs and the deficit fraction are run on one
+    # site model (see site_template.py), any other job is run on its own
+    units = dict()
+    for scenario_name, mg_name, job_args, result_key in pending:
+        if args.reuse_site_model and can_use_template(job_args):
+            unit_key = ('site', mg_name, get_template_key(job_args))
+        else:
+            unit_key = ('job', scenario_name, mg_name)
+        units.setdefault(unit_key, []).append((scenario_name, mg_name, job_args, result_key))
+    return list(units.values())
+
+
+def run_unit(unit):
+    if len(unit) == 1:
+        scenario_name, mg_name, job_args, result_key = unit[0]
+        unit_results = [run_job(job_args, scenario_name, mg_name, result_key)]
+    else:
+        unit_results = run_site_scenarios(unit)
+    # the Gurobi wrappers of the disposed models are freed right away instead of at the next collection
+    if unit[0][2].low_memory:
+        gc.collect()
+    return unit_results
+
+
+def get_memory_key(job_args):
+    # jobs of the same model, horizon and solve mode have about the same peak memory. the stochastic model stacks
+    # its scenario years
+    if job_args.fixed_load_sce:
+        model_type, T, solve_mode = 'fixed', job_args.num_hour_fixed_load, job_args.fixed_solve_mode
+    else:
+        model_type, T, solve_mode = 'flex', job_args.num_hour_flex_pue, job_args.flex_solve_mode
+    if solve_mode == 'stochastic':
+        T *= max(1, len(job_args.stochastic_years))
+    return model_type, T, solve_mode
+
+
+def estimate_unit_mb(unit, measured_peaks, base_mb):
+    # peak memory of a unit: the largest measured peak of its kind of job, else the memory of a fresh process plus
+    # memory_per_hour_kb per model hour. the jobs of a unit run one after the other
+    unit_mb = 0.
+    for _, _, job_args, _ in unit:
+        memory_key = get_memory_key(job_args)
+        job_mb = measured_peaks.get(memory_key, base_mb + memory_per_hour_kb[memory_key[0]] * memory_key[1] / 1024)
+        unit_mb = max(unit_mb, job_mb)
+    return unit_mb
+
+
+def write_manifest(args, manifest):
+    if not os.path.exists(args.results_dir):
+        os.makedirs(args.results_dir)
+    pd.DataFrame(manifest).to_csv(os.path.join(args.results_dir, 'batch_manifest.csv'), index=False)
+
+
+def run_units_parallel(args, units, manifest, num_workers):
+    # cap the solver threads of each worker so that the workers together do not oversubscribe the cores
+    worker_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    if args.solver_threads:
+        worker_threads = min(worker_threads, args.solver_threads)
+    # with a memory budget, a unit is only started while the estimated peaks of the running units and its own fit
+    # in memory_budget_mb. the first unit that fits is started, a unit larger than the budget runs on its own
+    base_mb = get_rss_mb()
+    measured_peaks = dict()
+    pending = list(units)
+    running = dict()
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        while pending or running:
+            while pending and len(running) < num_workers:
+                running_mb = sum(unit_mb for _, unit_mb in running.values())
+                unit_no = 0
+                if args.memory_budget_mb:
+                    unit_no = next((i for i, unit in enumerate(pending) if not running or running_mb +
+                                    estimate_unit_mb(unit, measured_peaks, base_mb) <= args.memory_budget_mb), None)
+                    if unit_no is None:
+                        break
+                unit = pending.pop(unit_no)
+                for _, _, job_args, _ in unit:
+                    job_args.solver_threads = worker_threads
+                running[pool.submit(run_unit, unit)] = (unit, estimate_unit_mb(unit, measured_peaks, base_mb))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                unit, _ = running.pop(future)
+                for job_results, (_, _, job_args, _) in zip(future.result(), unit):
+                    memory_key = get_memory_key(job_args)
+                    measured_peaks[memory_key] = max(measured_peaks.get(memory_key, 0.), job_results['peak_rss_mb'])
+                    manifest.append(job_results)
+                    print(f"{job_results['scenario']}/{job_results['mg_name']}: {job_results['status']} "
+                          f"in {job_results['run_time_s']:.1f} s, peak {job_results['peak_rss_mb']:.0f} MB")
+                write_manifest(args, manifest)
+
+
+def post_process_batch(args, jobs, manifest):
+    # metrics and deficit / curtailment breakdowns of every finished job of the batch in one vectorized pass over
+    # the results store per horizon length. the metrics are written to results_dir, the breakdowns to tables of
+    # results.sqlite
+    finished = {(row['scenario'], row['mg_name']) for row in manifest if row['status'] in ['done', 'cached']}
+    horizon_jobs = dict()
+    for scenario_name, mg_name, job_args in jobs:
+        if (scenario_name, mg_name) in finished:
+            T = job_args.num_hour_fixed_load if job_args.fixed_load_sce else job_args.num_hour_flex_pue
+            horizon_jobs.setdefault(T, []).append((scenario_name, mg_name, job_args))
+    batch_results = []
+    for T, jobs in horizon_jobs.items():
+        keys = [(mg_name, scenario_name) for scenario_name, mg_name, _ in jobs]
+        caps_block, ts_block, ts_col_names = read_result_block(args, keys)
+        horizon_results, breakdowns = process_results_batch([job_args for _, _, job_args in jobs], caps_block,
+                                                            ts_block, ts_col_names)
+        horizon_results.insert(0, 'mg_name', [mg_name for mg_name, _ in keys])
+        horizon_results.insert(1, 'scenario', [scenario_name for _, scenario_name in keys])
+        batch_results.append(horizon_results)
+        write_breakdowns(args, keys, breakdowns)
+    if batch_results:
+        pd.concat(batch_results, ignore_index=True).round(decimals=3).to_csv(
+            os.path.join(args.results_dir, 'batch_processed_results.csv'), index=False)
+
+
+def run_batch(args, mg_list, scenarios=None, num_workers=None):
+    num_workers = num_workers or args.num_workers
+    jobs = get_batch_jobs(args, mg_list, scenarios)
+
+    # jobs whose parameters, inputs and model code are unchanged since an earlier run get their results from the
+    # result cache, any other job is (re)calculated. without a result cache, jobs whose results directory already
+    # exists are skipped.
+    manifest, pending = [], []
+    for scenario_name, mg_name, job_args in jobs:
+        result_key = None
+        if job_args.result_cache_dir:
+            result_key = get_result_key(job_args, mg_name)
+            status = 'cached' if load_cached_results(job_args, mg_name, result_key) else None
+        else:
+            status = 'skipped' if os.path.exists(os.path.join(job_args.results_dir, mg_name)) else None
+        if status:
+            print(f"{scenario_name}/{mg_name} was already calculated ({status}).")
+            manifest.append({'scenario': scenario_name, 'mg_name': mg_name, 'results_dir': job_args.results_dir,
+                             'status': status, 'start_time': None, 'end_time': None, 'run_time_s': 0.,
+                             'error': '', 'result_key': result_key, 'peak_rss_mb': None})
+        else:
+            pending.append((scenario_name, mg_name, job_args, result_key))
+
+    # the manifest is written with the cached and skipped jobs first, then after every unit
+    write_manifest(args, manifest)
+    units = get_job_units(args, pending)
+    num_workers = max(1, min(num_workers, len(units)))
+    if num_workers == 1:
+        for unit in units:
+            print(unit[0][1], 'name of mini-grid')
+            for job_results in run_unit(unit):
+                manifest.append(job_results)
+                print(f"{job_results['scenario']}/{job_results['mg_name']}: {job_results['status']} "
+                      f"in {job_results['run_time_s']:.1f} s, peak {job_results['peak_rss_mb']:.0f} MB")
+            write_manifest(args, manifest)
+    else:
+        run_units_parallel(args, units, manifest, num_workers)
+
+    if args.results_store_dir and args.batch_post_processing:
+        post_process_batch(args, jobs, manifest)
+    if args.profile_dir:
+        profile_report(args)
+    return manifest
@@ -0,0 +1,177 @@
+from fixed_load_model import create_fix_load_model
+from flex_pue_model import create_flex_pue_model
+from param_sweep import get_sweep_points
+from profiling import start_profile, write_profile, profile_report
+from result_cache import hash_file
+from utils import get_args, get_fixed_load, get_curtailable_load, get_flex_pue_ts, get_site_table, get_solar_file
+import numpy as np
+import pandas as pd
+import argparse
+import datetime
+import platform
+import hashlib
+import shutil
+import os
+
+# benchmark cases: every combination of the lists in args.benchmark. model ('fixed' or 'flex'), num_hour (horizon of
+# the model), load_scale and num_pue (PUEs of the flex model) describe the synthetic site, any other key is a model
+# parameter such as a technology flag.
+benchmark_site_params = ['model', 'num_hour', 'load_scale', 'num_pue']
+
+
+def get_site_name(load_scale, num_pue):
+    return f'bench_s{load_scale:g}_p{num_pue}'
+
+
+def make_synthetic_site(args, bench_args, sample_mg, load_scale, num_pue):
+    # a site in the data directory of bench_args with the series of the sample site scaled by load_scale, and
+    # num_pue PUEs tiled from the sample PUEs (each repeat shifted by a week so that the PUEs differ)
+    site_name = get_site_name(load_scale, num_pue)
+    data_dir = bench_args.data_dir
+    fixed_load = get_fixed_load(args, sample_mg) * load_scale
+    os.makedirs(f'{data_dir}/{args.fixed_load_dir}', exist_ok=True)
+    pd.DataFrame({'load': fixed_load}).to_csv(f'{data_dir}/{args.fixed_load_dir}/{site_name}_fixed_loads.csv',
+                                              index_label='datetime')
+    curtailable_load = get_curtailable_load(args, sample_mg) * load_scale
+    os.makedirs(f'{data_dir}/{args.curtailment_dir}', exist_ok=True)
+    pd.DataFrame({'curtail': curtailable_load}).to_csv(
+        f'{data_dir}/{args.curtailment_dir}/{site_name}_curtailable_loads.csv', index_label='datetime')
+
+    flex_fixed_load, pue_daily_array, _ = get_flex_pue_ts(args, sample_mg)
+    site_dir = f'{data_dir}/{args.flex_pue_dir}/{site_name}'
+    if os.path.isdir(site_dir):
+        shutil.rmtree(site_dir)
+    os.makedirs(site_dir)
+    pd.DataFrame({'load': np.asarray(flex_fixed_load) * load_scale}).to_csv(f'{site_dir}/fixed_loads.csv',
+                                                                            index_label='datetime')
+    num_sample_pue = pue_daily_array.shape[0]
+    for pue_no in range(num_pue):
+        pue_daily = np.roll(pue_daily_array[pue_no % num_sample_pue], 7 * (pue_no // num_sample_pue), axis=0)
+        pd.DataFrame(pue_daily * load_scale, columns=['daily_sum', 'daily_max']).to_csv(
+            f'{site_dir}/pue_daily_loads_{pue_no:05d}.csv', index=False)
+
+    # site tables with a row per synthetic site, the motor and fixed system capacities scale with the load
+    for table_path, scaled_cols in [(args.motor_cap_dir, ['motor_capacity']),
+                                    (args.system_capacity, ['solar_cap_kw', 'batt_cap_kwh', 'inv_cap_kw'])]:
+        bench_table_path = f'{data_dir}/{table_path}'
+        if os.path.exists(bench_table_path):
+            table = pd.read_csv(bench_table_path).set_index('mg_name')
+        else:
+            table = get_site_table(args, table_path).iloc[:0]
+        table.loc[site_name] = get_site_table(args, table_path).loc[sample_mg]
+        table.loc[site_name, scaled_cols] *= load_scale
+        os.makedirs(os.path.dirname(bench_table_path), exist_ok=True)
+        table.to_csv(bench_table_path)
+    return site_name
+
+
+def get_benchmark_args(args):
+    # the benchmark runs on its own data, results and profile directories, without the input store and the result
+    # cache, so that every case is read, built and solved from scratch
+    bench_args = argparse.Namespace(**vars(args))
+    bench_args.data_dir = os.path.join(args.benchmark_dir, 'data')
+    bench_args.results_dir = os.path.join(args.benchmark_dir, 'results')
+    bench_args.results_store_dir = os.path.join(args.benchmark_dir, 'results', 'store')
+    bench_args.profile_dir = os.path.join(args.benchmark_dir, 'profile')
+    bench_args.input_store_dir = ''
+    bench_args.result_cache_dir = ''
+    solar_file = get_solar_file(args, args.solar_region)
+    os.makedirs(os.path.dirname(f'{bench_args.data_dir}/{solar_file}'), exist_ok=True)
+    shutil.copyfile(f'{args.data_dir}/{solar_file}', f'{bench_args.data_dir}/{solar_file}')
+    return bench_args
+
+
+def get_benchmark_cases(benchmark):
+    # the grid of cases, the number of PUEs only applies to the flex model
+    cases = []
+    for point in get_sweep_points(benchmark):
+        point = {'model': 'fixed', 'num_hour': 8760, 'load_scale': 1, 'num_pue': 0, **point}
+        if point['model'] == 'fixed':
+            point['num_pue'] = 0
+        if point not in cases:
+            cases.append(point)
+    return cases
+
+
+def get_case_name(case):
+    return '__'.join(f'{k}={v}' for k, v in case.items())
+
+
+def get_code_hash():
+    # hash of the model code, benchmark results of the same code hash are directly comparable
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    code_hash = hashlib.sha256()
+    for name in sorted(name for name in os.listdir(code_dir) if name.endswith('.py')):
+        code_hash.update(hash_file(os.path.join(code_dir, name)).encode())
+    return code_hash.hexdigest()[:12]
+
+
+def run_benchmark(args, sample_mg='agoro', benchmark=None):
+    # build, solve, extract and write every benchmark case on its synthetic site, one profiled run per case. the
+    # phase times and model statistics of all cases are appended to benchmark_dir/benchmark_results.csv, tagged with
+    # the run, code hash, host and solver backend, so that runs can be compared over time
+    benchmark = benchmark or args.benchmark
+    bench_args = get_benchmark_args(args)
+    run_id = datetime.datetime.now().isoformat(timespec='seconds')
+    code_hash = get_code_hash()
+    sites = dict()
+    benchmark_results = []
+    for case in get_benchmark_cases(benchmark):
+        case_name = get_case_name(case)
+        site_key = (case['load_scale'], case['num_pue'])
+        if site_key not in sites:
+            sites[site_key] = make_synthetic_site(args, bench_args, sample_mg, *site_key)
+        mg_name = sites[site_key]
+        case_args = argparse.Namespace(**vars(bench_args))
+        case_args.scenario_name = case_name
+        case_args.fixed_load_sce = case['model'] == 'fixed'
+        case_args.num_hour_fixed_load = case['num_hour']
+        case_args.num_hour_flex_pue = case['num_hour']
+        for k, v in case.items():
+            if k not in benchmark_site_params:
+                setattr(case_args, k, v)
+
+        print(f'benchmark case {case_name}')
+        status, error = 'done', ''
+        start_profile(case_args, mg_name)
+        try:
+            if case_args.fixed_load_sce:
+                create_fix_load_model(case_args, mg_name)
+            else:
+                create_flex_pue_model(case_args, mg_name)
+        except Exception as e:
+            status, error = 'failed', repr(e)
+        profile = write_profile(case_args, status)
+
+        case_results = {'run_id': run_id, 'code_hash': code_hash, 'host': platform.node(),
+                        'solver_backend': case_args.solver_backend, 'case': case_name, **case, 'status': status,
+                        'error': error, 'total_s': profile['total_s'], 'peak_rss_mb': profile['peak_rss_mb']}
+        case_results.update({f'{phase_name}_s': value for phase_name, value in profile['phases'].items()})
+        if profile['models']:
+            model_stats = profile['models'][-1]
+            case_results.update({k: model_stats[k] for k in ['num_vars', 'num_constrs', 'num_nzs', 'num_bin_vars',
+                                                             'obj', 'solve_runtime_s', 'iterations', 'nodes']})
+        benchmark_results.append(case_results)
+        print(f"{case_name}: {status} in {profile['total_s']:.2f} s")
+
+    # append to the results of the earlier runs, cases and phases added since then get new columns
+    benchmark_results = pd.DataFrame(benchmark_results)
+    results_file = os.path.join(args.benchmark_dir, 'benchmark_results.csv')
+    if os.path.exists(results_file):
+        benchmark_results = pd.concat([pd.read_csv(results_file), benchmark_results], ignore_index=True)
+    benchmark_results.round(decimals=6).to_csv(results_file, index=False)
+    profile_report(bench_args)
+    return benchmark_results[benchmark_results.run_id == run_id]
+
+
+if __name__ == '__main__':
+
+    running_start_time = datetime.datetime.now()
+
+    args = get_args()
+    benchmark_results = run_benchmark(args)
+    print(benchmark_results[['case', 'status', 'total_s', 'build_model_s', 'solve_s']].to_string(index=False))
+
+    # showing the time used
+    running_end_time = datetime.datetime.now()
+    print(running_end_time - running_start_time)
@@ -1,196 +1,147 @@
 from gurobipy import *
-from utils import get_cap_cost, load_timeseries, get_fixed_load, get_fixed_system_size, get_curtailable_load, get_motor_cap_limit
-from results_processing import results_retrieval, process_results
+from utils import load_timeseries, get_fixed_load, get_curtailable_load
+from model_core import assemble_model
+from results_processing import results_retrieval, process_results, get_ts_dtype
+from results_store import write_results
+from solver_backend import optimize, get_solve_info, get_values
+from profiling import timed_phase, add_counter
+from representative_days import get_rep_days, get_rep_day_inputs, expand_rep_days
 import numpy as np
 import pandas as pd
+import datetime
 import os
 
-def create_fix_load_model(args, mg_name):
-    print("fixed load model building and solving")
-    print("--------####################------------")
 
+def get_fix_load_inputs(args, mg_name):
+    # hourly inputs of the fixed load model over its horizon
     T = args.num_hour_fixed_load
-    trange = range(T)
     solar_region = args.solar_region
-    solar_po_hourly = load_timeseries(args, solar_region)
-
-    fixed_load = get_fixed_load(args, mg_name)
-
-    if args.curtailable_load_sce:
-        curtailable_load = get_curtailable_load(args, mg_name)
-
-    # Retrieve capital prices for solar, battery, and diesel generators
-    solar_cap_cost, battery_la_cap_cost_kwh, battery_li_cap_cost_kwh, \
-        battery_inverter_cap_cost_kw, diesel_cap_cost_kw = get_cap_cost(args, args.num_year_fixed_load)
-
-    # create the model
-    m = Model("fixed_load_model")
-    print('fixed load model is building and solving')
-
-    # Initialize capacity variables
-    solar_cap = m.addVar(name='solar_cap', obj=solar_cap_cost)
-    solar_binary = m.addVar(name='solar_cap_binary', vtype=GRB.BINARY)
-    diesel_cap = m.addVar(obj=diesel_cap_cost_kw, name='diesel_cap')
-    diesel_binary = m.addVar(name='diesel_cap_binary', vtype=GRB.BINARY)
-    battery_la_cap_kwh = m.addVar(obj=battery_la_cap_cost_kwh, name='batt_la_energy_cap')
-    battery_la_cap_kw = m.addVar(obj=battery_inverter_cap_cost_kw, name='batt_la_power_cap')
-    battery_li_cap_kwh = m.addVar(obj=battery_li_cap_cost_kwh, name='batt_li_energy_cap')
-    battery_li_cap_kw = m.addVar(obj=battery_inverter_cap_cost_kw, name='batt_li_power_cap')
-
-    # constraints for technology availability
-    if not args.solar_ava:
-        m.addConstr(solar_cap == 0)
-    else:
-        m.addConstr(solar_cap - args.solar_min_cap * solar_binary >= 0)
-        m.addConstr(solar_cap * (1 - solar_binary) == 0)
-    if not args.battery_la_ava:
-        m.addConstr(battery_la_cap_kwh == 0)
-    if not args.battery_li_ava:
-        m.addConstr(battery_li_cap_kwh == 0)
-    if not args.diesel_ava:
-        m.addConstr(diesel_cap == 0)
-    else:
-        m.addConstr(diesel_cap - args.diesel_min_cap * diesel_binary >= 0)
-        m.addConstr(diesel_cap * (1 - diesel_binary) == 0)
-        if args.diesel_vali_cond:
-            m.addConstr(diesel_binary == 1)
-
-    # three-phase motor capacities limits
-    motor_limit_cap = get_motor_cap_limit(args, mg_name)
-    if args.motor_cap_limit:
-        if args.fixed_load_dir not in [f'fixed_load_ts/{scenario}' for scenario in
-                                       args.no_motor_cap_scenarios]:
-            m.addConstr(battery_la_cap_kw + battery_li_cap_kw >= motor_limit_cap)
-
-    # fixed generation system with solar, and LA battery and battery inverter
-    if args.fixed_gen_caps:
-        caps = get_fixed_system_size(args, mg_name)
-        print('Solar capacity [kW]: ', caps[0], '\n',
-              'Battery capacity [kWh]: ', caps[1], '\n',
-              'Inverter capacity [kWh]: ', caps[2])
-        m.addConstr(solar_cap == caps[0])
-        m.addConstr(battery_la_cap_kwh == caps[1])
-        # for inverter, choose the maximum of guided capacity and motor capacity if applicable.
-        if args.motor_cap_limit:
-            if args.fixed_load_dir not in [f'fixed_load_ts/{scenario}' for scenario in
-                                           args.no_motor_cap_scenarios]:
-                m.addConstr(battery_la_cap_kw == max(caps[2], motor_limit_cap))
-            else:
-                m.addConstr(battery_la_cap_kw == caps[2])
-        else:
-            m.addConstr(battery_la_cap_kw == caps[2])
-
-    # battery capacity constraints
-    m.addConstr(battery_la_cap_kwh * (1 - args.battery_la_min_soc) * float(args.battery_la_p2e_ratio_range[0]) <=
-                battery_la_cap_kw)
-    m.addConstr(battery_la_cap_kwh * (1 - args.battery_la_min_soc) * float(args.battery_la_p2e_ratio_range[1]) >=
-                battery_la_cap_kw)
-    m.addConstr(battery_li_cap_kwh * (1 - args.battery_li_min_soc) * float(args.battery_li_p2e_ratio_range[0]) <=
-                battery_li_cap_kw)
-    m.addConstr(battery_li_cap_kwh * (1 - args.battery_li_min_soc) * float(args.battery_li_p2e_ratio_range[1]) >=
-                battery_li_cap_kw)
-    m.update()
-
-    # Initialize time-series variables
-    solar_util = m.addVars(trange, name='solar_util')
-    battery_la_charge = m.addVars(trange, name='batt_la_charge')
-    battery_la_discharge = m.addVars(trange, obj=args.nominal_discharge_cost_kwh, name='batt_la_discharge')
-    battery_la_level = m.addVars(trange, name='batt_la_level')
-    battery_li_charge = m.addVars(trange, name='batt_li_charge')
-    battery_li_discharge = m.addVars(trange, obj=args.nominal_discharge_cost_kwh, name='batt_li_discharge')
-    battery_li_level = m.addVars(trange, name='batt_li_level')
-    diesel_kwh_fuel_cost = args.diesel_cost_liter * args.liter_per_kwh / args.diesel_eff
-    diesel_gen = m.addVars(trange, obj=diesel_kwh_fuel_cost, name="diesel_gen")
-
-    supply_deficit = m.addVars(trange, obj=args.deficit_penalty, name='supply_deficit')
-    supply_deficit_binary = m.addVars(trange, vtype=GRB.BINARY, name='supply_deficit_binary', obj=0.1)
-    curtailed_loads = m.addVars(trange, obj=args.curtailment_nominal, name='curtailed_loads')
-
-    # create commercial loads
-    pue_load = m.addVars(trange, name='pue_load')
-    m.update()
-
-    # Add time-series Constraints
-    for j in trange:
-        # solar and diesel generation constraint
-        m.addConstr(diesel_gen[j] <= diesel_cap)
-        m.addConstr(solar_util[j] <= solar_cap * round(solar_po_hourly[j], 4))
-
-        # Energy Balance
-        m.addConstr(solar_util[j] + diesel_gen[j] - battery_la_charge[j] + battery_la_discharge[j] -
-                    battery_li_charge[j] + battery_li_discharge[j] ==
-                    fixed_load[j] - curtailed_loads[j] - supply_deficit[j])
-
-        # curtailable load from those customers with high demand events. we tested how much impacts they have.
+    with timed_phase('read_solar'):
+        solar_po_hourly = load_timeseries(args, solar_region)
+
+    with timed_phase('read_loads'):
+        fixed_load = get_fixed_load(args, mg_name)
+        curtailable_load = None
         if args.curtailable_load_sce:
-            m.addConstr(curtailable_load[j] - curtailed_loads[j] == 0)
-        else:
-            m.addConstr(curtailed_loads[j] == 0)
-
-        # Battery operation constraints
-        m.addConstr(args.battery_la_eff * battery_la_charge[j] - battery_la_cap_kw <= 0)
-        m.addConstr(battery_la_discharge[j] / args.battery_la_eff - battery_la_cap_kw <= 0)
-        m.addConstr(battery_la_level[j] - battery_la_cap_kwh <= 0)
-        m.addConstr(battery_la_level[j] - battery_la_cap_kwh * args.battery_la_min_soc >= 0)
-
-        m.addConstr(args.battery_li_eff * battery_li_charge[j] - battery_li_cap_kw <= 0)
-        m.addConstr(battery_li_discharge[j] / args.battery_li_eff - battery_li_cap_kw <= 0)
-        m.addConstr(battery_li_level[j] - battery_li_cap_kwh <= 0)
-        m.addConstr(battery_li_level[j] - battery_li_cap_kwh * args.battery_li_min_soc >= 0)
-
-        # Battery control
-        if j == 0:
-            m.addConstr(
-                battery_la_discharge[j] / args.battery_la_eff - args.battery_la_eff * battery_la_charge[j] ==
-                battery_la_level[T - 1] - battery_la_level[j])
-            m.addConstr(
-                battery_li_discharge[j] / args.battery_li_eff - args.battery_li_eff * battery_li_charge[j] ==
-                battery_li_level[T - 1] - battery_li_level[j])
-        else:
-            m.addConstr(
-                battery_la_discharge[j] / args.battery_la_eff - args.battery_la_eff * battery_la_charge[j] ==
-                battery_la_level[j - 1] - battery_la_level[j])
-            m.addConstr(
-                battery_li_discharge[j] / args.battery_li_eff - args.battery_li_eff * battery_li_charge[j] ==
-                battery_li_level[j - 1] - battery_li_level[j])
-
-        m.addConstr(pue_load[j] == 0)
-
-        if args.supply_deficit_binary_sce:
-            m.addConstr(supply_deficit[j] <= fixed_load[j] * supply_deficit_binary[j])
-            if args.curtailable_load_sce:
-                m.addConstr(supply_deficit[j] <= (fixed_load[j] - curtailed_loads[j]) * supply_deficit_binary[j])
-            m.addConstr(supply_deficit[j] >= 0)
-
-
-    m.update()
-
-    # allowed supply deficit
-    if args.supply_deficit_sce:
-        m.addConstr(quicksum(supply_deficit[j] for j in trange) <= args.allowed_supply_deficit_frac * np.sum(fixed_load))
-    else:
-        m.addConstr(quicksum(supply_deficit[j] for j in trange) == 0)
+            curtailable_load = get_curtailable_load(args, mg_name)[:T]
 
-    # Set model solver parameters
-    m.setParam("FeasibilityTol", args.feasibility_tol)
-    m.setParam("OptimalityTol", args.optimality_tol)
-    m.setParam("Method", args.solver_method)
-    m.setParam("OutputFlag", 1)
-    # Solve the model
-    m.optimize()
+    return {'solar_po_hourly': solar_po_hourly[:T], 'fixed_load': fixed_load[:T],
+            'curtailable_load': curtailable_load}
 
-    ### ------------------------- Results Output ------------------------- ###
-    # Retrieve results and process the model solution
-    caps_results, ts_results = results_retrieval(m, T)
-    ts_results['fixed_load_kw'] = fixed_load  # add the fixed load to the time series results
 
-    # save results / get final processed results
-    if not os.path.exists(os.path.join(args.results_dir, mg_name)):
-        os.makedirs(os.path.join(args.results_dir, mg_name))
+def build_fix_load_model(args, mg_name, inputs=None, hour_weights=None, day_map=None, fixed_caps=None,
+                         period_hours=None, env=None):
+    # inputs, hour_weights, day_map and fixed_caps build the representative day models, inputs, hour_weights and
+    # period_hours the stacked scenario years of the stochastic model. by default the model covers the whole horizon
+    # with the inputs of the mini-grid. env: Gurobi environment of the model (default environment by default)
+    print("fixed load model building and solving")
+    print("--------####################------------")
 
-    processed_results = process_results(args, caps_results, ts_results)
+    if inputs is None:
+        inputs = get_fix_load_inputs(args, mg_name)
+    return assemble_model(args, mg_name, 'fixed', inputs, hour_weights, period_hours=period_hours, day_map=day_map,
+                          fixed_caps=fixed_caps, env=env)
+
+
+def solve_fix_load_rep_days(args, mg_name):
+    # screening run: capacities are sized on representative days weighted by the number of days they stand for,
+    # with the battery level linked across the calendar days. optionally the horizon is then dispatched at the fixed
+    # capacities, and the LCOE is compared with the full resolution model.
+    inputs = get_fix_load_inputs(args, mg_name)
+    T = len(inputs['fixed_load'])
+    if T % 24:
+        raise ValueError('num_hour_fixed_load must be whole days for the representative day model')
+
+    sizing_start_time = datetime.datetime.now()
+    with timed_phase('rep_days_clustering'):
+        rep_days, day_map, day_weights = get_rep_days(args, inputs)
+    add_counter('rep_days', len(rep_days))
+    m, handles = build_fix_load_model(args, mg_name, get_rep_day_inputs(inputs, rep_days),
+                                      np.repeat(day_weights, 24).astype(float), day_map=day_map)
+    optimize(m, args)
+    solve_info = get_solve_info(m)
+    if solve_info['sol_count'] == 0:
+        raise RuntimeError(f'sizing on representative days failed with status {solve_info["status"]}')
+    caps_results, ts_results = results_retrieval(m, handles['cap_vars'], handles['ts_vars'])
+    ts_results['fixed_load_kw'] = handles['fixed_load']
+    # a battery the scenario does not have has no day start levels
+    day_start_levels = {batt: get_values(m, handles['ts_vars'][f'{batt}_level_day_start'])
+                        for batt in ['batt_la', 'batt_li'] if f'{batt}_level_day_start' in handles['ts_vars']}
+    ts_results = expand_rep_days(ts_results, day_map, day_start_levels)
+    fixed_caps = {cap_name: get_values(m, cap_var) for cap_name, cap_var in handles['cap_vars'].items()}
+    rep_days_report = {'rep_days': len(rep_days), 'sizing_obj': solve_info['obj'],
+                       'sizing_time_s': (datetime.datetime.now() - sizing_start_time).total_seconds(),
+                       'rep_days_lcoe': process_results(args, caps_results, ts_results).LCOE[0]}
+    m.dispose()
+
+    # the dispatch check only penalizes the supply deficit, so that it stays feasible at the fixed capacities
+    if args.rep_days_dispatch_check:
+        dispatch_start_time = datetime.datetime.now()
+        m, handles = build_fix_load_model(args, mg_name, inputs, fixed_caps=fixed_caps)
+        m.remove(handles['deficit_constr'])
+        optimize(m, args)
+        solve_info = get_solve_info(m)
+        if solve_info['sol_count'] == 0:
+            raise RuntimeError(f'dispatch check at fixed capacities failed with status {solve_info["status"]}')
+        caps_results, ts_results = results_retrieval(m, handles['cap_vars'], handles['ts_vars'])
+        ts_results['fixed_load_kw'] = handles['fixed_load']
+        rep_days_report['dispatch_time_s'] = (datetime.datetime.now() - dispatch_start_time).total_seconds()
+        rep_days_report['dispatch_lcoe'] = process_results(args, caps_results, ts_results).LCOE[0]
+        # the dispatch is a solution of the full model only if its unserved energy is within the allowed deficit
+        unserved = np.sum(ts_results.supply_deficit_kw)
+        allowed_unserved = args.allowed_supply_deficit_frac * np.sum(inputs['fixed_load']) \
+            if args.supply_deficit_sce else 0.
+        rep_days_report['unserved_kwh'] = unserved
+        rep_days_report['allowed_unserved_kwh'] = allowed_unserved
+        rep_days_report['feasible'] = unserved <= allowed_unserved + args.feasibility_tol
+        m.dispose()
+
+    # LCOE error of the screening run against the full resolution model
+    if args.rep_days_report_error:
+        full_start_time = datetime.datetime.now()
+        m, handles = build_fix_load_model(args, mg_name, inputs)
+        optimize(m, args)
+        full_caps_results, full_ts_results = results_retrieval(m, handles['cap_vars'], handles['ts_vars'])
+        full_ts_results['fixed_load_kw'] = handles['fixed_load']
+        full_lcoe = process_results(args, full_caps_results, full_ts_results).LCOE[0]
+        rep_days_report['full_time_s'] = (datetime.datetime.now() - full_start_time).total_seconds()
+        rep_days_report['full_lcoe'] = full_lcoe
+        rep_days_report['rep_days_lcoe_error'] = (rep_days_report['rep_days_lcoe'] - full_lcoe) / full_lcoe
+        # the LCOE of a dispatch that does not serve the load is not compared
+        if args.rep_days_dispatch_check:
+            rep_days_report['dispatch_lcoe_error'] = (rep_days_report['dispatch_lcoe'] - full_lcoe) / full_lcoe \
+                if rep_days_report['feasible'] else np.nan
+        m.dispose()
+
+    return caps_results, ts_results, pd.DataFrame([rep_days_report])
 
-    ts_results.round(decimals=3).to_csv(os.path.join(args.results_dir, mg_name, 'ts_results.csv'))
-    processed_results.round(decimals=3).to_csv(os.path.join(args.results_dir, mg_name, 'processed_results.csv'))
+
+def create_fix_load_model(args, mg_name):
+    reports = dict()
+    if args.fixed_solve_mode == 'rep_days':
+        caps_results, ts_results, reports['rep_days_report'] = solve_fix_load_rep_days(args, mg_name)
+    elif args.fixed_solve_mode == 'stochastic':
+        from stochastic_sizing import solve_stochastic  # builds its models with build_fix_load_model
+        caps_results, ts_results, reports['stochastic_report'], reports['ph_report'] = solve_stochastic(args, mg_name)
+    else:
+        with timed_phase('build_model'):
+            m, handles = build_fix_load_model(args, mg_name)
+        # Solve the model
+        optimize(m, args)
+
+        ### ------------------------- Results Output ------------------------- ###
+        # Retrieve results and process the model solution
+        with timed_phase('results_retrieval'):
+            caps_results, ts_results = results_retrieval(m, handles['cap_vars'], handles['ts_vars'],
+                                                         dtype=get_ts_dtype(args))
+        ts_results['fixed_load_kw'] = handles['fixed_load']  # add the fixed load to the time series results
+        # the model is not needed once its results are read
+        m.dispose()
+
+    # save results / get final processed results
+    with timed_phase('process_results'):
+        processed_results = process_results(args, caps_results, ts_results)
+    with timed_phase('write_results'):
+        write_results(args, mg_name, ts_results, processed_results, reports=reports)
 
     return None
\ No newline at end of file
@@ -1,216 +1,258 @@
 from gurobipy import *
-from utils import get_cap_cost, load_timeseries, get_flex_pue_ts, get_fixed_system_size, get_curtailable_load, get_motor_cap_limit
-from results_processing import results_retrieval, process_results
+from utils import get_cap_cost, load_timeseries, get_flex_pue_ts, get_curtailable_load, validate_pue_daily_array
+from model_core import assemble_model
+from results_processing import results_retrieval, process_results, get_ts_dtype
+from results_store import write_results
+from solver_backend import optimize, get_solve_info, get_values
+from profiling import timed_phase, add_counter
 import numpy as np
 import pandas as pd
+import datetime
 import os
 
-def create_flex_pue_model(args, mg_name):
-    print("flex pue load model building and solving")
-    print("--------####################------------")
 
+def get_flex_pue_inputs(args, mg_name):
+    # hourly inputs of the flex pue model over its horizon
     T = args.num_hour_flex_pue
-    trange = range(T)
     solar_region = args.solar_region
-    solar_po_hourly = load_timeseries(args, solar_region)
-
-    fixed_load, pue_daily_array = get_flex_pue_ts(args, mg_name)
-    print(pue_daily_array, 'delete')
-    if args.curtailable_load_sce:
-        curtailable_load = get_curtailable_load(args, mg_name)
+    with timed_phase('read_solar'):
+        solar_po_hourly = load_timeseries(args, solar_region)
+
+    with timed_phase('read_loads'):
+        fixed_load, pue_daily_array, pue_ids = get_flex_pue_ts(args, mg_name)
+        if len(fixed_load) < T:
+            raise ValueError(f'{args.flex_pue_dir}/{mg_name}: {len(fixed_load)} hours of fixed load, the horizon '
+                             f'has {T}')
+        validate_pue_daily_array(pue_daily_array, pue_ids, T // 24, f'{args.flex_pue_dir}/{mg_name}')
+        curtailable_load = None
+        if args.curtailable_load_sce:
+            curtailable_load = get_curtailable_load(args, mg_name)[:T]
 
-    # Retrieve capital prices for solar, battery, and diesel generators
-    solar_cap_cost, battery_la_cap_cost_kwh, battery_li_cap_cost_kwh, \
-        battery_inverter_cap_cost_kw, diesel_cap_cost_kw = get_cap_cost(args, args.num_year_flex_pue)
+    return {'solar_po_hourly': solar_po_hourly[:T], 'fixed_load': fixed_load[:T],
+            'curtailable_load': curtailable_load, 'pue_daily_array': pue_daily_array[:, :T // 24]}
 
-    # create the model
-    m = Model("flex_pue_model")
-    print('Flexible pue model building and solving')
-
-    # Initialize capacity variables
-    solar_cap = m.addVar(name='solar_cap', obj=solar_cap_cost)
-    solar_binary = m.addVar(name='solar_cap_binary', vtype=GRB.BINARY)
-    diesel_cap = m.addVar(obj=diesel_cap_cost_kw, name='diesel_cap')
-    diesel_binary = m.addVar(name='diesel_cap_binary', vtype=GRB.BINARY)
-    battery_la_cap_kwh = m.addVar(obj=battery_la_cap_cost_kwh, name='batt_la_energy_cap')
-    battery_la_cap_kw = m.addVar(obj=battery_inverter_cap_cost_kw, name='batt_la_power_cap')
-    battery_li_cap_kwh = m.addVar(obj=battery_li_cap_cost_kwh, name='batt_li_energy_cap')
-    battery_li_cap_kw = m.addVar(obj=battery_inverter_cap_cost_kw, name='batt_li_power_cap')
-
-    # constraints for technology availability
-    if not args.solar_ava:
-        m.addConstr(solar_cap == 0)
-    else:
-        m.addConstr(solar_cap - args.solar_min_cap * solar_binary >= 0)
-        m.addConstr(solar_cap * (1 - solar_binary) == 0)
-    if not args.battery_la_ava:
-        m.addConstr(battery_la_cap_kwh == 0)
-    if not args.battery_li_ava:
-        m.addConstr(battery_li_cap_kwh == 0)
-    if not args.diesel_ava:
-        m.addConstr(diesel_cap == 0)
-    else:
-        m.addConstr(diesel_cap - args.diesel_min_cap * diesel_binary >= 0)
-        m.addConstr(diesel_cap * (1 - diesel_binary) == 0)
-        if args.diesel_vali_cond:
-            m.addConstr(diesel_binary == 1)
-
-    # three-phase motor capacity limits the battery inverter capacity
-    motor_limit_cap = get_motor_cap_limit(args, mg_name)
-    if args.motor_cap_limit:
-        if args.flex_pue_dir == 'flex_pue_ts/sp_tp':
-            m.addConstr(battery_la_cap_kw + battery_li_cap_kw >= motor_limit_cap)  # + diesel_cap
-
-    # fixed generation system with solar, and LA battery and battery inverter
-    if args.fixed_gen_caps:
-        caps = get_fixed_system_size(args, mg_name)
-        print('Solar capacity [kW]: ', caps[0], '\n',
-              'Battery capacity [kWh]: ', caps[1], '\n',
-              'Inverter capacity [kWh]: ', caps[2])
-        m.addConstr(solar_cap == caps[0])
-        m.addConstr(battery_la_cap_kwh == caps[1])
-        # for inverter, choose the maximum of guided capacity and motor capacity if applicable.
-        if args.motor_cap_limit:
-            if args.fixed_load_dir not in [f'fixed_load_ts/{scenario}' for scenario in
-                                           args.no_motor_cap_scenarios]:
-                m.addConstr(battery_la_cap_kw == max(caps[2], motor_limit_cap))
-            else:
-                m.addConstr(battery_la_cap_kw == caps[2])
-        else:
-            m.addConstr(battery_la_cap_kw == caps[2])
-
-    # battery capacity constraints
-    m.addConstr(battery_la_cap_kwh * (1 - args.battery_la_min_soc) * float(args.battery_la_p2e_ratio_range[0]) <=
-                battery_la_cap_kw)
-    m.addConstr(battery_la_cap_kwh * (1 - args.battery_la_min_soc) * float(args.battery_la_p2e_ratio_range[1]) >=
-                battery_la_cap_kw)
-    m.addConstr(battery_li_cap_kwh * (1 - args.battery_li_min_soc) * float(args.battery_li_p2e_ratio_range[0]) <=
-                battery_li_cap_kw)
-    m.addConstr(battery_li_cap_kwh * (1 - args.battery_li_min_soc) * float(args.battery_li_p2e_ratio_range[1]) >=
-                battery_li_cap_kw)
-    m.update()
-
-    # Initialize time-series variables
-    solar_util = m.addVars(trange, name='solar_util')
-    battery_la_charge = m.addVars(trange, name='batt_la_charge')
-    battery_la_discharge = m.addVars(trange, obj=args.nominal_discharge_cost_kwh, name='batt_la_discharge')
-    battery_la_level = m.addVars(trange, name='batt_la_level')
-    battery_li_charge = m.addVars(trange, name='batt_li_charge')
-    battery_li_discharge = m.addVars(trange, obj=args.nominal_discharge_cost_kwh, name='batt_li_discharge')
-    battery_li_level = m.addVars(trange, name='batt_li_level')
-    diesel_kwh_fuel_cost = args.diesel_cost_liter * args.liter_per_kwh / args.diesel_eff
-    diesel_gen = m.addVars(trange, obj=diesel_kwh_fuel_cost, name="diesel_gen")
 
-    supply_deficit = m.addVars(trange, obj=args.deficit_penalty, name='supply_deficit')
-    supply_deficit_binary = m.addVars(trange, vtype=GRB.BINARY, name='supply_deficit_binary', obj=0.1)
-    curtailed_loads = m.addVars(trange, obj=args.curtailment_nominal, name='curtailed_loads')
+def build_flex_pue_model(args, mg_name, inputs=None, hour_weights=None, period_hours=None, initial_level=None,
+                         fixed_caps=None, env=None):
+    # inputs, hour_weights, period_hours, initial_level and fixed_caps build the sub-horizon models of the rolling
+    # solve mode and the stacked scenario years of the stochastic model, by default the model covers the whole
+    # horizon with the inputs of the mini-grid. env: Gurobi environment of the model (default environment by default)
+    print("flex pue load model building and solving")
+    print("--------####################------------")
 
-    # create commercial loads
-    pue_load = m.addVars(trange, name='pue_load')
-    m.update()
+    if inputs is None:
+        inputs = get_flex_pue_inputs(args, mg_name)
+    return assemble_model(args, mg_name, 'flex', inputs, hour_weights, period_hours=period_hours,
+                          initial_level=initial_level, fixed_caps=fixed_caps, env=env)
+
+
+def get_window_inputs(inputs, hours):
+    # inputs restricted to the given hours, which are whole days
+    days = hours[::24] // 24
+    curtailable_load = inputs['curtailable_load']
+    return {'solar_po_hourly': inputs['solar_po_hourly'][hours], 'fixed_load': inputs['fixed_load'][hours],
+            'curtailable_load': None if curtailable_load is None else curtailable_load[hours],
+            'pue_daily_array': inputs['pue_daily_array'][:, days]}
+
+
+def get_sizing_windows(args, inputs):
+    # representative windows for sizing: evenly spaced windows over the year plus the window with the highest
+    # demand relative to the solar potential
+    window_hours = args.rolling_window_hours
+    num_windows = len(inputs['fixed_load']) // window_hours
+    hours = num_windows * window_hours
+    daily_pue = np.sum(inputs['pue_daily_array'][:, :hours // 24, 0], axis=0)
+    window_demand = np.sum(inputs['fixed_load'][:hours].reshape(num_windows, -1), axis=1) + \
+        np.sum(daily_pue.reshape(num_windows, -1), axis=1)
+    window_solar = np.sum(inputs['solar_po_hourly'][:hours].reshape(num_windows, -1), axis=1)
+    windows = set(np.linspace(0, num_windows - 1, args.rolling_sizing_windows).round().astype(int))
+    windows.add(int(np.argmax(window_demand / np.maximum(window_solar, 1e-6))))
+    return sorted(windows)
+
+
+def get_operation_cost(args, ts_results):
+    # hourly costs of a dispatch, as in the model objective
+    diesel_kwh_fuel_cost = args.diesel_cost_liter * args.liter_per_kwh / args.diesel_eff
+    return np.sum(args.nominal_discharge_cost_kwh * ts_results.batt_la_discharge_kw +
+                  args.nominal_discharge_cost_kwh * ts_results.batt_li_discharge_kw +
+                  diesel_kwh_fuel_cost * ts_results.diesel_util_kw +
+                  args.deficit_penalty * ts_results.supply_deficit_kw +
+                  args.curtailment_nominal * ts_results.curtailed_load_kw)
+
+
+def size_on_windows(args, mg_name, inputs, sizing_windows):
+    # capacities sized on the given windows, with the window costs scaled to the horizon. the battery levels run on
+    # through consecutive windows and wrap around within each run of consecutive windows. Returns the capacities and
+    # the objective of the sizing model.
+    T = len(inputs['fixed_load'])
+    window_hours = args.rolling_window_hours
+    sizing_hours = np.concatenate([np.arange(w * window_hours, (w + 1) * window_hours) for w in sizing_windows])
+    hour_weights = np.full(len(sizing_hours), T / len(sizing_hours))
+    run_starts = np.flatnonzero(np.diff(sizing_windows, prepend=-2) != 1)
+    period_hours = np.diff(np.append(run_starts, len(sizing_windows))) * window_hours
+    m, handles = build_flex_pue_model(args, mg_name, get_window_inputs(inputs, sizing_hours), hour_weights,
+                                      period_hours=period_hours)
+    optimize(m, args)
+    solve_info = get_solve_info(m)
+    if solve_info['sol_count'] == 0:
+        raise RuntimeError(f'sizing on representative windows failed with status {solve_info["status"]}')
+    fixed_caps = {cap_name: get_values(m, cap_var) for cap_name, cap_var in handles['cap_vars'].items()}
+    m.dispose()
+    return fixed_caps, solve_info['obj']
+
+
+def dispatch_rolling(args, mg_name, inputs, fixed_caps, lookahead_hours, initial_level=None):
+    # the horizon dispatched window by window at the fixed capacities with the battery level carried over from
+    # initial_level (empty batteries by default). each dispatch window looks ahead lookahead_hours, only its first
+    # window is kept. the dispatch windows only penalize the supply deficit, so that they stay feasible at the fixed
+    # capacities
+    T = len(inputs['fixed_load'])
+    window_hours = args.rolling_window_hours
+    if initial_level is None:
+        initial_level = {'batt_la': fixed_caps['batt_la_energy_cap'] * args.battery_la_min_soc,
+                         'batt_li': fixed_caps['batt_li_energy_cap'] * args.battery_li_min_soc}
+    ts_windows = []
+    for window_start in range(0, T, window_hours):
+        # the lookahead of the last windows wraps around to the start of the horizon, as the battery levels of the
+        # full model do
+        window_hours_ahead = min(window_hours, T - window_start) + lookahead_hours
+        m, handles = build_flex_pue_model(args, mg_name, get_window_inputs(
+            inputs, np.arange(window_start, window_start + window_hours_ahead) % T),
+            initial_level=initial_level, fixed_caps=fixed_caps)
+        m.remove(handles['deficit_constr'])
+        m.setParam("OutputFlag", 0)
+        optimize(m, args)
+        solve_info = get_solve_info(m)
+        if solve_info['sol_count'] == 0:
+            raise RuntimeError(f'dispatch window starting at hour {window_start} failed with status '
+                               f'{solve_info["status"]}')
+        caps_results, ts_results = results_retrieval(m, handles['cap_vars'], handles['ts_vars'])
+        ts_results = ts_results.iloc[:min(window_hours, T - window_start)]
+        initial_level = {'batt_la': ts_results.batt_la_level_kwh.values[-1],
+                         'batt_li': ts_results.batt_li_level_kwh.values[-1]}
+        ts_windows.append(ts_results)
+        add_counter('dispatch_windows')
+        m.dispose()
+    ts_results = pd.concat(ts_windows, ignore_index=True)
+    ts_results['fixed_load_kw'] = inputs['fixed_load']
+    return ts_results
+
+
+def solve_flex_pue_rolling(args, mg_name):
+    # capacities are sized on representative windows, then the horizon is dispatched in rolling windows at these
+    # capacities. while the dispatch leaves more unserved energy than the allowed supply deficit, up to
+    # rolling_max_repairs times: the window with the most unserved energy joins the sizing windows and the
+    # capacities are sized again. once all windows with unserved energy are sizing windows, the lookahead of the
+    # dispatch is doubled up to a window, then the windows before them join the sizing windows
+    inputs = get_flex_pue_inputs(args, mg_name)
+    T = len(inputs['fixed_load'])
+    window_hours = args.rolling_window_hours
+    if window_hours % 24 or args.rolling_lookahead_hours % 24:
+        raise ValueError('rolling_window_hours and rolling_lookahead_hours must be whole days')
+    num_windows = T // window_hours
+
+    # the dispatch is a solution of the full model only if its unserved energy is within the allowed supply deficit
+    total_load = np.sum(inputs['fixed_load']) + np.sum(inputs['pue_daily_array'][:, :T // 24, 0])
+    allowed_unserved = args.allowed_supply_deficit_frac * total_load if args.supply_deficit_sce else 0.
+
+    sizing_windows = get_sizing_windows(args, inputs)
+    lookahead_hours = args.rolling_lookahead_hours
+    sizing_time = dispatch_time = 0.
+    repairs = 0
+    fixed_caps = None
+    while True:
+        if fixed_caps is None:
+            sizing_start_time = datetime.datetime.now()
+            fixed_caps, sizing_obj = size_on_windows(args, mg_name, inputs, sizing_windows)
+            sizing_time += (datetime.datetime.now() - sizing_start_time).total_seconds()
+        # the full model wraps the battery levels around the horizon, the horizon is dispatched again from the
+        # levels it ended with
+        dispatch_start_time = datetime.datetime.now()
+        ts_results = dispatch_rolling(args, mg_name, inputs, fixed_caps, lookahead_hours)
+        ts_results = dispatch_rolling(args, mg_name, inputs, fixed_caps, lookahead_hours,
+                                      {'batt_la': ts_results.batt_la_level_kwh.values[-1],
+                                       'batt_li': ts_results.batt_li_level_kwh.values[-1]})
+        dispatch_time += (datetime.datetime.now() - dispatch_start_time).total_seconds()
+        unserved = np.sum(ts_results.supply_deficit_kw)
+        feasible = unserved <= allowed_unserved + args.feasibility_tol
+        if feasible or repairs >= args.rolling_max_repairs:
+            break
+        repairs += 1
+        window_unserved = np.sum(ts_results.supply_deficit_kw.values[:num_windows * window_hours].reshape(
+            num_windows, -1), axis=1)
+        unserved_windows = [w for w in np.argsort(-window_unserved) if window_unserved[w] > 0]
+        candidates = [w for w in unserved_windows if w not in sizing_windows]
+        # a sizing window with unserved energy is entered with too little stored energy, the window before it is
+        # sized as well and passes its battery level on
+        preceding = [w - 1 for w in unserved_windows if w > 0 and w - 1 not in sizing_windows]
+        if candidates or (lookahead_hours >= window_hours and preceding):
+            sizing_windows = sorted(sizing_windows + [int((candidates or preceding)[0])])
+            fixed_caps = None
+        elif lookahead_hours < window_hours:
+            lookahead_hours = min(max(2 * lookahead_hours, 24), window_hours)
+        else:
+            break
+    add_counter('sizing_windows', len(sizing_windows))
 
-    # Add time-series Constraints
-    for j in trange:
-        # solar and diesel generation constraint
-        m.addConstr(diesel_gen[j] <= diesel_cap)
-        m.addConstr(solar_util[j] <= solar_cap * round(solar_po_hourly[j], 4))
+    solar_cap_cost, battery_la_cap_cost_kwh, battery_li_cap_cost_kwh, \
+        battery_inverter_cap_cost_kw, diesel_cap_cost_kw = get_cap_cost(args, args.num_year_flex_pue)
+    capital_cost = fixed_caps['solar_cap'] * solar_cap_cost + fixed_caps['diesel_cap'] * diesel_cap_cost_kw + \
+        fixed_caps['batt_la_energy_cap'] * battery_la_cap_cost_kwh + fixed_caps['batt_li_energy_cap'] * \
+        battery_li_cap_cost_kwh + (fixed_caps['batt_la_power_cap'] + fixed_caps['batt_li_power_cap']) * \
+        battery_inverter_cap_cost_kw
+    rolling_report = {'sizing_windows': len(sizing_windows), 'repairs': repairs, 'lookahead_hours': lookahead_hours,
+                      'sizing_obj': sizing_obj, 'sizing_time_s': sizing_time,
+                      'dispatch_windows': -(-T // window_hours), 'dispatch_time_s': dispatch_time,
+                      'rolling_obj': capital_cost + get_operation_cost(args, ts_results),
+                      'unserved_kwh': unserved, 'allowed_unserved_kwh': allowed_unserved, 'feasible': feasible}
+
+    # optimality gap of the rolling solve against the monolithic model, there is none for an infeasible dispatch
+    if args.rolling_report_gap:
+        full_start_time = datetime.datetime.now()
+        m, handles = build_flex_pue_model(args, mg_name, inputs)
+        optimize(m, args)
+        full_obj = get_solve_info(m)['obj']
+        rolling_report['full_obj'] = full_obj
+        rolling_report['full_time_s'] = (datetime.datetime.now() - full_start_time).total_seconds()
+        rolling_report['gap'] = (rolling_report['rolling_obj'] - full_obj) / full_obj if rolling_report['feasible'] \
+            else np.nan
+        m.dispose()
+
+    caps_results = pd.DataFrame({'solar_cap_kw': [fixed_caps['solar_cap']],
+                                 'diesel_cap_kw': [fixed_caps['diesel_cap']],
+                                 'batt_la_energy_cap_kwh': [fixed_caps['batt_la_energy_cap']],
+                                 'batt_la_power_cap_kw': [fixed_caps['batt_la_power_cap']],
+                                 'batt_li_energy_cap_kwh': [fixed_caps['batt_li_energy_cap']],
+                                 'batt_li_power_cap_kw': [fixed_caps['batt_li_power_cap']]})
+    return caps_results, ts_results, pd.DataFrame([rolling_report])
 
-        # Energy Balance
-        m.addConstr(solar_util[j] + diesel_gen[j] - battery_la_charge[j] + battery_la_discharge[j] -
-                    battery_li_charge[j] + battery_li_discharge[j] ==
-                    fixed_load[j] + pue_load[j] - curtailed_loads[j] - supply_deficit[j])
 
-        # curtailable load from those customers with high demand events. we tested how much impacts they have.
-        if args.curtailable_load_sce:
-            m.addConstr(curtailable_load[j] - curtailed_loads[j] == 0)
-        else:
-            m.addConstr(curtailed_loads[j] == 0)
-
-        # Battery operation constraints
-        m.addConstr(args.battery_la_eff * battery_la_charge[j] - battery_la_cap_kw <= 0)
-        m.addConstr(battery_la_discharge[j] / args.battery_la_eff - battery_la_cap_kw <= 0)
-        m.addConstr(battery_la_level[j] - battery_la_cap_kwh <= 0)
-        m.addConstr(battery_la_level[j] - battery_la_cap_kwh * args.battery_la_min_soc >= 0)
-
-        m.addConstr(args.battery_li_eff * battery_li_charge[j] - battery_li_cap_kw <= 0)
-        m.addConstr(battery_li_discharge[j] / args.battery_li_eff - battery_li_cap_kw <= 0)
-        m.addConstr(battery_li_level[j] - battery_li_cap_kwh <= 0)
-        m.addConstr(battery_li_level[j] - battery_li_cap_kwh * args.battery_li_min_soc >= 0)
-
-        # Battery control
-        if j == 0:
-            m.addConstr(
-                battery_la_discharge[j] / args.battery_la_eff - args.battery_la_eff * battery_la_charge[j] ==
-                battery_la_level[T - 1] - battery_la_level[j])
-            m.addConstr(
-                battery_li_discharge[j] / args.battery_li_eff - args.battery_li_eff * battery_li_charge[j] ==
-                battery_li_level[T - 1] - battery_li_level[j])
-        else:
-            m.addConstr(
-                battery_la_discharge[j] / args.battery_la_eff - args.battery_la_eff * battery_la_charge[j] ==
-                battery_la_level[j - 1] - battery_la_level[j])
-            m.addConstr(
-                battery_li_discharge[j] / args.battery_li_eff - args.battery_li_eff * battery_li_charge[j] ==
-                battery_li_level[j - 1] - battery_li_level[j])
-
-        if args.supply_deficit_binary_sce:
-            m.addConstr(supply_deficit[j] <= fixed_load[j] * supply_deficit_binary[j])
-            if args.curtailable_load_sce:
-                m.addConstr(supply_deficit[j] <= (fixed_load[j] - curtailed_loads[j]) * supply_deficit_binary[j])
-            m.addConstr(supply_deficit[j] >= 0)
-
-
-    m.update()
-
-    # allowed supply deficit
-    if args.supply_deficit_sce:
-        m.addConstr(
-            quicksum(supply_deficit[j] for j in trange) <= args.allowed_supply_deficit_frac *
-            quicksum(fixed_load[j] + pue_load[j] for j in trange))
+def create_flex_pue_model(args, mg_name):
+    reports = dict()
+    if args.flex_solve_mode == 'rolling':
+        caps_results, ts_results, reports['rolling_report'] = solve_flex_pue_rolling(args, mg_name)
+    elif args.flex_solve_mode == 'stochastic':
+        from stochastic_sizing import solve_stochastic  # builds its models with build_flex_pue_model
+        caps_results, ts_results, reports['stochastic_report'], reports['ph_report'] = solve_stochastic(args, mg_name)
     else:
-        m.addConstr(quicksum(supply_deficit[j] for j in trange) == 0)
-
-    # Commercial load constraint / initialize variables for each commercial load
-    pue_nums = int(pue_daily_array.shape[0])
-    for pue_no in range(pue_nums):
-        pue_load_single = m.addVars(trange, name=f'pue_load_{pue_no}')
-        # for each pue, the daily sum and the daily max is limited
-        for d in range(int(args.num_hour_flex_pue/24)):
-            pue_load_single_daily = quicksum(pue_load_single[j] for j in range(d*24, (d+1)*24))
-            m.addConstr(pue_load_single_daily == pue_daily_array[pue_no, d, 0])
-            for hour in range(24):
-                m.addConstr(pue_load_single[d * 24 + hour] <= pue_daily_array[pue_no, d, 1])
-
-    m.update()
-
-    # sum the pue load single to pue load
-    for j in trange:
-        pue_load_sums = quicksum(m.getVarByName(f'pue_load_{pue_no}[{j}]') for pue_no in range(pue_nums))
-        m.addConstr(pue_load[j] == pue_load_sums)
-
-    m.update()
-
-    # Set model solver parameters
-    m.setParam("FeasibilityTol", args.feasibility_tol)
-    m.setParam("OptimalityTol", args.optimality_tol)
-    m.setParam("Method", args.solver_method)
-    m.setParam("TimeLimit", args.model_time_limit)
-    m.setParam("OutputFlag", 1)
-    # Solve the model
-    m.optimize()
-
-    ### ------------------------- Results Output ------------------------- ###
-    # Process the model solution
-    caps_results, ts_results = results_retrieval(m, T)
-    ts_results['fixed_load_kw'] = fixed_load  # add the fixed load to the time series results
+        with timed_phase('build_model'):
+            m, handles = build_flex_pue_model(args, mg_name)
+        # Solve the model
+        optimize(m, args)
+
+        ### ------------------------- Results Output ------------------------- ###
+        # Process the model solution
+        with timed_phase('results_retrieval'):
+            caps_results, ts_results = results_retrieval(m, handles['cap_vars'], handles['ts_vars'],
+                                                         dtype=get_ts_dtype(args))
+        ts_results['fixed_load_kw'] = handles['fixed_load']  # add the fixed load to the time series results
+        # the model is not needed once its results are read
+        m.dispose()
 
     # save results / get final processed results
-    if not os.path.exists(os.path.join(args.results_dir, mg_name)):
-        os.makedirs(os.path.join(args.results_dir, mg_name))
-
-    processed_results = process_results(args, caps_results, ts_results)
-
-    ts_results.round(decimals=3).to_csv(os.path.join(args.results_dir, mg_name, 'ts_results.csv'))
-    processed_results.round(decimals=3).to_csv(os.path.join(args.results_dir, mg_name, 'processed_results.csv'))
+    with timed_phase('process_results'):
+        processed_results = process_results(args, caps_results, ts_results)
+    with timed_phase('write_results'):
+        write_results(args, mg_name, ts_results, processed_results, reports=reports)
 
     return None
\ No newline at end of file
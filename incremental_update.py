@@ -0,0 +1,186 @@
+from gurobipy import *
+from fixed_load_model import build_fix_load_model, get_fix_load_inputs
+from flex_pue_model import build_flex_pue_model, get_flex_pue_inputs
+from results_processing import results_retrieval, process_results
+from results_store import write_results
+from solver_backend import optimize, get_solve_info
+from site_template import can_use_template
+from matrix_builder import presolve_inputs
+from model_core import has_motor_limit
+from result_cache import result_key_ignored_params, hash_file
+from utils import get_args
+import numpy as np
+import pandas as pd
+import datetime
+import json
+import time
+import os
+
+# parameters that only pick the input series of a site, see update_model_inputs
+input_series_params = ['solar_year', 'solar_region', 'fixed_load_dir', 'curtailment_dir', 'flex_pue_dir']
+
+# models of the sites solved in this process, keyed by mg name: (m, handles, structure key). A forecast update patches
+# the model of the previous update instead of building it again.
+_site_models = dict()
+
+
+def get_site_inputs(args, mg_name):
+    if args.fixed_load_sce:
+        return get_fix_load_inputs(args, mg_name)
+    return get_flex_pue_inputs(args, mg_name)
+
+
+def get_structure_key(args, mg_name):
+    # what an input update can not patch: the parameters and the site tables. the load and solar series are
+    # patched, the PUE daily loads are compared by update_model_inputs, so the parameters that only pick the series
+    # are left out. the load directories also decide whether the model has the motor capacity limit
+    params = {k: v for k, v in sorted(vars(args).items())
+              if k not in result_key_ignored_params + input_series_params}
+    site_tables = {path: hash_file(f'{args.data_dir}/{path}') for path in [args.motor_cap_dir, args.system_capacity]}
+    motor_limit = has_motor_limit(args, 'fixed' if args.fixed_load_sce else 'flex')
+    return json.dumps({'params': params, 'mg_name': mg_name, 'site_tables': site_tables, 'motor_limit': motor_limit},
+                      sort_keys=True, default=str)
+
+
+def build_site_model(args, mg_name, inputs):
+    if args.fixed_load_sce:
+        return build_fix_load_model(args, mg_name, inputs)
+    return build_flex_pue_model(args, mg_name, inputs)
+
+
+def update_model_inputs(m, args, handles, inputs):
+    # patch a full horizon model built by build_fix_load_model or build_flex_pue_model to new input arrays: the
+    # solar potential only changes coefficients of solar_cap in the solar availability rows, the fixed and
+    # curtailable loads only right-hand sides of the energy balance, the objective constant and the deficit limit
+    # (and the coefficients of the deficit binaries), the bounds of presolve_inputs are set again. Only rows whose
+    # value changed are patched, so Gurobi re-solves from the basis of the previous solve. Returns the number of
+    # patched rows per input, or None if the PUE daily loads changed, which changes the PUE groups, or if an hour
+    # without solar potential got some, which has no availability row. Both need a rebuild.
+    T = handles['T']
+    ts_vars = handles['ts_vars']
+    ts_constrs = handles['ts_constrs']
+    if handles['model_type'] == 'flex' and not np.array_equal(inputs['pue_daily_array'], handles['pue_daily_array']):
+        return None
+    presolve = presolve_inputs(inputs, T)
+    solar_hours = handles['solar_hours']
+    # the model has solar_util variables unless solar is not available, and availability rows only if some hour had
+    # solar potential
+    solar_built = not isinstance(ts_vars['solar_util'], np.ndarray)
+    if solar_built and np.any(np.delete(presolve['solar_po_hourly'], solar_hours) != 0):
+        return None
+    changes = dict()
+
+    # solar potential, rounded as in presolve_inputs. without solar the model has no solar availability rows
+    solar_po_hourly = presolve['solar_po_hourly']
+    changed = np.flatnonzero(solar_po_hourly != np.round(np.asarray(handles['solar_po_hourly'][:T], dtype=float), 4))
+    if 'solar_avail' in ts_constrs:
+        solar_avail = ts_constrs['solar_avail'].tolist()
+        solar_cap = handles['cap_vars']['solar_cap']
+        for j in changed:
+            m.chgCoeff(solar_avail[np.searchsorted(solar_hours, j)], solar_cap, -solar_po_hourly[j])
+    handles['solar_po_hourly'] = solar_po_hourly
+    changes['solar_po_hourly'] = len(changed)
+
+    # fixed and curtailable loads
+    fixed_load = np.asarray(inputs['fixed_load'][:T], dtype=float)
+    curtailable_load = inputs['curtailable_load']
+    if args.curtailable_load_sce:
+        curtailed_loads = np.asarray(curtailable_load[:T], dtype=float)
+    else:
+        curtailed_loads = np.zeros(T)
+    pue_flat_load = ts_vars.get('pue_flat_load', 0.)
+    rhs = fixed_load + pue_flat_load - curtailed_loads
+    changed = np.flatnonzero(rhs != handles['fixed_load'][:T] + pue_flat_load - ts_vars['curtailed_loads'])
+    if len(changed):
+        energy_balance = handles['energy_balance'].tolist()
+        m.setAttr('RHS', [energy_balance[j] for j in changed], rhs[changed])
+    changes['fixed_load'] = int(np.sum(fixed_load != handles['fixed_load'][:T]))
+    changes['curtailable_load'] = int(np.sum(curtailed_loads != ts_vars['curtailed_loads']))
+
+    # the deficit binaries limit the deficit to the (curtailed) fixed load of their hour
+    for constr_name, limit in [('deficit_binary', fixed_load), ('deficit_binary_curtailed', fixed_load -
+                                                                curtailed_loads)]:
+        if constr_name in ts_constrs:
+            binaries = ts_vars['supply_deficit_binary'].tolist()
+            deficit_binary = ts_constrs[constr_name].tolist()
+            prev_limit = handles['fixed_load'][:T] - (ts_vars['curtailed_loads'] if constr_name.endswith('curtailed')
+                                                      else 0.)
+            for j in np.flatnonzero(limit != prev_limit):
+                m.chgCoeff(deficit_binary[j], binaries[j], -limit[j])
+
+    ts_vars['supply_deficit'].UB = presolve['deficit_ub']
+    handles['fixed_load'] = fixed_load
+    handles['curtailable_load'] = curtailable_load
+    handles['total_fixed_load'] = handles['hour_weights'] @ fixed_load
+    ts_vars['curtailed_loads'] = curtailed_loads
+    m.ObjCon = float(np.sum(handles['hour_weights'] * args.curtailment_nominal * curtailed_loads))
+    if args.supply_deficit_sce:
+        handles['deficit_constr'].RHS = args.allowed_supply_deficit_frac * (handles['total_fixed_load'] +
+                                                                            handles['total_pue_load'])
+    m.update()
+    return changes
+
+
+def run_forecast_update(args, mg_list):
+    # solve every site with its current inputs. a site solved before in this process with the same parameters and
+    # site tables has its model patched with the changed load and solar values and is re-solved warm, any other site
+    # is built cold. the results are written as by main.py and a forecast_update_report.csv lists per site how the
+    # model was prepared, the patched rows and the times.
+    if not can_use_template(args):
+        raise ValueError('forecast updates need the full solve mode (fixed_solve_mode / flex_solve_mode: full)')
+    report = []
+    for mg_name in mg_list:
+        start_time = time.perf_counter()
+        inputs = get_site_inputs(args, mg_name)
+        structure_key = get_structure_key(args, mg_name)
+        changes = None
+        if mg_name in _site_models and _site_models[mg_name][2] == structure_key:
+            m, handles, _ = _site_models[mg_name]
+            changes = update_model_inputs(m, args, handles, inputs)
+            if changes is None:
+                m.dispose()
+        mode = 'incremental'
+        if changes is None:
+            mode = 'cold'
+            m, handles = build_site_model(args, mg_name, inputs)
+            _site_models[mg_name] = (m, handles, structure_key)
+        prepare_time = time.perf_counter() - start_time
+
+        # a MIP starts from the previous solution, an LP from the previous basis. the solution has to be kept at
+        # solve time, it is gone once the model is modified
+        if mode == 'incremental' and handles.get('prev_x') is not None:
+            m.setAttr('Start', m.getVars(), handles['prev_x'])
+        optimize(m, args)
+        solve_info = get_solve_info(m)
+        handles['prev_x'] = None
+        if m.IsMIP and args.solver_backend == 'gurobi' and solve_info['sol_count'] > 0:
+            handles['prev_x'] = m.getAttr('X', m.getVars())
+        caps_results, ts_results = results_retrieval(m, handles['cap_vars'], handles['ts_vars'])
+        ts_results['fixed_load_kw'] = handles['fixed_load']
+        processed_results = process_results(args, caps_results, ts_results)
+        write_results(args, mg_name, ts_results, processed_results)
+        report.append({'mg_name': mg_name, 'mode': mode, **{f'{k}_rows': v for k, v in (changes or {}).items()},
+                       'prepare_time_s': prepare_time, 'solve_time_s': solve_info['runtime'],
+                       'iterations': solve_info['iterations'], 'obj': solve_info['obj'],
+                       'total_time_s': time.perf_counter() - start_time})
+    report = pd.DataFrame(report)
+    os.makedirs(args.results_dir, exist_ok=True)
+    report.round(decimals=6).to_csv(os.path.join(args.results_dir, 'forecast_update_report.csv'), index=False)
+    return report
+
+
+if __name__ == '__main__':
+
+    running_start_time = datetime.datetime.now()
+
+    args = get_args()
+    mg_list = ['agoro']
+
+    # the first update builds the site models, later updates (e.g. after new load forecasts are written to
+    # data_dir) patch them
+    print(run_forecast_update(args, mg_list))
+    print(run_forecast_update(args, mg_list))
+
+    # showing the time used
+    running_end_time = datetime.datetime.now()
+    print(running_end_time - running_start_time)
@@ -0,0 +1,79 @@
+from utils import get_args, get_solar_ts, get_flex_pue_ts, input_mtime
+import numpy as np
+import pandas as pd
+import argparse
+import datetime
+import os
+
+
+def save_store_array(args, store_file, array):
+    store_path = os.path.join(args.input_store_dir, store_file)
+    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    np.save(store_path, np.ascontiguousarray(array, dtype=float))
+
+
+def ingest_inputs(args):
+    # convert every input under data_dir into a .npy array (time series) or a Parquet table (site lookup tables)
+    # in input_store_dir, with metadata.parquet indexing them by their source path relative to data_dir
+    csv_args = argparse.Namespace(**vars(args))
+    csv_args.input_store_dir = ''
+    os.makedirs(args.input_store_dir, exist_ok=True)
+    metadata = []
+    for root, dirs, files in os.walk(args.data_dir):
+        dirs.sort()
+        rel_root = os.path.relpath(root, args.data_dir).replace(os.sep, '/')
+
+        # flex PUE site directory, all daily PUE files are stacked into one array
+        if any(name.startswith('pue_daily') for name in files):
+            flex_pue_dir, mg_name = os.path.split(rel_root)
+            csv_args.flex_pue_dir = flex_pue_dir
+            fixed_load, pue_daily_array, _ = get_flex_pue_ts(csv_args, mg_name)
+            save_store_array(args, f'{rel_root}/fixed_loads.npy', fixed_load)
+            save_store_array(args, f'{rel_root}/pue_daily_loads.npy', pue_daily_array)
+            metadata.append({'source': f'{rel_root}/fixed_loads.csv', 'store_file': f'{rel_root}/fixed_loads.npy',
+                             'mtime_ns': input_mtime(os.path.join(root, 'fixed_loads.csv')),
+                             'shape': str(fixed_load.shape)})
+            metadata.append({'source': rel_root, 'store_file': f'{rel_root}/pue_daily_loads.npy',
+                             'mtime_ns': input_mtime(root), 'shape': str(pue_daily_array.shape)})
+            print(f'{rel_root} -> {rel_root}/pue_daily_loads.npy {pue_daily_array.shape}')
+            continue
+
+        for name in sorted(files):
+            if not name.endswith('.csv'):
+                continue
+            source = name if rel_root == '.' else f'{rel_root}/{name}'
+            source_path = os.path.join(root, name)
+            csv_data = pd.read_csv(source_path)
+            if 'mg_name' in csv_data.columns:
+                store_file = source[:-len('.csv')] + '.parquet'
+                store_path = os.path.join(args.input_store_dir, store_file)
+                os.makedirs(os.path.dirname(store_path), exist_ok=True)
+                csv_data.set_index('mg_name').to_parquet(store_path)
+                shape = csv_data.shape
+            else:
+                if rel_root == 'uganda_solar_ts':
+                    array = np.array(get_solar_ts(csv_data, args), dtype=float)[:, 0]
+                else:
+                    array = np.array(csv_data.set_index(csv_data.columns[0]))[:, 0]
+                store_file = source[:-len('.csv')] + '.npy'
+                save_store_array(args, store_file, array)
+                shape = array.shape
+            metadata.append({'source': source, 'store_file': store_file, 'mtime_ns': input_mtime(source_path),
+                             'shape': str(shape)})
+            print(f'{source} -> {store_file} {shape}')
+
+    metadata = pd.DataFrame(metadata)
+    metadata.to_parquet(os.path.join(args.input_store_dir, 'metadata.parquet'), index=False)
+    return metadata
+
+
+if __name__ == '__main__':
+
+    running_start_time = datetime.datetime.now()
+
+    args = get_args()
+    ingest_inputs(args)
+
+    # showing the time used
+    running_end_time = datetime.datetime.now()
+    print(running_end_time - running_start_time)
@@ -0,0 +1,259 @@
+from gurobipy import *
+from profiling import timed_phase, add_counter
+import scipy.sparse as sp
+import numpy as np
+
+
+def add_gen_cap_var(m, name, obj, available, min_cap=0., force_min=False):
+    # capacity of a generator that is either not built or built with at least min_cap. a semi-continuous variable
+    # replaces the on/off binary and its bilinear constraint, and without a minimum capacity the variable is
+    # continuous, so that the model stays a linear problem
+    if not available:
+        return m.addVar(obj=obj, ub=0, name=name)
+    if force_min:
+        return m.addVar(obj=obj, lb=min_cap, name=name)
+    if min_cap > 0:
+        return m.addVar(obj=obj, lb=min_cap, vtype=GRB.SEMICONT, name=name)
+    return m.addVar(obj=obj, name=name)
+
+
+def get_pue_groups(pue_daily_array):
+    # merge the PUEs of each day into groups. A PUE with daily energy s and hourly cap c shifts its energy freely
+    # within the day, and a set of PUEs can together reach any hourly profile whose k highest hours sum to at most
+    # sum_n min(s_n, c_n * k). PUEs with the same number of full-power hours floor(s / c) all switch from their cap
+    # to their energy at the same k, so their sum is exactly a single PUE with the summed energy and cap. A day thus
+    # has at most 25 groups whatever the number of PUEs. PUEs without energy are dropped and PUEs at their cap all
+    # day (s = 24 c) are a constant load. Returns the day, energy and cap of each group and the constant load of
+    # each day.
+    daily_energy = pue_daily_array[:, :, 0]
+    daily_cap = pue_daily_array[:, :, 1]
+    num_days = daily_energy.shape[1]
+    day = np.broadcast_to(np.arange(num_days), daily_energy.shape)
+    flat = (daily_cap > 0) & np.isclose(daily_energy, 24 * daily_cap)
+    flat_load = np.sum(np.where(flat, daily_cap, 0.), axis=0)
+    # a PUE with energy and no cap can not be met, it is kept as a group of its own so that the model is infeasible
+    with np.errstate(divide='ignore', invalid='ignore'):
+        full_power_hours = np.where(daily_cap > 0, np.minimum(np.floor(daily_energy / daily_cap), 24), 25)
+    grouped = (daily_energy > 0) & ~flat
+    group_keys, group_index = np.unique(day[grouped] * 26 + full_power_hours[grouped], return_inverse=True)
+    group_day = (group_keys // 26).astype(int)
+    group_energy = np.bincount(group_index, weights=daily_energy[grouped], minlength=len(group_keys))
+    group_cap = np.bincount(group_index, weights=daily_cap[grouped], minlength=len(group_keys))
+    return group_day, group_energy, group_cap, flat_load
+
+
+def add_pue_vars(m, T, pue_daily_array):
+    # flexible PUE loads over the whole days of the horizon, one variable block per PUE group and day (see
+    # get_pue_groups) with the hourly cap of the group as upper bound and its daily energy as constraint. Returns
+    # the ts_vars of the PUE groups and the hourly PUE load as a linear expression, which goes straight into the
+    # energy balance.
+    group_day, group_energy, group_cap, flat_load = get_pue_groups(pue_daily_array[:, :T // 24])
+    num_groups = len(group_day)
+    pue_group_load = m.addMVar((num_groups, 24), ub=np.repeat(group_cap[:, None], 24, axis=1),
+                               name='pue_group_load')
+    m.addConstr(pue_group_load.sum(axis=1) == group_energy, name='pue_daily_energy')
+
+    # hour of the horizon of each group variable, hours after the last whole day have no PUE load
+    group_hours = (group_day[:, None] * 24 + np.arange(24)).ravel()
+    pue_group_hours = sp.csr_matrix((np.ones(num_groups * 24), (group_hours, np.arange(num_groups * 24))),
+                                    shape=(T, num_groups * 24))
+    pue_flat_load = np.zeros(T)
+    pue_flat_load[:len(flat_load) * 24] = np.repeat(flat_load, 24)
+    pue_load = pue_group_hours @ pue_group_load.reshape(-1) + pue_flat_load
+    return {'pue_group_load': pue_group_load, 'pue_group_hours': pue_group_hours,
+            'pue_flat_load': pue_flat_load}, pue_load
+
+
+def presolve_inputs(inputs, T):
+    # bounds worked out from the input arrays before the model is built. The hours without solar potential only
+    # fix solar_util to zero, they get an upper bound of zero instead of an availability row. The hourly supply
+    # deficit is at most the fixed load plus the hourly caps of the PUEs with energy on that day, the curtailed load
+    # is not subtracted as the site template switches it in place.
+    solar_po_hourly = np.round(np.asarray(inputs['solar_po_hourly'][:T], dtype=float), 4)
+    deficit_ub = np.maximum(np.asarray(inputs['fixed_load'][:T], dtype=float), 0.)
+    pue_daily_array = inputs.get('pue_daily_array')
+    if pue_daily_array is not None:
+        num_days = T // 24
+        pue_cap = np.where(pue_daily_array[:, :num_days, 0] > 0, pue_daily_array[:, :num_days, 1], 0.)
+        deficit_ub[:num_days * 24] += np.repeat(np.sum(np.maximum(pue_cap, 0.), axis=0), 24)
+    return {'solar_po_hourly': solar_po_hourly, 'solar_hours': np.flatnonzero(solar_po_hourly != 0),
+            'deficit_ub': deficit_ub}
+
+
+def add_solar_vars(m, args, name, block):
+    solar_ub = np.where(block['presolve']['solar_po_hourly'] != 0, GRB.INFINITY, 0.)
+    block['ts_vars']['solar_util'] = m.addMVar(block['T'], ub=solar_ub, name='solar_util')
+    block['supply'].append(block['ts_vars']['solar_util'])
+
+
+def add_solar_constrs(m, args, name, block):
+    # availability rows of the hours with solar potential only, see presolve_inputs. a horizon without any solar
+    # potential has no rows, solar_util is zero by its bounds
+    solar_cap = MVar.fromvar(block['cap_vars']['solar_cap'])
+    solar_hours = block['presolve']['solar_hours']
+    if len(solar_hours) == 0:
+        return
+    solar_po_hourly = block['presolve']['solar_po_hourly'][solar_hours]
+    block['ts_constrs']['solar_avail'] = m.addConstr(
+        block['ts_vars']['solar_util'][solar_hours] <= solar_po_hourly * solar_cap, name='solar_avail')
+
+
+def add_battery_vars(m, args, batt, block):
+    # the discharge cost avoids battery activity that is not needed
+    ts_vars = block['ts_vars']
+    ts_vars[f'{batt}_charge'] = m.addMVar(block['T'], name=f'{batt}_charge')
+    ts_vars[f'{batt}_discharge'] = m.addMVar(block['T'], obj=block['hour_weights'] * args.nominal_discharge_cost_kwh,
+                                             name=f'{batt}_discharge')
+    ts_vars[f'{batt}_level'] = m.addMVar(block['T'], name=f'{batt}_level')
+    block['supply'] += [ts_vars[f'{batt}_discharge'], -ts_vars[f'{batt}_charge']]
+
+
+def add_battery_constrs(m, args, batt, block):
+    # Battery operation constraints and control, the level of hour j-1 wraps around to the last hour of the period
+    # for the first hour of each period (period_hours: the hours of every period or a list of period lengths), or starts from the initial level of the battery. With a day_map the levels
+    # are linked across the calendar days, see add_linked_soc_constraints.
+    T = block['T']
+    eff = getattr(args, f"{batt.replace('batt', 'battery')}_eff")
+    min_soc = getattr(args, f"{batt.replace('batt', 'battery')}_min_soc")
+    cap_kwh = MVar.fromvar(block['cap_vars'][f'{batt}_energy_cap'])
+    cap_kw = MVar.fromvar(block['cap_vars'][f'{batt}_power_cap'])
+    ts_vars = block['ts_vars']
+    charge = ts_vars[f'{batt}_charge']
+    discharge = ts_vars[f'{batt}_discharge']
+    level = ts_vars[f'{batt}_level']
+    m.addConstr(eff * charge - cap_kw <= 0, name=f'{batt}_charge_limit')
+    m.addConstr(discharge / eff - cap_kw <= 0, name=f'{batt}_discharge_limit')
+    if block['day_map'] is not None:
+        ts_vars[f'{batt}_level_day_start'] = add_linked_soc_constraints(m, batt, eff, min_soc, cap_kwh, charge,
+                                                                        discharge, level, block['day_map'])
+        return
+    m.addConstr(level - cap_kwh <= 0, name=f'{batt}_level_max')
+    m.addConstr(level - cap_kwh * min_soc >= 0, name=f'{batt}_level_min')
+    initial_level = block['initial_level']
+    if initial_level is None:
+        # periods of period_hours each, or of the listed numbers of hours
+        period_hours = block['period_hours']
+        prev_hour = np.arange(T) - 1
+        if np.ndim(period_hours) == 0:
+            prev_hour[::period_hours] += period_hours
+        else:
+            prev_hour[np.cumsum(period_hours) - period_hours] += period_hours
+        m.addConstr(discharge / eff - eff * charge == level[prev_hour] - level, name=f'{batt}_soc')
+    else:
+        m.addConstr(discharge[0] / eff - eff * charge[0] == initial_level[batt] - level[0], name=f'{batt}_soc_init')
+        m.addConstr(discharge[1:] / eff - eff * charge[1:] == level[:-1] - level[1:], name=f'{batt}_soc')
+
+
+def add_diesel_vars(m, args, name, block):
+    diesel_kwh_fuel_cost = args.diesel_cost_liter * args.liter_per_kwh / args.diesel_eff
+    block['ts_vars']['diesel_gen'] = m.addMVar(block['T'], obj=block['hour_weights'] * diesel_kwh_fuel_cost,
+                                               name='diesel_gen')
+    block['supply'].append(block['ts_vars']['diesel_gen'])
+
+
+def add_diesel_constrs(m, args, name, block):
+    diesel_cap = MVar.fromvar(block['cap_vars']['diesel_cap'])
+    m.addConstr(block['ts_vars']['diesel_gen'] <= diesel_cap, name='diesel_gen_limit')
+
+
+def add_deficit_vars(m, args, name, block):
+    # the deficit binaries only exist with supply_deficit_binary_sce
+    ts_vars = block['ts_vars']
+    ts_vars['supply_deficit'] = m.addMVar(block['T'], ub=block['presolve']['deficit_ub'],
+                                          obj=block['hour_weights'] * args.deficit_penalty, name='supply_deficit')
+    if args.supply_deficit_binary_sce:
+        ts_vars['supply_deficit_binary'] = m.addMVar(block['T'], vtype=GRB.BINARY, obj=block['hour_weights'] * 0.1,
+                                                    name='supply_deficit_binary')
+    block['demand'].append(-ts_vars['supply_deficit'])
+
+
+def add_deficit_constrs(m, args, name, block):
+    if not args.supply_deficit_binary_sce:
+        return
+    ts_vars = block['ts_vars']
+    supply_deficit = ts_vars['supply_deficit']
+    supply_deficit_binary = ts_vars['supply_deficit_binary']
+    fixed_load = np.asarray(block['inputs']['fixed_load'][:block['T']], dtype=float)
+    block['ts_constrs']['deficit_binary'] = m.addConstr(supply_deficit <= fixed_load * supply_deficit_binary,
+                                                        name='deficit_binary')
+    if args.curtailable_load_sce:
+        block['ts_constrs']['deficit_binary_curtailed'] = m.addConstr(
+            supply_deficit <= (fixed_load - ts_vars['curtailed_loads']) * supply_deficit_binary,
+            name='deficit_binary_curtailed')
+    m.addConstr(supply_deficit >= 0)
+
+
+def add_curtailment(m, args, name, block):
+    # curtailable load from those customers with high demand events. we tested how much impacts they have. The
+    # curtailed loads are fixed by the scenario and are kept as an array, their cost is a constant of the objective.
+    curtailed_loads = np.asarray(block['inputs']['curtailable_load'][:block['T']], dtype=float)
+    block['ts_vars']['curtailed_loads'] = curtailed_loads
+    m.ObjCon = float(np.sum(block['hour_weights'] * args.curtailment_nominal * curtailed_loads))
+
+
+def add_flex_pue(m, args, name, block):
+    # Commercial loads: the PUEs merged into groups per day, their hourly load is summed into the energy balance.
+    # the daily PUE energy is fixed, so the weighted PUE load is a constant (hour weights are the same within a day)
+    T = block['T']
+    pue_daily_array = block['inputs']['pue_daily_array']
+    add_counter('pue_loads', int(pue_daily_array.shape[0]))
+    with timed_phase('build_pue_constraints'):
+        pue_vars, pue_load = add_pue_vars(m, T, pue_daily_array)
+    block['ts_vars'].update(pue_vars)
+    add_counter('pue_groups', pue_vars['pue_group_load'].shape[0])
+    block['demand'].append(pue_load)
+    num_days = T // 24
+    day_weights = np.asarray(block['hour_weights'][:num_days * 24], dtype=float).reshape(num_days, 24).mean(axis=1)
+    block['total_pue_load'] = day_weights @ np.sum(pue_daily_array[:, :num_days, 0], axis=0)
+
+
+def add_energy_balance(m, args, block):
+    # Energy Balance: the supply of the built components meets the fixed load, less the curtailed load and the
+    # supply deficit, plus the flexible PUE load
+    ts_vars = block['ts_vars']
+    demand = np.asarray(block['inputs']['fixed_load'][:block['T']], dtype=float) - ts_vars['curtailed_loads']
+    for demand_term in block['demand']:
+        demand = demand + demand_term
+    block['ts_constrs']['energy_balance'] = m.addConstr(sum(block['supply']) == demand, name='energy_balance')
+
+
+# hourly components of the models, in the order they are built: name, the parameter that enables the component (None:
+# always built), the functions adding its variables and its constraints, and its ts_vars. A component the scenario
+# does not enable adds no variables or constraints, its ts_vars are kept as arrays of zeros.
+ts_components = [('solar', 'solar_ava', add_solar_vars, add_solar_constrs, ['solar_util']),
+                 ('batt_la', 'battery_la_ava', add_battery_vars, add_battery_constrs,
+                  ['batt_la_charge', 'batt_la_discharge', 'batt_la_level']),
+                 ('batt_li', 'battery_li_ava', add_battery_vars, add_battery_constrs,
+                  ['batt_li_charge', 'batt_li_discharge', 'batt_li_level']),
+                 ('diesel', 'diesel_ava', add_diesel_vars, add_diesel_constrs, ['diesel_gen']),
+                 ('deficit', None, add_deficit_vars, add_deficit_constrs, ['supply_deficit']),
+                 ('curtailment', 'curtailable_load_sce', add_curtailment, None, ['curtailed_loads'])]
+flex_pue_component = ('flex_pue', None, add_flex_pue, None, [])
+
+def add_linked_soc_constraints(m, batt, eff, min_soc, cap_kwh, charge, discharge, level, day_map):
+    # level is the change of the battery level since the start of its representative day. the level at the start
+    # of every calendar day advances by the net change of the day's representative day, and the day's highest and
+    # lowest level keep the absolute level within the battery limits.
+    T = level.shape[0]
+    num_rep_days = T // 24
+    num_days = len(day_map)
+    level.LB = -GRB.INFINITY
+    day_start = np.arange(0, T, 24)
+    other_hours = np.setdiff1d(np.arange(T), day_start)
+    m.addConstr(discharge[day_start] / eff - eff * charge[day_start] == -level[day_start], name=f'{batt}_soc_init')
+    m.addConstr(discharge[other_hours] / eff - eff * charge[other_hours] == level[other_hours - 1] -
+                level[other_hours], name=f'{batt}_soc')
+
+    rep_day_of_hour = np.repeat(np.arange(num_rep_days), 24)
+    level_day_max = m.addMVar(num_rep_days, lb=-GRB.INFINITY, name=f'{batt}_level_day_max')
+    level_day_min = m.addMVar(num_rep_days, lb=-GRB.INFINITY, name=f'{batt}_level_day_min')
+    m.addConstr(level <= level_day_max[rep_day_of_hour], name=f'{batt}_level_day_max')
+    m.addConstr(level >= level_day_min[rep_day_of_hour], name=f'{batt}_level_day_min')
+
+    day_start_level = m.addMVar(num_days, name=f'{batt}_level_day_start')
+    next_day = np.roll(np.arange(num_days), -1)
+    day_change = level[day_start + 23]
+    m.addConstr(day_start_level[next_day] == day_start_level + day_change[day_map], name=f'{batt}_soc_day_link')
+    m.addConstr(day_start_level + level_day_max[day_map] - cap_kwh <= 0, name=f'{batt}_level_max')
+    m.addConstr(day_start_level + level_day_min[day_map] - cap_kwh * min_soc >= 0, name=f'{batt}_level_min')
+    return day_start_level
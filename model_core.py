@@ -0,0 +1,163 @@
+from gurobipy import *
+from utils import get_cap_cost, get_fixed_system_size, get_motor_cap_limit
+from matrix_builder import add_gen_cap_var, add_energy_balance, presolve_inputs, ts_components, flex_pue_component
+from profiling import timed_phase, add_counter
+import numpy as np
+
+# the fixed load and flexible PUE models are configurations of the same core: the model name, the parameter with the
+# years of the capital costs and the hourly components, see matrix_builder.ts_components
+model_configs = {'fixed': {'model_name': 'fixed_load_model', 'num_year': 'num_year_fixed_load',
+                           'components': ts_components},
+                 'flex': {'model_name': 'flex_pue_model', 'num_year': 'num_year_flex_pue',
+                          'components': ts_components + [flex_pue_component]}}
+
+
+def has_motor_limit(args, model_type):
+    # the three-phase motor capacity limit applies to the load scenarios with motor PUEs
+    if model_type == 'flex':
+        return args.flex_pue_dir == 'flex_pue_ts/sp_tp'
+    return args.fixed_load_dir not in [f'fixed_load_ts/{scenario}' for scenario in args.no_motor_cap_scenarios]
+
+
+def add_cap_vars(m, args, mg_name, model_type, num_year):
+    # Retrieve capital prices for solar, battery, and diesel generators
+    solar_cap_cost, battery_la_cap_cost_kwh, battery_li_cap_cost_kwh, \
+        battery_inverter_cap_cost_kw, diesel_cap_cost_kw = get_cap_cost(args, num_year)
+
+    # Initialize capacity variables, solar and diesel are either not built or built with their minimum capacity
+    solar_cap = add_gen_cap_var(m, 'solar_cap', solar_cap_cost, args.solar_ava, args.solar_min_cap)
+    diesel_cap = add_gen_cap_var(m, 'diesel_cap', diesel_cap_cost_kw, args.diesel_ava, args.diesel_min_cap,
+                                 force_min=args.diesel_vali_cond)
+    battery_la_cap_kwh = m.addVar(obj=battery_la_cap_cost_kwh, ub=GRB.INFINITY if args.battery_la_ava else 0,
+                                  name='batt_la_energy_cap')
+    battery_la_cap_kw = m.addVar(obj=battery_inverter_cap_cost_kw, name='batt_la_power_cap')
+    battery_li_cap_kwh = m.addVar(obj=battery_li_cap_cost_kwh, ub=GRB.INFINITY if args.battery_li_ava else 0,
+                                  name='batt_li_energy_cap')
+    battery_li_cap_kw = m.addVar(obj=battery_inverter_cap_cost_kw, name='batt_li_power_cap')
+
+    # three-phase motor capacity limits the battery inverter capacity
+    motor_limit_cap = get_motor_cap_limit(args, mg_name)
+    motor_constr = None
+    if args.motor_cap_limit and has_motor_limit(args, model_type):
+        motor_constr = m.addConstr(battery_la_cap_kw + battery_li_cap_kw >= motor_limit_cap, name='motor_cap_limit')
+
+    # fixed generation system with solar, and LA battery and battery inverter
+    if args.fixed_gen_caps:
+        caps = get_fixed_system_size(args, mg_name)
+        print('Solar capacity [kW]: ', caps[0], '\n',
+              'Battery capacity [kWh]: ', caps[1], '\n',
+              'Inverter capacity [kWh]: ', caps[2])
+        m.addConstr(solar_cap == caps[0])
+        m.addConstr(battery_la_cap_kwh == caps[1])
+        # for inverter, choose the maximum of guided capacity and motor capacity if applicable.
+        if args.motor_cap_limit and has_motor_limit(args, 'fixed'):
+            m.addConstr(battery_la_cap_kw == max(caps[2], motor_limit_cap))
+        else:
+            m.addConstr(battery_la_cap_kw == caps[2])
+
+    # battery capacity constraints
+    m.addConstr(battery_la_cap_kwh * (1 - args.battery_la_min_soc) * float(args.battery_la_p2e_ratio_range[0]) <=
+                battery_la_cap_kw)
+    m.addConstr(battery_la_cap_kwh * (1 - args.battery_la_min_soc) * float(args.battery_la_p2e_ratio_range[1]) >=
+                battery_la_cap_kw)
+    m.addConstr(battery_li_cap_kwh * (1 - args.battery_li_min_soc) * float(args.battery_li_p2e_ratio_range[0]) <=
+                battery_li_cap_kw)
+    m.addConstr(battery_li_cap_kwh * (1 - args.battery_li_min_soc) * float(args.battery_li_p2e_ratio_range[1]) >=
+                battery_li_cap_kw)
+    cap_vars = {'solar_cap': solar_cap, 'diesel_cap': diesel_cap,
+                'batt_la_energy_cap': battery_la_cap_kwh, 'batt_la_power_cap': battery_la_cap_kw,
+                'batt_li_energy_cap': battery_li_cap_kwh, 'batt_li_power_cap': battery_li_cap_kw}
+    return cap_vars, motor_constr, motor_limit_cap
+
+
+def assemble_model(args, mg_name, model_type, inputs, hour_weights=None, period_hours=None, initial_level=None,
+                   day_map=None, fixed_caps=None, env=None):
+    # the model of model_type ('fixed' or 'flex') over the hours of inputs: the capacity variables, then the hourly
+    # components the scenario enables, the energy balance over the supply and demand terms of the components and the
+    # allowed supply deficit. Returns the model and the handles to its parts that sweeps and re-solves edit in place.
+    config = model_configs[model_type]
+    fixed_load = inputs['fixed_load']
+    T = len(fixed_load)
+    if hour_weights is None:
+        hour_weights = np.ones(T)
+    num_year = getattr(args, config['num_year'])
+
+    # create the model
+    m = Model(config['model_name'], env=env)
+    cap_vars, motor_constr, motor_limit_cap = add_cap_vars(m, args, mg_name, model_type, num_year)
+
+    # capacities given by an earlier sizing run, a semi-continuous capacity could otherwise still drop to zero
+    if fixed_caps is not None:
+        for cap_name, cap_value in fixed_caps.items():
+            cap_vars[cap_name].VType = GRB.CONTINUOUS
+            cap_vars[cap_name].LB = cap_value
+            cap_vars[cap_name].UB = cap_value
+    with timed_phase('model_update'):
+        m.update()
+
+    # bounds of the hourly variables from the input arrays
+    with timed_phase('presolve_inputs'):
+        presolve = presolve_inputs(inputs, T)
+    add_counter('solar_rows_dropped', T - len(presolve['solar_hours']))
+
+    # the hourly components, a component that is not enabled keeps its ts_vars as arrays of zeros. the PUE load of
+    # the fixed load model is zero, the flex model has it from its PUE groups
+    block = {'T': T, 'hour_weights': hour_weights, 'inputs': inputs, 'cap_vars': cap_vars,
+             'ts_vars': {'pue_load': np.zeros(T)}, 'ts_constrs': dict(), 'supply': [], 'demand': [],
+             'period_hours': T if period_hours is None else period_hours, 'initial_level': initial_level, 'day_map': day_map,
+             'presolve': presolve, 'total_pue_load': 0.}
+    components = []
+    with timed_phase('build_ts_vars'):
+        for name, enabled_by, add_vars, add_constrs, var_names in config['components']:
+            if enabled_by is None or getattr(args, enabled_by):
+                add_vars(m, args, name, block)
+                components.append((name, add_constrs))
+            else:
+                block['ts_vars'].update({var_name: np.zeros(T) for var_name in var_names})
+    add_counter('ts_components', len(components))
+    with timed_phase('model_update'):
+        m.update()
+
+    with timed_phase('build_ts_constraints'):
+        add_energy_balance(m, args, block)
+        for name, add_constrs in components:
+            if add_constrs is not None:
+                add_constrs(m, args, name, block)
+    with timed_phase('model_update'):
+        m.update()
+
+    # allowed supply deficit
+    supply_deficit = block['ts_vars']['supply_deficit']
+    total_fixed_load = hour_weights @ fixed_load
+    total_pue_load = block['total_pue_load']
+    if args.supply_deficit_sce:
+        deficit_constr = m.addConstr(hour_weights @ supply_deficit <= args.allowed_supply_deficit_frac *
+                                     (total_fixed_load + total_pue_load))
+    else:
+        deficit_constr = m.addConstr(hour_weights @ supply_deficit == 0)
+    with timed_phase('model_update'):
+        m.update()
+
+    # Set model solver parameters
+    m.setParam("FeasibilityTol", args.feasibility_tol)
+    m.setParam("OptimalityTol", args.optimality_tol)
+    m.setParam("Method", args.solver_method)
+    if args.solver_threads:
+        m.setParam("Threads", args.solver_threads)
+    m.setParam("TimeLimit", args.model_time_limit)
+    m.setParam("OutputFlag", 1)
+
+    # handles to the parts of the model that sweeps and re-solves edit in place
+    ts_constrs = block['ts_constrs']
+    handles = {'model_type': model_type, 'cap_vars': cap_vars, 'ts_vars': block['ts_vars'],
+               'deficit_constr': deficit_constr.item(), 'ts_constrs': ts_constrs,
+               'energy_balance': ts_constrs['energy_balance'],
+               'motor_constr': motor_constr, 'motor_limit_cap': motor_limit_cap,
+               'curtailable_load': inputs['curtailable_load'], 'fixed_load': fixed_load,
+               'total_fixed_load': total_fixed_load, 'total_pue_load': total_pue_load,
+               'solar_po_hourly': inputs['solar_po_hourly'], 'solar_hours': presolve['solar_hours'],
+               'num_year': num_year, 'T': T, 'hour_weights': hour_weights}
+    if model_type == 'flex':
+        handles['pue_daily_array'] = inputs['pue_daily_array']
+
+    return m, handles
@@ -0,0 +1,208 @@
+from fixed_load_model import build_fix_load_model
+from flex_pue_model import build_flex_pue_model
+from results_processing import results_retrieval, process_results
+from solver_backend import optimize, get_solve_info
+from utils import get_args, get_cap_cost
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import argparse
+import datetime
+import itertools
+import os
+
+# parameters that only change objective coefficients of the built model
+sweep_obj_params = ['i_rate', 'reserve_req',
+                    'solar_cost_kw', 'annualize_years_solar',
+                    'battery_la_cost_kwh', 'annualize_years_battery_la',
+                    'battery_li_cost_kwh', 'annualize_years_battery_li',
+                    'battery_inverter_cost_kw', 'annualize_years_battery_inverter',
+                    'diesel_cap_cost_kw', 'annualize_years_diesel', 'diesel_cost_liter', 'liter_per_kwh', 'diesel_eff',
+                    'deficit_penalty', 'curtailment_nominal', 'nominal_discharge_cost_kwh']
+# parameters that only change right-hand sides (and the matching coefficients) of the built model
+sweep_rhs_params = ['allowed_supply_deficit_frac']
+
+
+def get_sweep_points(sweep):
+    # full grid of all the listed values
+    names = list(sweep)
+    return [dict(zip(names, values)) for values in itertools.product(*[sweep[name] for name in names])]
+
+
+def update_cost_coefficients(m, args, handles):
+    cap_vars = handles['cap_vars']
+    ts_vars = handles['ts_vars']
+    solar_cap_cost, battery_la_cap_cost_kwh, battery_li_cap_cost_kwh, \
+        battery_inverter_cap_cost_kw, diesel_cap_cost_kw = get_cap_cost(args, handles['num_year'])
+    m.setAttr('Obj', [cap_vars['solar_cap'], cap_vars['diesel_cap'],
+                      cap_vars['batt_la_energy_cap'], cap_vars['batt_la_power_cap'],
+                      cap_vars['batt_li_energy_cap'], cap_vars['batt_li_power_cap']],
+              [solar_cap_cost, diesel_cap_cost_kw,
+               battery_la_cap_cost_kwh, battery_inverter_cap_cost_kw,
+               battery_li_cap_cost_kwh, battery_inverter_cap_cost_kw])
+
+    # the hourly costs are weighted by the hours of the model as in its builders (representative days, stacked
+    # scenario years). the ts_vars of a component the scenario does not build are arrays, see assemble_model
+    hour_weights = handles['hour_weights']
+    for var_name, cost in [('batt_la_discharge', args.nominal_discharge_cost_kwh),
+                           ('batt_li_discharge', args.nominal_discharge_cost_kwh),
+                           ('diesel_gen', args.diesel_cost_liter * args.liter_per_kwh / args.diesel_eff),
+                           ('supply_deficit', args.deficit_penalty)]:
+        if not isinstance(ts_vars[var_name], np.ndarray):
+            ts_vars[var_name].Obj = hour_weights * cost
+    m.ObjCon = float(np.sum(hour_weights * args.curtailment_nominal * ts_vars['curtailed_loads']))
+
+
+def update_deficit_rhs(m, args, handles):
+    # the total deficit constraint is only an equality to zero without the supply deficit scenario
+    if not args.supply_deficit_sce:
+        return
+    handles['deficit_constr'].RHS = args.allowed_supply_deficit_frac * (handles['total_fixed_load'] +
+                                                                        handles['total_pue_load'])
+
+
+def check_sweep_params(sweep):
+    structural = [k for k in sweep if k not in sweep_obj_params + sweep_rhs_params]
+    if structural:
+        raise ValueError(f'{structural} change the model structure and cannot be swept on one built model, '
+                         f'supported: {sweep_obj_params + sweep_rhs_params}')
+
+
+def run_sweep_points(args, mg_name, points):
+    # solve the numbered (point_no, point) sweep points in order on one built model, every point only edits
+    # coefficients and right-hand sides
+    if args.fixed_load_sce:
+        m, handles = build_fix_load_model(args, mg_name)
+    else:
+        m, handles = build_flex_pue_model(args, mg_name)
+    all_vars = m.getVars()
+    total_load = handles['total_fixed_load'] + handles['total_pue_load']
+
+    sweep_results = []
+    prev_point = None
+    for point_no, point in points:
+        point_args = argparse.Namespace(**vars(args))
+        for k, v in point.items():
+            setattr(point_args, k, v)
+        print(f'sweep point {point_no + 1}: {point}')
+
+        update_cost_coefficients(m, point_args, handles)
+        rhs_changed = prev_point is None or any(point[k] != prev_point[k] for k in point if k in sweep_rhs_params)
+        if rhs_changed:
+            update_deficit_rhs(m, point_args, handles)
+
+        # warm start from the previous point: LPs keep their basis, objective changes leave it primal feasible
+        # and right-hand side changes leave it dual feasible. MIPs get the previous solution as a start. The HiGHS
+        # backends solve every point from scratch.
+        if prev_point is not None and args.solver_backend == 'gurobi':
+            if m.IsMIP and m.SolCount > 0:
+                m.setAttr('Start', all_vars, m.getAttr('X', all_vars))
+            elif not m.IsMIP:
+                m.setParam('Method', 1 if rhs_changed else 0)
+        optimize(m, args)
+        # the simplex method of the warm start is only for this point
+        m.setParam('Method', args.solver_method)
+        solve_info = get_solve_info(m)
+
+        point_results = {'point_no': point_no, **point, 'status': solve_info['status'],
+                         'solve_time_s': solve_info['runtime'], 'iterations': solve_info['iterations']}
+        if solve_info['sol_count'] > 0:
+            caps_results, ts_results = results_retrieval(m, handles['cap_vars'], handles['ts_vars'])
+            ts_results['fixed_load_kw'] = handles['fixed_load']
+            processed_results = process_results(point_args, caps_results, ts_results)
+            point_results['objective'] = solve_info['obj']
+            point_results['unserved_kwh'] = np.sum(ts_results.supply_deficit_kw)
+            point_results['unserved_frac'] = point_results['unserved_kwh'] / total_load
+            point_results.update(processed_results.iloc[0].to_dict())
+        sweep_results.append(point_results)
+        prev_point = point
+    m.dispose()
+    return sweep_results
+
+
+def run_sweep(args, mg_name, sweep=None):
+    sweep = sweep or args.sweep
+    check_sweep_params(sweep)
+    # without the supply deficit scenario the deficit is fixed to zero, see update_deficit_rhs
+    if 'allowed_supply_deficit_frac' in sweep and not args.supply_deficit_sce:
+        raise ValueError('allowed_supply_deficit_frac is only swept with supply_deficit_sce, or use run_frontier')
+    sweep_points = get_sweep_points(sweep)
+
+    # build the model once, every sweep point only edits coefficients and right-hand sides
+    sweep_results = pd.DataFrame(run_sweep_points(args, mg_name, list(enumerate(sweep_points))))
+    if not os.path.exists(os.path.join(args.results_dir, mg_name)):
+        os.makedirs(os.path.join(args.results_dir, mg_name))
+    sweep_results.round(decimals=6).to_csv(os.path.join(args.results_dir, mg_name, 'sweep_results.csv'), index=False)
+    return sweep_results
+
+
+def get_pareto_flags(frontier_results, group_cols):
+    # points not dominated by another point of their group (the same values of the other swept parameters) with
+    # both a lower or equal LCOE and a lower or equal unserved fraction, and better in one of them
+    pareto = pd.Series(False, index=frontier_results.index)
+    solved = frontier_results.dropna(subset=['LCOE', 'unserved_frac'])
+    for _, group in (solved.groupby(group_cols) if group_cols else [(None, solved)]):
+        lcoe = group.LCOE.values
+        unserved = group.unserved_frac.values
+        dominated = np.any((lcoe[None, :] <= lcoe[:, None]) & (unserved[None, :] <= unserved[:, None]) &
+                           ((lcoe[None, :] < lcoe[:, None]) | (unserved[None, :] < unserved[:, None])), axis=1)
+        pareto[group.index] = ~dominated
+    return pareto
+
+
+def run_frontier(args, mg_name, frontier=None, num_workers=None):
+    # LCOE versus reliability frontier over the grid of frontier: allowed_supply_deficit_frac and optionally cost
+    # parameters such as curtailment_nominal. The points are split into contiguous chunks, one per worker process,
+    # and every worker solves its chunk on one model of the site, warm-starting each point from its neighbour. The
+    # deficit fraction varies fastest, so that neighbouring points only differ in the deficit right-hand side.
+    frontier = dict(frontier or args.frontier)
+    if 'allowed_supply_deficit_frac' not in frontier:
+        raise ValueError('the frontier needs a list of allowed_supply_deficit_frac values')
+    check_sweep_params(frontier)
+    frontier['allowed_supply_deficit_frac'] = sorted(frontier.pop('allowed_supply_deficit_frac'))
+    points = list(enumerate(get_sweep_points(frontier)))
+    num_workers = max(1, min(num_workers or args.num_workers, len(points)))
+
+    # the deficit limit is an inequality whatever the scenario flag, its right-hand side is set per point
+    frontier_args = argparse.Namespace(**vars(args))
+    frontier_args.supply_deficit_sce = True
+    chunks = [[points[i] for i in chunk] for chunk in np.array_split(np.arange(len(points)), num_workers)]
+    if num_workers == 1:
+        frontier_results = run_sweep_points(frontier_args, mg_name, points)
+    else:
+        # cap the solver threads of each worker so that the workers together do not oversubscribe the cores
+        worker_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        if args.solver_threads:
+            worker_threads = min(worker_threads, args.solver_threads)
+        frontier_args.solver_threads = worker_threads
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            futures = [pool.submit(run_sweep_points, frontier_args, mg_name, chunk) for chunk in chunks]
+            frontier_results = [point_results for future in futures for point_results in future.result()]
+
+    frontier_results = pd.DataFrame(frontier_results).sort_values('point_no').reset_index(drop=True)
+    frontier_results.insert(1, 'chunk', np.concatenate([np.full(len(chunk), i) for i, chunk in enumerate(chunks)]))
+    frontier_results['pareto'] = get_pareto_flags(frontier_results, [k for k in frontier
+                                                                     if k != 'allowed_supply_deficit_frac'])
+    if not os.path.exists(os.path.join(args.results_dir, mg_name)):
+        os.makedirs(os.path.join(args.results_dir, mg_name))
+    frontier_results.round(decimals=6).to_csv(os.path.join(args.results_dir, mg_name, 'frontier.csv'), index=False)
+    return frontier_results
+
+
+if __name__ == '__main__':
+
+    running_start_time = datetime.datetime.now()
+
+    args = get_args()
+    mg_list = ['agoro']
+
+    for mg_name in mg_list:
+        print(mg_name, 'name of mini-grid')
+        if args.sweep or not args.frontier:
+            run_sweep(args, mg_name)
+        if args.frontier:
+            print(run_frontier(args, mg_name)[['allowed_supply_deficit_frac', 'LCOE', 'unserved_frac', 'pareto']])
+
+    # showing the time used
+    running_end_time = datetime.datetime.now()
+    print(running_end_time - running_start_time)
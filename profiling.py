@@ -0,0 +1,245 @@
+from gurobipy import *
+from utils import get_args
+import numpy as np
+import pandas as pd
+import contextlib
+import datetime
+import resource
+import json
+import glob
+import time
+import os
+
+# phase timers, counters and model statistics of the current run (one site and scenario), written as one JSON record
+# per run to profile_dir/runs. None while no run is profiled, the timers then only cost a perf_counter call.
+_profile = None
+
+# progress hook of this process, called with a dict per event: the phase a run enters and, at most every
+# progress_interval_s, the progress of the Gurobi solve. Set by the solve service in its worker processes, None: off
+_progress_hook = None
+progress_interval_s = 1.
+
+
+def start_profile(args, mg_name, result_key=None):
+    global _profile
+    _profile = None
+    reset_peak_rss()
+    if args.profile_dir:
+        _profile = {'mg_name': mg_name, 'scenario': args.scenario_name, 'result_key': result_key,
+                    'model_type': 'fixed' if args.fixed_load_sce else 'flex', 'solver_backend': args.solver_backend,
+                    'started': datetime.datetime.now().isoformat(timespec='seconds'),
+                    'start_time': time.perf_counter(), 'phases': dict(), 'counters': dict(), 'models': []}
+
+
+def is_profiling():
+    return _profile is not None
+
+
+@contextlib.contextmanager
+def timed_phase(phase_name):
+    # wall time of the block, added to the phase so that repeated phases (model updates, windows) are summed. phases
+    # can nest, build_model includes the build_* and model_update phases of the builder
+    start_time = time.perf_counter()
+    report_progress({'event': 'phase', 'phase': phase_name})
+    try:
+        yield
+    finally:
+        if _profile is not None:
+            phases = _profile['phases']
+            phases[phase_name] = phases.get(phase_name, 0.) + time.perf_counter() - start_time
+
+
+def add_phase_time(phase_name, seconds):
+    # time measured outside the run, e.g. the shared site model built before the first scenario
+    if _profile is not None and seconds:
+        _profile['phases'][phase_name] = _profile['phases'].get(phase_name, 0.) + seconds
+
+
+def add_counter(counter_name, value=1):
+    if _profile is not None:
+        _profile['counters'][counter_name] = _profile['counters'].get(counter_name, 0) + value
+
+
+def presolve_callback(m, where):
+    # Gurobi callback: the runtime at the first simplex, barrier or MIP callback is the time spent in presolve
+    if where in [GRB.Callback.SIMPLEX, GRB.Callback.BARRIER, GRB.Callback.MIP] and m._presolve_time is None:
+        m._presolve_time = m.cbGet(GRB.Callback.RUNTIME)
+
+
+def set_progress_hook(hook):
+    global _progress_hook
+    _progress_hook = hook
+
+
+def has_progress_hook():
+    return _progress_hook is not None
+
+
+def report_progress(event):
+    if _progress_hook is not None:
+        _progress_hook(event)
+
+
+def progress_callback(m, where):
+    # Gurobi callback: the presolve time as presolve_callback, and the objective, bound and gap of a MIP or the
+    # objective and infeasibility of the simplex and barrier iterations, reported to the progress hook
+    presolve_callback(m, where)
+    if where not in [GRB.Callback.SIMPLEX, GRB.Callback.BARRIER, GRB.Callback.MIP]:
+        return
+    runtime = m.cbGet(GRB.Callback.RUNTIME)
+    if getattr(m, '_progress_time', None) is not None and runtime - m._progress_time < progress_interval_s:
+        return
+    m._progress_time = runtime
+    event = {'event': 'solver', 'model_name': m.ModelName, 'runtime_s': runtime}
+    if where == GRB.Callback.MIP:
+        obj_best = m.cbGet(GRB.Callback.MIP_OBJBST)
+        obj_bound = m.cbGet(GRB.Callback.MIP_OBJBND)
+        gap = abs(obj_best - obj_bound) / abs(obj_best) if abs(obj_best) < GRB.INFINITY and obj_best != 0 else None
+        event.update({'method': 'mip', 'obj': obj_best if abs(obj_best) < GRB.INFINITY else None,
+                      'bound': obj_bound, 'gap': gap, 'nodes': m.cbGet(GRB.Callback.MIP_NODCNT)})
+    elif where == GRB.Callback.SIMPLEX:
+        event.update({'method': 'simplex', 'obj': m.cbGet(GRB.Callback.SPX_OBJVAL),
+                      'primal_inf': m.cbGet(GRB.Callback.SPX_PRIMINF),
+                      'iterations': m.cbGet(GRB.Callback.SPX_ITRCNT)})
+    else:
+        event.update({'method': 'barrier', 'obj': m.cbGet(GRB.Callback.BARRIER_PRIMOBJ),
+                      'bound': m.cbGet(GRB.Callback.BARRIER_DUALOBJ),
+                      'iterations': m.cbGet(GRB.Callback.BARRIER_ITRCNT)})
+    report_progress(event)
+
+
+def record_model(m, args, solve_info):
+    # size of a solved model and its solve statistics, one entry per solve of the run. HiGHS does not report its
+    # presolve time
+    if _profile is None:
+        return
+    presolve_time = getattr(m, '_presolve_time', None)
+    if presolve_time is None and args.solver_backend == 'gurobi':
+        # solved in presolve, no simplex, barrier or MIP callback was reached
+        presolve_time = solve_info['runtime']
+    _profile['models'].append({'model_name': m.ModelName, 'num_vars': m.NumVars, 'num_constrs': m.NumConstrs,
+                               'num_nzs': m.NumNZs, 'num_bin_vars': m.NumBinVars, 'num_int_vars': m.NumIntVars,
+                               'status': solve_info['status'], 'obj': solve_info['obj'],
+                               'solve_runtime_s': solve_info['runtime'], 'presolve_time_s': presolve_time,
+                               'iterations': solve_info['iterations'], 'nodes': solve_info['nodes']})
+
+
+def read_proc_status_mb(field):
+    # a memory field of /proc/self/status in MB, None where there is no /proc (values are in kB)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def reset_peak_rss():
+    # start the peak resident set size of this process over from its current size, so that a worker process that
+    # runs several jobs reports the peak of each job. Linux only, elsewhere the peak is that of the process
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def get_rss_mb():
+    # current resident set size of this process
+    rss_mb = read_proc_status_mb('VmRSS')
+    return get_peak_rss_mb() if rss_mb is None else rss_mb
+
+
+def get_peak_rss_mb():
+    # peak resident set size of this process since reset_peak_rss (ru_maxrss is in kB on Linux)
+    peak_mb = read_proc_status_mb('VmHWM')
+    if peak_mb is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return peak_mb
+
+
+def write_profile(args, status='done'):
+    # write the record of the current run and stop profiling
+    global _profile
+    if _profile is None:
+        return None
+    profile = _profile
+    _profile = None
+    profile['status'] = status
+    profile['total_s'] = time.perf_counter() - profile.pop('start_time')
+    profile['peak_rss_mb'] = get_peak_rss_mb()
+    runs_dir = os.path.join(args.profile_dir, 'runs')
+    os.makedirs(runs_dir, exist_ok=True)
+    run_id = f"{profile['started'].replace(':', '')}_{os.getpid()}"
+    with open(os.path.join(runs_dir, f"{profile['mg_name']}__{profile['scenario']}__{run_id}.json"), 'w') as f:
+        json.dump(profile, f, indent=1, default=float)
+    return profile
+
+
+def read_profiles(args):
+    # one row per profiled run: phase times, counters, totals of its models and the size of its largest model
+    rows = []
+    for path in sorted(glob.glob(os.path.join(args.profile_dir, 'runs', '*.json'))):
+        with open(path) as f:
+            profile = json.load(f)
+        row = {k: profile[k] for k in ['mg_name', 'scenario', 'model_type', 'solver_backend', 'started', 'status',
+                                       'total_s', 'peak_rss_mb']}
+        row.update({f'{phase_name}_s': value for phase_name, value in profile['phases'].items()})
+        row.update(profile['counters'])
+        models = pd.DataFrame(profile['models'])
+        row['num_models'] = len(models)
+        if len(models):
+            for col_name in ['num_vars', 'num_constrs', 'num_nzs', 'num_bin_vars', 'num_int_vars']:
+                row[col_name] = models[col_name].max()
+            for col_name in ['solve_runtime_s', 'presolve_time_s', 'iterations', 'nodes']:
+                row[col_name] = models[col_name].sum(min_count=1)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def profile_report(args):
+    # aggregate the run records of profile_dir: per site, scenario, model type and backend the last run against the
+    # median of the earlier runs. metrics that grew by more than profile_regression_tol are flagged as regressions.
+    runs = read_profiles(args)
+    if runs.empty:
+        return runs
+    runs.to_csv(os.path.join(args.profile_dir, 'profile_runs.csv'), index=False)
+    group_cols = ['mg_name', 'scenario', 'model_type', 'solver_backend']
+    metric_cols = [c for c in runs.columns if c not in group_cols + ['started', 'status'] and
+                   pd.api.types.is_numeric_dtype(runs[c])]
+    report = []
+    for group_key, group_runs in runs[runs.status == 'done'].sort_values('started').groupby(group_cols):
+        for metric in metric_cols:
+            values = group_runs[metric].dropna()
+            if values.empty:
+                continue
+            report.append({**dict(zip(group_cols, group_key)), 'metric': metric, 'runs': len(values),
+                           'last': values.iloc[-1], 'median': values.median(), 'min': values.min(),
+                           'max': values.max(),
+                           'median_prev': values.iloc[:-1].median() if len(values) > 1 else np.nan})
+    report = pd.DataFrame(report)
+    if report.empty:
+        return report
+    with np.errstate(divide='ignore', invalid='ignore'):
+        report['ratio_prev'] = report['last'] / report['median_prev']
+    report['regression'] = report.ratio_prev > 1 + args.profile_regression_tol
+    report.round(decimals=6).to_csv(os.path.join(args.profile_dir, 'profile_report.csv'), index=False)
+    return report
+
+
+if __name__ == '__main__':
+
+    running_start_time = datetime.datetime.now()
+
+    args = get_args()
+    report = profile_report(args)
+    if report.empty:
+        print(f'no profiled runs in {args.profile_dir}')
+    else:
+        print(report[report.regression] if report.regression.any() else 'no regressions')
+
+    # showing the time used
+    running_end_time = datetime.datetime.now()
+    print(running_end_time - running_start_time)
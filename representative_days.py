@@ -0,0 +1,84 @@
+import numpy as np
+
+
+def get_day_features(inputs):
+    # one row per calendar day with the hourly profiles of the fixed load, the curtailable load and the solar
+    # potential, each scaled by its peak so that the profiles weigh the same in the clustering
+    num_days = len(inputs['fixed_load']) // 24
+    profiles = [inputs['fixed_load'], inputs['solar_po_hourly']]
+    if inputs['curtailable_load'] is not None:
+        profiles.append(inputs['curtailable_load'])
+    features = []
+    for profile in profiles:
+        profile = np.asarray(profile[:num_days * 24], dtype=float).reshape(num_days, 24)
+        features.append(profile / max(np.max(np.abs(profile)), 1e-6))
+    return np.hstack(features)
+
+
+def cluster_days(features, num_clusters, seed=0, max_iter=100):
+    # k-means with k-means++ seeding, returns the cluster of each day and the medoid day of each cluster
+    rng = np.random.default_rng(seed)
+    num_days = features.shape[0]
+    num_clusters = min(num_clusters, num_days)
+    centers = [features[rng.integers(num_days)]]
+    for _ in range(1, num_clusters):
+        dist = np.min(((features[:, None, :] - np.array(centers)[None, :, :]) ** 2).sum(axis=2), axis=1)
+        if dist.sum() == 0:
+            break
+        centers.append(features[rng.choice(num_days, p=dist / dist.sum())])
+    centers = np.array(centers)
+
+    labels = None
+    for _ in range(max_iter):
+        dist = ((features[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        new_labels = np.argmin(dist, axis=1)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        for k in range(len(centers)):
+            if np.any(labels == k):
+                centers[k] = features[labels == k].mean(axis=0)
+
+    # drop empty clusters and pick the day closest to each center
+    clusters = np.unique(labels)
+    labels = np.searchsorted(clusters, labels)
+    centers = centers[clusters]
+    dist = ((features - centers[labels]) ** 2).sum(axis=1)
+    medoids = np.array([np.flatnonzero(labels == k)[np.argmin(dist[labels == k])] for k in range(len(clusters))])
+    return labels, medoids
+
+
+def get_rep_days(args, inputs):
+    # representative days of the horizon: the medoid days of the clusters, plus the day with the highest fixed load
+    # as a cluster of its own so that the sizing sees the peak. day_map gives the representative of each calendar
+    # day and day_weights the number of calendar days each representative stands for.
+    features = get_day_features(inputs)
+    day_map, rep_days = cluster_days(features, args.rep_days_num)
+    rep_days = list(rep_days)
+    if args.rep_days_add_peak:
+        num_days = features.shape[0]
+        peak_day = int(np.argmax(np.max(np.asarray(inputs['fixed_load'][:num_days * 24]).reshape(num_days, 24),
+                                        axis=1)))
+        if peak_day not in rep_days:
+            day_map[peak_day] = len(rep_days)
+            rep_days.append(peak_day)
+    rep_days = np.array(rep_days)
+    day_weights = np.bincount(day_map, minlength=len(rep_days))
+    return rep_days, day_map, day_weights
+
+
+def get_rep_day_inputs(inputs, rep_days):
+    # inputs restricted to the representative days, one after the other
+    hours = (rep_days[:, None] * 24 + np.arange(24)).ravel()
+    return {name: None if value is None else value[hours] for name, value in inputs.items()}
+
+
+def expand_rep_days(ts_results, day_map, day_start_levels=None):
+    # hourly results of the representative days mapped back onto the calendar days. the battery levels of the
+    # representative days are relative to the start of the day, day_start_levels makes them absolute.
+    hours = (day_map[:, None] * 24 + np.arange(24)).ravel()
+    ts_results = ts_results.iloc[hours].reset_index(drop=True)
+    if day_start_levels is not None:
+        for batt, day_start_level in day_start_levels.items():
+            ts_results[f'{batt}_level_kwh'] += np.repeat(day_start_level, 24)
+    return ts_results
@@ -0,0 +1,147 @@
+from results_store import get_ts_partition, write_summary, read_summary, summary_id_columns
+from utils import get_solar_file
+import numpy as np
+import pandas as pd
+import hashlib
+import json
+import os
+import shutil
+import time
+
+# parameters that do not change the results of a site, they are left out of the result key
+result_key_ignored_params = ['params_filename', 'results_dir', 'scenario_name', 'results_store_dir', 'cache_dir',
+                             'input_store_dir', 'result_cache_dir', 'result_cache_max_mb', 'num_workers',
+                             'solver_threads', 'scenarios', 'sweep', 'profile_dir', 'profile_regression_tol',
+                             'batch_post_processing', 'benchmark_dir', 'benchmark', 'stochastic_workers',
+                             'frontier', 'memory_budget_mb', 'service_host', 'service_port', 'service_workers']
+
+# content hashes of this process, keyed by (file path, mtime, size)
+_file_hash_memo = dict()
+
+
+def hash_file(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in _file_hash_memo:
+        file_hash = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                file_hash.update(block)
+        _file_hash_memo[key] = file_hash.hexdigest()
+    return _file_hash_memo[key]
+
+
+def get_input_files(args, mg_name):
+    # every input file the models can read for the site, of every scenario year in the stochastic solve mode
+    input_args = [args]
+    if (args.fixed_solve_mode if args.fixed_load_sce else args.flex_solve_mode) == 'stochastic':
+        from stochastic_sizing import get_year_args
+        input_args = list(get_year_args(args)[0].values())
+    input_files = []
+    for a in input_args:
+        input_files += [f'{a.data_dir}/{a.fixed_load_dir}/{mg_name}_fixed_loads.csv',
+                        f'{a.data_dir}/{a.curtailment_dir}/{mg_name}_curtailable_loads.csv',
+                        f'{a.data_dir}/{a.motor_cap_dir}',
+                        f'{a.data_dir}/{a.system_capacity}',
+                        f'{a.data_dir}/{get_solar_file(a, a.solar_region)}']
+        pue_dir = f'{a.data_dir}/{a.flex_pue_dir}/{mg_name}'
+        if os.path.isdir(pue_dir):
+            input_files += [f'{pue_dir}/{name}' for name in sorted(os.listdir(pue_dir))]
+    return [path for path in dict.fromkeys(input_files) if os.path.isfile(path)]
+
+
+def get_result_key(args, mg_name):
+    # hash of the effective parameters, the site, the contents of its input files and the model code, so that any
+    # change to what the results depend on gives a new key
+    params = {k: v for k, v in sorted(vars(args).items()) if k not in result_key_ignored_params}
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    code_files = sorted(name for name in os.listdir(code_dir) if name.endswith('.py'))
+    key_data = {'params': params, 'mg_name': mg_name,
+                'inputs': {os.path.relpath(path, args.data_dir): hash_file(path)
+                           for path in get_input_files(args, mg_name)},
+                'code': {name: hash_file(os.path.join(code_dir, name)) for name in code_files}}
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_entry_dir(args, result_key):
+    return os.path.join(args.result_cache_dir, result_key[:2], result_key)
+
+
+def load_cached_results(args, mg_name, result_key):
+    # copy the cached results of the key into results_dir/mg_name, False if the key is not cached
+    entry_dir = get_entry_dir(args, result_key)
+    meta_file = os.path.join(entry_dir, 'meta.json')
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file) as f:
+        meta = json.load(f)
+    site_dir = os.path.join(args.results_dir, mg_name)
+    os.makedirs(site_dir, exist_ok=True)
+    try:
+        for name in meta['files']:
+            shutil.copyfile(os.path.join(entry_dir, name), os.path.join(site_dir, name))
+        # results of the results store, filed under the site and scenario of this job
+        if meta.get('store') and args.results_store_dir:
+            ts_path = get_ts_partition(args, mg_name)
+            os.makedirs(os.path.dirname(ts_path), exist_ok=True)
+            shutil.copyfile(os.path.join(entry_dir, 'store_ts_results.parquet'), ts_path)
+            write_summary(args, mg_name, pd.read_parquet(os.path.join(entry_dir, 'store_processed_results.parquet')))
+    except FileNotFoundError:
+        # evicted by another process while copying
+        return False
+    # the modification time of meta.json orders the entries for eviction
+    os.utime(meta_file)
+    return True
+
+
+def store_results(args, mg_name, result_key, since):
+    # cache the files the job wrote to results_dir/mg_name since the given time. the entry is written to a
+    # temporary directory first, parallel workers may be storing the same key
+    site_dir = os.path.join(args.results_dir, mg_name)
+    files = [name for name in sorted(os.listdir(site_dir)) if os.path.isfile(os.path.join(site_dir, name)) and
+             os.path.getmtime(os.path.join(site_dir, name)) >= since]
+    entry_dir = get_entry_dir(args, result_key)
+    tmp_dir = f'{entry_dir}.{os.getpid()}.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+    for name in files:
+        shutil.copyfile(os.path.join(site_dir, name), os.path.join(tmp_dir, name))
+    store = bool(args.results_store_dir)
+    if store:
+        shutil.copyfile(get_ts_partition(args, mg_name), os.path.join(tmp_dir, 'store_ts_results.parquet'))
+        summary = read_summary(args, 'SELECT * FROM processed_results WHERE mg_name = ? AND scenario = ?',
+                               (mg_name, args.scenario_name))
+        summary.drop(columns=summary_id_columns).to_parquet(os.path.join(tmp_dir, 'store_processed_results.parquet'))
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'mg_name': mg_name, 'files': files, 'store': store, 'created': time.time()}, f)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # already stored by another worker
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    evict_results(args)
+
+
+def evict_results(args):
+    # drop the least recently used entries until the cache fits in result_cache_max_mb
+    if not args.result_cache_max_mb or not os.path.isdir(args.result_cache_dir):
+        return
+    entries = []
+    for prefix in os.listdir(args.result_cache_dir):
+        prefix_dir = os.path.join(args.result_cache_dir, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+        for result_key in os.listdir(prefix_dir):
+            entry_dir = os.path.join(prefix_dir, result_key)
+            meta_file = os.path.join(entry_dir, 'meta.json')
+            if result_key.endswith('.tmp') or not os.path.exists(meta_file):
+                continue
+            entry_size = sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(meta_file), entry_size, entry_dir))
+    entries.sort()
+    cache_size = np.sum([entry[1] for entry in entries])
+    max_size = args.result_cache_max_mb * 1024 ** 2
+    for _, entry_size, entry_dir in entries:
+        if cache_size <= max_size:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        cache_size -= entry_size
@@ -1,25 +1,31 @@
 import numpy as np
 import pandas as pd
 from utils import load_timeseries, get_cap_cost
+from solver_backend import get_values
 import datetime
 
 
-def results_retrieval(m, T_hours):
+def get_ts_dtype(args):
+    # float32 hourly results with low_memory, the results store keeps them as float32 in any case
+    return np.float32 if args.low_memory else np.float64
 
-    node_df = pd.DataFrame()
-    node_df['solar_cap_kw'] = [m.getVarByName('solar_cap').X]
-    node_df['diesel_cap_kw'] = [m.getVarByName('diesel_cap').X]
-    node_df['batt_la_energy_cap_kwh'] = [m.getVarByName('batt_la_energy_cap').X]
-    node_df['batt_la_power_cap_kw'] = [m.getVarByName('batt_la_power_cap').X]
-    node_df['batt_li_energy_cap_kwh'] = [m.getVarByName('batt_li_energy_cap').X]
-    node_df['batt_li_power_cap_kw'] = [m.getVarByName('batt_li_power_cap').X]
 
-    # get the ts data
+def results_retrieval(m, cap_vars, ts_vars, dtype=np.float64):
+
+    # get the capacities with a single attribute query
+    cap_names = ['solar_cap', 'diesel_cap', 'batt_la_energy_cap', 'batt_la_power_cap',
+                 'batt_li_energy_cap', 'batt_li_power_cap']
+    cap_col_names = ['solar_cap_kw', 'diesel_cap_kw', 'batt_la_energy_cap_kwh', 'batt_la_power_cap_kw',
+                     'batt_li_energy_cap_kwh', 'batt_li_power_cap_kw']
+    cap_values = get_values(m, [cap_vars[name] for name in cap_names])
+    node_df = pd.DataFrame([cap_values], columns=cap_col_names, dtype=np.float64)
+
+    # get the ts data, one array per matrix variable
     variable_names = [
-        'solar_util[{}]', 'diesel_gen[{}]', 'batt_la_level[{}]',
-        'batt_la_charge[{}]', 'batt_la_discharge[{}]', 'batt_li_level[{}]',
-        'batt_li_charge[{}]', 'batt_li_discharge[{}]', 'pue_load[{}]',
-        'supply_deficit[{}]', 'curtailed_loads[{}]'
+        'solar_util', 'diesel_gen', 'batt_la_level',
+        'batt_la_charge', 'batt_la_discharge', 'batt_li_level',
+        'batt_li_charge', 'batt_li_discharge', 'pue_load',
+        'supply_deficit', 'curtailed_loads'
     ]
     ts_col_names = [
         'solar_util_kw', 'diesel_util_kw',
@@ -27,11 +33,15 @@ def results_retrieval(m, T_hours):
         'batt_li_level_kwh', 'batt_li_charge_kw', 'batt_li_discharge_kw',
         'commercial_load_kw', 'supply_deficit_kw', 'curtailed_load_kw'
     ]
-    num_vars = len(variable_names)
-    system_ts_df = pd.DataFrame(index=range(T_hours), columns=ts_col_names)
-    for j in range(T_hours):
-        for var_name, col_name in zip(variable_names, ts_col_names):
-            system_ts_df.at[j, col_name] = m.getVarByName(var_name.format(j)).X
+    # the PUE load of the flexible PUE model is the sum of its PUE groups, see add_pue_vars
+    if 'pue_group_load' in ts_vars:
+        ts_vars = dict(ts_vars, pue_load=ts_vars['pue_group_hours'] @ get_values(m, ts_vars['pue_group_load']).ravel() +
+                       ts_vars['pue_flat_load'])
+
+    # variables fixed by the scenario are kept as arrays of their values instead of model variables
+    system_ts_df = pd.DataFrame({col_name: np.asarray(ts_vars[var_name] if isinstance(ts_vars[var_name], np.ndarray)
+                                                      else get_values(m, ts_vars[var_name]), dtype=dtype)
+                                 for var_name, col_name in zip(variable_names, ts_col_names)})
 
     return node_df, system_ts_df
 
@@ -96,4 +106,80 @@ def process_results(args, caps_results, ts_results):
     data_for_export['generation_cost'] = [total_gen_cost]
     data_for_export['LCOE'] = [total_gen_cost / (T*avg_total_demand)]
 
-    return data_for_export
\ No newline at end of file
+    return data_for_export
+
+def get_hour_months(T):
+    # calendar month of each model hour, the hourly series start on March 1st (see get_solar_ts)
+    return pd.date_range('2019-03-01', periods=T, freq='h').month.values
+
+
+def process_results_batch(args_list, caps_block, ts_block, ts_col_names, percentiles=(50, 90, 95, 99, 100)):
+    # the metrics of process_results for N scenarios at once: args_list has the args of each scenario, caps_block
+    # the (N, 6) capacities in the column order of results_retrieval and ts_block the (N, T, k) hourly results with
+    # the columns ts_col_names. Also returns the monthly, hour-of-day and percentile breakdowns of the supply
+    # deficit and the curtailed load.
+    ts = {col_name: ts_block[:, :, i] for i, col_name in enumerate(ts_col_names)}
+    solar_cap, diesel_cap, battery_la_energy_cap, battery_la_power_cap, battery_li_energy_cap, \
+        battery_li_power_cap = caps_block.T
+    T = np.array([args.num_hour_fixed_load for args in args_list])
+
+    # Calculate demand, generation, solar uncurtailed / actual CF
+    total_demand = ts['commercial_load_kw'] + ts['fixed_load_kw'] - ts['supply_deficit_kw'] - ts['curtailed_load_kw']
+    avg_total_demand = np.mean(total_demand, axis=1)
+    peak_total_demand = np.max(total_demand, axis=1)
+    avg_solar_gen = np.mean(ts['solar_util_kw'], axis=1)
+    avg_diesel_gen = np.mean(ts['diesel_util_kw'], axis=1)
+    avg_total_gen = avg_solar_gen + avg_diesel_gen
+    # the uncurtailed CF of each solar series, read with the args of a scenario that uses it, scenarios can have
+    # their own data directory and weather year
+    solar_keys = [(args.data_dir, args.solar_region, args.solar_year) for args in args_list]
+    solar_unc_cf = dict()
+    for solar_key, args in zip(solar_keys, args_list):
+        if solar_key not in solar_unc_cf:
+            solar_unc_cf[solar_key] = np.mean(load_timeseries(args, args.solar_region))
+    solar_uncurtailed_cf = np.array([solar_unc_cf[solar_key] for solar_key in solar_keys])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        solar_actual_cf = avg_solar_gen / solar_cap
+
+    # total capital cost and operation cost, with the cost parameters of each scenario
+    cap_costs = np.array([get_cap_cost(args, args.num_year_fixed_load) for args in args_list])
+    solar_cap_cost, battery_la_cap_cost_kwh, battery_li_cap_cost_kwh, \
+        battery_inverter_cap_cost_kw, diesel_cap_cost_kw = cap_costs.T
+    diesel_kwh_fuel_cost = np.array([args.diesel_cost_liter * args.liter_per_kwh / args.diesel_eff
+                                     for args in args_list])
+    total_solar_cost = solar_cap * solar_cap_cost
+    total_diesel_cost = diesel_cap * diesel_cap_cost_kw
+    total_battery_la_cost = battery_la_energy_cap * battery_la_cap_cost_kwh + \
+        battery_la_power_cap * battery_inverter_cap_cost_kw
+    total_battery_li_cost = battery_li_energy_cap * battery_li_cap_cost_kwh + \
+        battery_li_power_cap * battery_inverter_cap_cost_kw
+    total_diesel_fuel_cost = avg_diesel_gen * T * diesel_kwh_fuel_cost
+    total_gen_cost = total_solar_cost + total_battery_la_cost + total_battery_li_cost + \
+        total_diesel_cost + total_diesel_fuel_cost
+
+    data_for_export = pd.DataFrame({
+        'solar_cap_kw': solar_cap, 'diesel_cap_kw': diesel_cap,
+        'battery_la_energy_cap_kwh': battery_la_energy_cap, 'battery_la_power_cap_kw': battery_la_power_cap,
+        'battery_li_energy_cap_kwh': battery_li_energy_cap, 'battery_li_power_cap_kw': battery_li_power_cap,
+        'peak_load_kw': peak_total_demand, 'avg_load_kw': avg_total_demand, 'avg_gen_kw': avg_total_gen,
+        'avg_solar_gen_kw': avg_solar_gen, 'avg_diesel_gen_kw': avg_diesel_gen,
+        'solar_unc_cf': solar_uncurtailed_cf, 'solar_act_cf': solar_actual_cf,
+        'solar_cost': total_solar_cost, 'diesel_cost': total_diesel_cost + total_diesel_fuel_cost,
+        'diesel_cap_cost': total_diesel_cost, 'diesel_fuel_cost': total_diesel_fuel_cost,
+        'battery_la_cost': total_battery_la_cost, 'battery_li_cost': total_battery_li_cost,
+        'generation_cost': total_gen_cost, 'LCOE': total_gen_cost / (T * avg_total_demand)})
+
+    # breakdowns of the supply deficit and the curtailed load: kWh per month, mean kW per hour of the day and
+    # percentiles of the hourly kW
+    num_hours = ts_block.shape[1]
+    month_onehot = (get_hour_months(num_hours)[:, None] == np.arange(1, 13)).astype(float)
+    hour_of_day_onehot = (np.arange(num_hours)[:, None] % 24 == np.arange(24)).astype(float)
+    hour_of_day_onehot /= hour_of_day_onehot.sum(axis=0)
+    breakdowns = dict()
+    for name, col_name in [('deficit', 'supply_deficit_kw'), ('curtailment', 'curtailed_load_kw')]:
+        breakdowns[f'{name}_monthly_kwh'] = pd.DataFrame(ts[col_name] @ month_onehot, columns=np.arange(1, 13))
+        breakdowns[f'{name}_hour_of_day_kw'] = pd.DataFrame(ts[col_name] @ hour_of_day_onehot, columns=np.arange(24))
+        breakdowns[f'{name}_percentiles_kw'] = pd.DataFrame(np.percentile(ts[col_name], percentiles, axis=1).T,
+                                                            columns=[f'p{p}' for p in percentiles])
+
+    return data_for_export, breakdowns
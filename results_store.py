@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+import datetime
+import sqlite3
+import os
+
+# results of all sites and scenarios in results_store_dir: the hourly results as one Parquet dataset partitioned by
+# site and scenario (ts_results/mg_name=<site>/scenario=<scenario>/part-0.parquet) and the processed results as
+# the processed_results table of results.sqlite, one row per site and scenario. The dataset needs pyarrow, the
+# table only sqlite3 of the standard library.
+
+
+def get_ts_partition(args, mg_name, scenario_name=None):
+    scenario_name = scenario_name or args.scenario_name
+    return os.path.join(args.results_store_dir, 'ts_results', f'mg_name={mg_name}', f'scenario={scenario_name}',
+                        'part-0.parquet')
+
+
+def get_summary_db(args):
+    return os.path.join(args.results_store_dir, 'results.sqlite')
+
+
+def write_ts_results(args, mg_name, ts_results):
+    # float32 keeps the precision of the rounded CSV output at half the size of float64. the partition is written
+    # to a temporary file first, a rerun of the site and scenario replaces it
+    ts_path = get_ts_partition(args, mg_name)
+    os.makedirs(os.path.dirname(ts_path), exist_ok=True)
+    ts_results = ts_results.astype(np.float32)
+    ts_results.insert(0, 'hour', np.arange(len(ts_results), dtype=np.int32))
+    tmp_path = os.path.join(os.path.dirname(ts_path), f'.part-0.{os.getpid()}.tmp')
+    ts_results.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, ts_path)
+
+
+# columns identifying the rows of the processed_results table
+summary_id_columns = ['mg_name', 'scenario', 'results_dir', 'written_at']
+
+
+def write_summary(args, mg_name, processed_results):
+    # replace the row of the site and scenario, parallel workers wait for the database lock
+    summary = processed_results.copy()
+    summary.insert(0, 'mg_name', mg_name)
+    summary.insert(1, 'scenario', args.scenario_name)
+    summary.insert(2, 'results_dir', args.results_dir)
+    summary.insert(3, 'written_at', datetime.datetime.now().isoformat(timespec='seconds'))
+    os.makedirs(args.results_store_dir, exist_ok=True)
+    with sqlite3.connect(get_summary_db(args), timeout=60) as con:
+        if con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='processed_results'").fetchone():
+            con.execute('DELETE FROM processed_results WHERE mg_name = ? AND scenario = ?',
+                        (mg_name, args.scenario_name))
+        summary.to_sql('processed_results', con, if_exists='append', index=False)
+    con.close()
+
+
+def write_results(args, mg_name, ts_results, processed_results, reports=None):
+    # results of one site and scenario. reports (name: DataFrame) of the solve modes are written as CSV to
+    # results_dir/mg_name, as are the time series and processed results with results_csv_export or without a
+    # results store
+    site_dir = os.path.join(args.results_dir, mg_name)
+    if not os.path.exists(site_dir):
+        os.makedirs(site_dir)
+    if args.results_store_dir:
+        write_ts_results(args, mg_name, ts_results)
+        write_summary(args, mg_name, processed_results)
+    if args.results_csv_export or not args.results_store_dir:
+        ts_results.round(decimals=3).to_csv(os.path.join(site_dir, 'ts_results.csv'))
+        processed_results.round(decimals=3).to_csv(os.path.join(site_dir, 'processed_results.csv'))
+    for report_name, report in (reports or {}).items():
+        if report is not None:
+            report.round(decimals=6).to_csv(os.path.join(site_dir, f'{report_name}.csv'))
+
+
+def read_ts_results(args, mg_name=None, scenario_name=None):
+    # hourly results of the store, optionally of one site and / or scenario only
+    filters = []
+    if mg_name is not None:
+        filters.append(('mg_name', '=', mg_name))
+    if scenario_name is not None:
+        filters.append(('scenario', '=', scenario_name))
+    return pd.read_parquet(os.path.join(args.results_store_dir, 'ts_results'), filters=filters or None)
+
+
+def read_summary(args, query='SELECT * FROM processed_results', params=None):
+    with sqlite3.connect(get_summary_db(args)) as con:
+        summary = pd.read_sql_query(query, con, params=params)
+    con.close()
+    return summary
+
+
+# capacity columns of the processed_results table, in the order of the capacity columns of the time series results
+summary_cap_columns = ['solar_cap_kw', 'diesel_cap_kw', 'battery_la_energy_cap_kwh', 'battery_la_power_cap_kw',
+                       'battery_li_energy_cap_kwh', 'battery_li_power_cap_kw']
+
+
+def read_result_block(args, keys):
+    # results of the (mg_name, scenario) keys stacked for process_results_batch: the (N, 6) capacities of the
+    # summary table, the (N, T, k) hourly results of the dataset and the names of the k columns
+    summary = read_summary(args).set_index(['mg_name', 'scenario'])
+    caps_block = summary.loc[keys, summary_cap_columns].to_numpy(dtype=np.float64)
+    ts_blocks = []
+    for mg_name, scenario_name in keys:
+        ts_results = pd.read_parquet(get_ts_partition(args, mg_name, scenario_name)).drop(columns='hour')
+        ts_blocks.append(ts_results.to_numpy(dtype=np.float64))
+    return caps_block, np.stack(ts_blocks), list(ts_results.columns)
+
+
+def write_breakdowns(args, keys, breakdowns):
+    # one table of results.sqlite per breakdown (name: DataFrame with a row per key), rows of the keys are replaced
+    with sqlite3.connect(get_summary_db(args), timeout=60) as con:
+        for table_name, breakdown in breakdowns.items():
+            breakdown = breakdown.copy()
+            breakdown.columns = [str(c) for c in breakdown.columns]
+            breakdown.insert(0, 'mg_name', [mg_name for mg_name, _ in keys])
+            breakdown.insert(1, 'scenario', [scenario_name for _, scenario_name in keys])
+            if con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,)).fetchone():
+                con.executemany(f'DELETE FROM {table_name} WHERE mg_name = ? AND scenario = ?', keys)
+            breakdown.to_sql(table_name, con, if_exists='append', index=False)
+    con.close()
@@ -0,0 +1,197 @@
+from gurobipy import *
+from fixed_load_model import build_fix_load_model
+from flex_pue_model import build_flex_pue_model
+from results_processing import results_retrieval, process_results, get_ts_dtype
+from results_store import write_results
+from solver_backend import optimize, get_solve_info
+from param_sweep import sweep_obj_params, sweep_rhs_params, update_cost_coefficients
+from result_cache import result_key_ignored_params, store_results
+from profiling import start_profile, write_profile, timed_phase, add_phase_time, reset_peak_rss, get_peak_rss_mb
+from utils import get_fixed_system_size
+import numpy as np
+import argparse
+import datetime
+import json
+
+# scenario flags that only change bounds, right-hand sides and coefficients of the site model
+template_toggle_params = ['solar_ava', 'battery_la_ava', 'battery_li_ava', 'diesel_ava', 'diesel_vali_cond',
+                          'curtailable_load_sce', 'supply_deficit_sce', 'motor_cap_limit', 'fixed_gen_caps']
+
+
+def get_template_key(args):
+    # scenarios with the same key share one site model. the deficit binaries scale with the curtailed load, so with
+    # supply_deficit_binary_sce the curtailable load scenario changes the model structure.
+    in_place_params = template_toggle_params + sweep_obj_params + sweep_rhs_params + result_key_ignored_params
+    if args.supply_deficit_binary_sce:
+        in_place_params = [k for k in in_place_params if k != 'curtailable_load_sce']
+    params = {k: v for k, v in sorted(vars(args).items()) if k not in in_place_params}
+    return json.dumps(params, sort_keys=True, default=str)
+
+
+def can_use_template(args):
+    # the representative day and rolling solve modes build several models of their own
+    if args.fixed_load_sce:
+        return args.fixed_solve_mode == 'full'
+    return args.flex_solve_mode == 'full'
+
+
+def build_site_template(args, mg_name):
+    # the site model with every toggleable part built in: all technologies available, the curtailable load read
+    # (unless the deficit binaries depend on it), the deficit limit as an inequality and the motor capacity limit as
+    # a constraint. apply_scenario then sets the bounds and right-hand sides of a scenario.
+    template_args = argparse.Namespace(**vars(args))
+    for k in ['solar_ava', 'battery_la_ava', 'battery_li_ava', 'diesel_ava', 'curtailable_load_sce',
+              'supply_deficit_sce', 'motor_cap_limit']:
+        setattr(template_args, k, True)
+    # the deficit binaries have a row with the curtailed load that a right-hand side can not switch off, with
+    # supply_deficit_binary_sce the curtailable load scenario is built as given (see get_template_key)
+    if args.supply_deficit_binary_sce:
+        template_args.curtailable_load_sce = args.curtailable_load_sce
+    template_args.diesel_vali_cond = False
+    template_args.fixed_gen_caps = False
+    if args.fixed_load_sce:
+        m, handles = build_fix_load_model(template_args, mg_name)
+    else:
+        m, handles = build_flex_pue_model(template_args, mg_name)
+    handles['mg_name'] = mg_name
+    return m, handles
+
+
+def set_cap_bounds(args, handles):
+    cap_vars = handles['cap_vars']
+    # solar and diesel are either not built or built with their minimum capacity, see add_gen_cap_var
+    for cap_name, available, min_cap, force_min in [('solar_cap', args.solar_ava, args.solar_min_cap, False),
+                                                     ('diesel_cap', args.diesel_ava, args.diesel_min_cap,
+                                                      args.diesel_vali_cond)]:
+        cap_var = cap_vars[cap_name]
+        cap_var.VType = GRB.SEMICONT if available and not force_min and min_cap > 0 else GRB.CONTINUOUS
+        cap_var.LB = min_cap if available and (force_min or min_cap > 0) else 0
+        cap_var.UB = GRB.INFINITY if available else 0
+    for batt, available in [('batt_la', args.battery_la_ava), ('batt_li', args.battery_li_ava)]:
+        cap_vars[f'{batt}_energy_cap'].LB = 0
+        cap_vars[f'{batt}_energy_cap'].UB = GRB.INFINITY if available else 0
+        cap_vars[f'{batt}_power_cap'].LB = 0
+        cap_vars[f'{batt}_power_cap'].UB = GRB.INFINITY
+
+    # fixed generation system with solar, and LA battery and battery inverter. an unavailable technology is left with
+    # an upper bound of zero, which makes the scenario infeasible as the equality constraints did
+    if args.fixed_gen_caps:
+        caps = get_fixed_system_size(args, handles['mg_name'])
+        inverter_cap = caps[2]
+        if args.motor_cap_limit and args.fixed_load_dir not in [f'fixed_load_ts/{scenario}' for scenario in
+                                                                args.no_motor_cap_scenarios]:
+            inverter_cap = max(caps[2], handles['motor_limit_cap'])
+        # the upper bounds come from args, the bounds set above are pending until the next model update
+        for cap_name, cap_value, available in [('solar_cap', caps[0], args.solar_ava),
+                                               ('batt_la_energy_cap', caps[1], args.battery_la_ava),
+                                               ('batt_la_power_cap', inverter_cap, True)]:
+            cap_vars[cap_name].VType = GRB.CONTINUOUS
+            cap_vars[cap_name].LB = cap_value
+            cap_vars[cap_name].UB = cap_value if available else 0
+
+
+def apply_scenario(m, args, handles):
+    # set the model to the scenario of args. every toggle is set from args, so applying the base scenario reverts
+    # the changes of the previous one
+    set_cap_bounds(args, handles)
+
+    # the motor capacity limit is dropped with a right-hand side of zero
+    if handles['motor_constr'] is not None:
+        handles['motor_constr'].RHS = handles['motor_limit_cap'] if args.motor_cap_limit else 0
+
+    # curtailed loads are constants of the energy balance and the objective
+    ts_vars = handles['ts_vars']
+    T = handles['T']
+    if args.curtailable_load_sce:
+        ts_vars['curtailed_loads'] = np.asarray(handles['curtailable_load'][:T], dtype=float)
+    else:
+        ts_vars['curtailed_loads'] = np.zeros(T)
+    handles['energy_balance'].RHS = handles['fixed_load'] + ts_vars.get('pue_flat_load', 0.) - \
+        ts_vars['curtailed_loads']
+    update_cost_coefficients(m, args, handles)
+
+    # without the supply deficit scenario the deficit limit has a right-hand side of zero, which forces the
+    # (non-negative) deficit to zero as the equality constraint did
+    deficit_frac = args.allowed_supply_deficit_frac if args.supply_deficit_sce else 0.
+    handles['deficit_constr'].RHS = deficit_frac * (handles['total_fixed_load'] + handles['total_pue_load'])
+    m.update()
+
+
+def run_site_scenarios(site_jobs, template=None):
+    # run the scenarios of one site on a single model: (scenario name, mg name, args, result key) per scenario,
+    # all with the same template key. template is an already built (m, handles) of the site. each solve starts from
+    # the previous one, Gurobi keeps the basis of an LP after bound and right-hand side changes and MIPs get the
+    # previous solution as a start.
+    base_args = site_jobs[0][2]
+    mg_name = site_jobs[0][1]
+    manifest = []
+    build_time = 0.
+    build_peak_mb = 0.
+    own_template = template is None
+    if own_template:
+        build_start_time = datetime.datetime.now()
+        reset_peak_rss()
+        try:
+            template = build_site_template(base_args, mg_name)
+            build_time = (datetime.datetime.now() - build_start_time).total_seconds()
+        except Exception as e:
+            for scenario_name, _, args, result_key in site_jobs:
+                manifest.append({'scenario': scenario_name, 'mg_name': mg_name, 'results_dir': args.results_dir,
+                                 'status': 'failed', 'start_time': build_start_time,
+                                 'end_time': datetime.datetime.now(), 'run_time_s': 0., 'error': repr(e),
+                                 'result_key': result_key, 'peak_rss_mb': get_peak_rss_mb()})
+            return manifest
+        build_peak_mb = get_peak_rss_mb()
+    m, handles = template
+    all_vars = m.getVars()
+
+    prev_x = None
+    for scenario_name, _, args, result_key in site_jobs:
+        job_start_time = datetime.datetime.now()
+        status, error = 'done', ''
+        start_profile(args, mg_name, result_key)
+        try:
+            # the first scenario of the site is charged with building the model, the others with editing it
+            add_phase_time('build_model', build_time)
+            build_time = 0.
+            with timed_phase('apply_scenario'):
+                apply_scenario(m, args, handles)
+            if prev_x is not None and m.IsMIP:
+                m.setAttr('Start', all_vars, prev_x)
+            optimize(m, args)
+            prev_x = None
+            solve_info = get_solve_info(m)
+            if solve_info['sol_count'] == 0:
+                raise RuntimeError(f'scenario {scenario_name} failed with status {solve_info["status"]}')
+            if args.solver_backend == 'gurobi':
+                prev_x = m.getAttr('X', all_vars)
+
+            with timed_phase('results_retrieval'):
+                caps_results, ts_results = results_retrieval(m, handles['cap_vars'], handles['ts_vars'],
+                                                             dtype=get_ts_dtype(args))
+            ts_results['fixed_load_kw'] = handles['fixed_load']
+            with timed_phase('process_results'):
+                processed_results = process_results(args, caps_results, ts_results)
+            with timed_phase('write_results'):
+                write_results(args, mg_name, ts_results, processed_results)
+            if result_key:
+                store_results(args, mg_name, result_key, job_start_time.timestamp())
+        except Exception as e:
+            status, error = 'failed', repr(e)
+            prev_x = None
+        write_profile(args, status)
+        job_end_time = datetime.datetime.now()
+        # the first scenario is charged with the peak of building the model as well
+        manifest.append({'scenario': scenario_name, 'mg_name': mg_name, 'results_dir': args.results_dir,
+                         'status': status, 'start_time': job_start_time, 'end_time': job_end_time,
+                         'run_time_s': (job_end_time - job_start_time).total_seconds(), 'error': error,
+                         'result_key': result_key, 'peak_rss_mb': max(get_peak_rss_mb(), build_peak_mb)})
+        build_peak_mb = 0.
+
+    # revert to the base scenario, the model can then be handed on for further scenarios. a model built here is
+    # disposed once its scenarios are done
+    if own_template:
+        m.dispose()
+    else:
+        apply_scenario(m, base_args, handles)
+    return manifest
@@ -0,0 +1,292 @@
+from batch_runner import run_job
+from result_cache import get_result_key, load_cached_results
+from results_store import read_summary, summary_id_columns
+from profiling import set_progress_hook
+from utils import get_args
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import pandas as pd
+import argparse
+import asyncio
+import datetime
+import json
+import uuid
+import sys
+import os
+
+# local solve service: a JSON-lines protocol over TCP on service_host:service_port, one request per line.
+#   {"op": "submit", "mg_name": "agoro", "params": {...}}  -> {"ok": true, "job_id": ...}
+#   {"op": "status", "job_id": ...}                        -> {"ok": true, "job": {...}}
+#   {"op": "watch", "job_id": ...}                         -> the job, then one line per event until it is finished
+#   {"op": "result", "job_id": ...}                        -> {"ok": true, "job": {...}, "results": [...]}
+#   {"op": "jobs"}                                         -> {"ok": true, "jobs": [...]}
+#   {"op": "shutdown"}                                     -> {"ok": true}, then the service stops
+# params override params.yaml for the job. Jobs run in a pool of service_workers processes, a job whose result key
+# is in the result cache is loaded from it without a solve, and a submit with the same key as a queued or running
+# job returns the ID of that job.
+
+# the events of a job kept for the watchers that connect later
+max_job_events = 200
+
+# progress queue of a worker process, see init_worker
+_progress_queue = None
+
+
+def init_worker(progress_queue):
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def read_processed_results(args, mg_name):
+    # processed results of a finished job, from the results store or the CSV of the site
+    if args.results_store_dir:
+        summary = read_summary(args, 'SELECT * FROM processed_results WHERE mg_name = ? AND scenario = ?',
+                               (mg_name, args.scenario_name))
+        return summary.drop(columns=summary_id_columns).to_dict('records')
+    return pd.read_csv(os.path.join(args.results_dir, mg_name, 'processed_results.csv'),
+                       index_col=0).to_dict('records')
+
+
+def run_service_job(job_id, job_args, mg_name, result_key):
+    # runs in a worker process: the job as the batch runner runs it, with its phases and solver progress put on the
+    # progress queue. the output of the models and the solver goes to solve.log in the results directory of the job
+    # instead of the console of the service. Returns the manifest row and the processed results.
+    set_progress_hook(lambda event: _progress_queue.put({'job_id': job_id, **event}))
+    _progress_queue.put({'job_id': job_id, 'event': 'started', 'pid': os.getpid()})
+    os.makedirs(job_args.results_dir, exist_ok=True)
+    sys.stdout.flush()
+    stdout_fd = os.dup(1)
+    with open(os.path.join(job_args.results_dir, 'solve.log'), 'a') as log:
+        os.dup2(log.fileno(), 1)
+    try:
+        job_results = run_job(job_args, job_args.scenario_name, mg_name, result_key)
+    finally:
+        sys.stdout.flush()
+        os.dup2(stdout_fd, 1)
+        os.close(stdout_fd)
+        set_progress_hook(None)
+        # the last event of the job on the queue, see finish_job
+        _progress_queue.put({'job_id': job_id, 'event': 'worker_done'})
+    processed_results = None
+    if job_results['status'] == 'done':
+        processed_results = read_processed_results(job_args, mg_name)
+    return job_results, processed_results
+
+
+def get_job_args(service, job_id, params):
+    # the parameters of the job: params.yaml with the overrides of the request. each job writes to its own results
+    # directory and scenario of the results store unless the request sets them
+    args = service['args']
+    unknown = sorted(k for k in params if not hasattr(args, k))
+    if unknown:
+        raise ValueError(f'unknown parameters: {unknown}')
+    job_args = argparse.Namespace(**vars(args))
+    job_args.results_dir = os.path.join(args.results_dir, 'service', job_id)
+    job_args.scenario_name = job_id
+    for k, v in params.items():
+        setattr(job_args, k, v)
+    # the solver threads of the workers together do not oversubscribe the cores
+    worker_threads = max(1, (os.cpu_count() or 1) // args.service_workers)
+    job_args.solver_threads = min(worker_threads, job_args.solver_threads) if job_args.solver_threads else \
+        worker_threads
+    return job_args
+
+
+def get_job_summary(job):
+    return {k: v for k, v in job.items() if k not in ['events', 'results', 'watchers', 'worker_done']}
+
+
+def publish(service, job, event):
+    # an event of the job: update the job, keep the event and pass it on to the watchers of the job
+    if event['event'] == 'worker_done':
+        job['worker_done'].set()
+        return
+    event = {'time': datetime.datetime.now().isoformat(timespec='milliseconds'), **event}
+    if event['event'] == 'started':
+        job.update({'status': 'running', 'started': event['time']})
+    elif event['event'] == 'phase':
+        job['phase'] = event['phase']
+    elif event['event'] in ['solver', 'solved']:
+        job['progress'] = {k: v for k, v in event.items() if k not in ['job_id', 'event']}
+    job['events'] = (job['events'] + [event])[-max_job_events:]
+    for watcher in job['watchers']:
+        watcher.put_nowait(event)
+
+
+async def pump_progress(service):
+    # move the events of the worker processes from the progress queue into the event loop
+    loop = asyncio.get_running_loop()
+    while True:
+        event = await loop.run_in_executor(None, service['progress_queue'].get)
+        if event is None:
+            return
+        job = service['jobs'].get(event['job_id'])
+        if job is not None:
+            publish(service, job, event)
+
+
+async def finish_job(service, job, future):
+    # the job is finished once the worker returned and its events are all published, the worker puts worker_done
+    # on the progress queue after its other events
+    try:
+        job_results, processed_results = await future
+        await job['worker_done'].wait()
+        job.update({'status': job_results['status'], 'error': job_results['error'],
+                    'run_time_s': job_results['run_time_s'], 'peak_rss_mb': job_results['peak_rss_mb']})
+        job['results'] = processed_results
+    except Exception as e:
+        job.update({'status': 'failed', 'error': repr(e)})
+    job['finished'] = datetime.datetime.now().isoformat(timespec='milliseconds')
+    service['active_keys'].pop(job['result_key'], None)
+    publish(service, job, {'event': 'finished', 'status': job['status'], 'error': job['error']})
+
+
+async def submit_job(service, mg_name, params):
+    loop = asyncio.get_running_loop()
+    job_id = uuid.uuid4().hex[:12]
+    job_args = get_job_args(service, job_id, params)
+    result_key = None
+    if job_args.result_cache_dir:
+        result_key = await loop.run_in_executor(None, get_result_key, job_args, mg_name)
+        if result_key in service['active_keys']:
+            return service['active_keys'][result_key]
+
+    job = {'job_id': job_id, 'mg_name': mg_name, 'params': params, 'status': 'queued', 'phase': None,
+           'progress': None, 'submitted': datetime.datetime.now().isoformat(timespec='milliseconds'),
+           'started': None, 'finished': None, 'error': '', 'run_time_s': None, 'peak_rss_mb': None,
+           'result_key': result_key,
+           'results_dir': job_args.results_dir, 'events': [], 'results': None, 'watchers': [],
+           'worker_done': asyncio.Event()}
+    service['jobs'][job_id] = job
+
+    # a job requested again is copied from the result cache, without waiting for a worker
+    if result_key and await loop.run_in_executor(None, load_cached_results, job_args, mg_name, result_key):
+        job['results'] = await loop.run_in_executor(None, read_processed_results, job_args, mg_name)
+        job.update({'status': 'cached', 'finished': datetime.datetime.now().isoformat(timespec='milliseconds')})
+        publish(service, job, {'event': 'finished', 'status': 'cached', 'error': ''})
+        return job_id
+
+    if result_key:
+        service['active_keys'][result_key] = job_id
+    future = loop.run_in_executor(service['pool'], run_service_job, job_id, job_args, mg_name, result_key)
+    asyncio.ensure_future(finish_job(service, job, future))
+    return job_id
+
+
+def encode(message):
+    # numpy scalars of the results and events as plain numbers
+    return (json.dumps(message, default=lambda v: v.item() if hasattr(v, 'item') else str(v)) + '\n').encode()
+
+
+async def watch_job(job, writer):
+    # the job and its events so far, then its events until it is finished
+    watcher = asyncio.Queue()
+    job['watchers'].append(watcher)
+    try:
+        writer.write(encode({'ok': True, 'job': get_job_summary(job)}))
+        for event in job['events']:
+            writer.write(encode(event))
+        await writer.drain()
+        if job['finished'] is not None:
+            return
+        while True:
+            event = await watcher.get()
+            writer.write(encode(event))
+            await writer.drain()
+            if event['event'] == 'finished':
+                return
+    finally:
+        job['watchers'].remove(watcher)
+
+
+async def handle_request(service, request, writer):
+    op = request.get('op')
+    if op == 'submit':
+        job_id = await submit_job(service, request['mg_name'], request.get('params') or {})
+        writer.write(encode({'ok': True, 'job_id': job_id}))
+    elif op == 'jobs':
+        writer.write(encode({'ok': True, 'jobs': [get_job_summary(job) for job in service['jobs'].values()]}))
+    elif op == 'shutdown':
+        writer.write(encode({'ok': True}))
+        service['stop'].set()
+    elif op in ['status', 'watch', 'result']:
+        job = service['jobs'].get(request.get('job_id'))
+        if job is None:
+            raise KeyError(f"unknown job {request.get('job_id')}")
+        if op == 'watch':
+            await watch_job(job, writer)
+        elif op == 'result':
+            writer.write(encode({'ok': True, 'job': get_job_summary(job), 'results': job['results']}))
+        else:
+            writer.write(encode({'ok': True, 'job': get_job_summary(job)}))
+    else:
+        raise ValueError(f'unknown op {op}')
+
+
+async def handle_client(service, reader, writer):
+    # requests of a connection are answered in order, an error is answered instead of closing the connection
+    try:
+        while not reader.at_eof():
+            line = await reader.readline()
+            if not line.strip():
+                continue
+            try:
+                await handle_request(service, json.loads(line), writer)
+            except Exception as e:
+                writer.write(encode({'ok': False, 'error': repr(e)}))
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def run_service(args, host=None, port=None):
+    # serve until a shutdown request. the workers are spawned rather than forked from the event loop and its
+    # threads
+    host = host or args.service_host
+    port = args.service_port if port is None else port
+    mp_context = multiprocessing.get_context('spawn')
+    progress_queue = mp_context.Queue()
+    service = {'args': args, 'jobs': dict(), 'active_keys': dict(), 'progress_queue': progress_queue,
+               'pool': ProcessPoolExecutor(max_workers=args.service_workers, mp_context=mp_context,
+                                           initializer=init_worker, initargs=(progress_queue,)),
+               'stop': asyncio.Event()}
+    pump = asyncio.ensure_future(pump_progress(service))
+    server = await asyncio.start_server(lambda reader, writer: handle_client(service, reader, writer), host, port)
+    print(f"solve service on {', '.join(str(sock.getsockname()) for sock in server.sockets)}")
+    try:
+        async with server:
+            await service['stop'].wait()
+    finally:
+        service['pool'].shutdown(wait=True, cancel_futures=True)
+        progress_queue.put(None)
+        await pump
+    return service
+
+
+async def call_service(message, host='127.0.0.1', port=8765):
+    # send one request and return its answer lines: one line, or for watch the job and its events up to the
+    # finished event
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(encode(message))
+    await writer.drain()
+    answers = [json.loads(await reader.readline())]
+    if message.get('op') == 'watch' and answers[0].get('ok'):
+        while answers[-1].get('event') != 'finished':
+            answers.append(json.loads(await reader.readline()))
+    writer.close()
+    await writer.wait_closed()
+    return answers
+
+
+if __name__ == '__main__':
+
+    running_start_time = datetime.datetime.now()
+
+    args = get_args()
+    asyncio.run(run_service(args))
+
+    # showing the time used
+    running_end_time = datetime.datetime.now()
+    print(running_end_time - running_start_time)
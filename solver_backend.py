@@ -0,0 +1,199 @@
+from gurobipy import *
+from utils import get_args
+from profiling import is_profiling, timed_phase, presolve_callback, progress_callback, has_progress_hook, \
+    report_progress, record_model
+import numpy as np
+import pandas as pd
+import datetime
+import tempfile
+import time
+import os
+
+# the models are built with gurobipy and solved by the backend named by solver_backend in params.yaml. gurobi: Gurobi
+# itself. highs: the model matrix is passed to HiGHS through highspy. highs_mps: the model is written as MPS and read
+# by HiGHS. The HiGHS backends do not need a Gurobi license to solve (building and writing models of any size works
+# with the license-free gurobipy package), but they do not solve quadratic constraints.
+solver_backends = ['gurobi', 'highs', 'highs_mps']
+
+
+def set_highs_options(h, m):
+    # map the Gurobi parameters set on the model to the matching HiGHS options
+    h.setOptionValue('output_flag', bool(m.Params.OutputFlag))
+    h.setOptionValue('primal_feasibility_tolerance', m.Params.FeasibilityTol)
+    h.setOptionValue('mip_feasibility_tolerance', m.Params.FeasibilityTol)
+    h.setOptionValue('dual_feasibility_tolerance', m.Params.OptimalityTol)
+    h.setOptionValue('mip_rel_gap', m.Params.MIPGap)
+    if m.Params.TimeLimit < GRB.INFINITY:
+        h.setOptionValue('time_limit', float(m.Params.TimeLimit))
+    if m.Params.Threads > 0:
+        h.setOptionValue('threads', m.Params.Threads)
+    # Method -1 automatic, 0 primal simplex, 1 dual simplex, 2 barrier, others are left to HiGHS
+    if m.Params.Method in [0, 1]:
+        h.setOptionValue('solver', 'simplex')
+        h.setOptionValue('simplex_strategy', 4 if m.Params.Method == 0 else 1)
+    elif m.Params.Method == 2:
+        h.setOptionValue('solver', 'ipm')
+
+
+def get_highs_lp(m):
+    # the model in HiGHS form: columns in the order of m.getVars(), so that solutions map back by variable index
+    import highspy
+    all_vars = m.getVars()
+    all_constrs = m.getConstrs()
+    matrix = m.getA().tocsc()
+    lb = np.array(m.getAttr('LB', all_vars))
+    ub = np.array(m.getAttr('UB', all_vars))
+    sense = np.array(m.getAttr('Sense', all_constrs))
+    rhs = np.array(m.getAttr('RHS', all_constrs))
+    vtype = np.array(m.getAttr('VType', all_vars))
+
+    lp = highspy.HighsLp()
+    lp.num_col_ = len(all_vars)
+    lp.num_row_ = len(all_constrs)
+    lp.col_cost_ = np.array(m.getAttr('Obj', all_vars))
+    lp.col_lower_ = np.where(lb <= -GRB.INFINITY, -highspy.kHighsInf, lb)
+    lp.col_upper_ = np.where(ub >= GRB.INFINITY, highspy.kHighsInf, ub)
+    lp.row_lower_ = np.where(sense == '<', -highspy.kHighsInf, rhs)
+    lp.row_upper_ = np.where(sense == '>', highspy.kHighsInf, rhs)
+    lp.offset_ = m.ObjCon
+    lp.sense_ = highspy.ObjSense.kMaximize if m.ModelSense == GRB.MAXIMIZE else highspy.ObjSense.kMinimize
+    lp.a_matrix_.format_ = highspy.MatrixFormat.kColwise
+    lp.a_matrix_.start_ = matrix.indptr
+    lp.a_matrix_.index_ = matrix.indices
+    lp.a_matrix_.value_ = matrix.data
+    if m.IsMIP:
+        var_types = {'C': highspy.HighsVarType.kContinuous, 'B': highspy.HighsVarType.kInteger,
+                     'I': highspy.HighsVarType.kInteger, 'S': highspy.HighsVarType.kSemiContinuous,
+                     'N': highspy.HighsVarType.kSemiInteger}
+        lp.integrality_ = [var_types[v] for v in vtype]
+    return lp
+
+
+def solve_highs(m, backend):
+    import highspy
+    m.update()
+    if m.NumQConstrs or m.NumQNZs:
+        raise ValueError(f'the {backend} backend does not solve quadratic models')
+    h = highspy.Highs()
+    set_highs_options(h, m)
+    if backend == 'highs_mps':
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mps_path = os.path.join(tmp_dir, 'model.mps')
+            m.write(mps_path)
+            h.readModel(mps_path)
+    else:
+        h.passModel(get_highs_lp(m))
+
+    start_time = time.perf_counter()
+    h.run()
+    runtime = time.perf_counter() - start_time
+
+    model_status = h.getModelStatus()
+    status_map = {highspy.HighsModelStatus.kOptimal: GRB.OPTIMAL,
+                  highspy.HighsModelStatus.kInfeasible: GRB.INFEASIBLE,
+                  highspy.HighsModelStatus.kUnboundedOrInfeasible: GRB.INF_OR_UNBD,
+                  highspy.HighsModelStatus.kUnbounded: GRB.UNBOUNDED,
+                  highspy.HighsModelStatus.kTimeLimit: GRB.TIME_LIMIT,
+                  highspy.HighsModelStatus.kIterationLimit: GRB.ITERATION_LIMIT,
+                  highspy.HighsModelStatus.kInterrupt: GRB.INTERRUPTED}
+    info = h.getInfo()
+    has_solution = info.primal_solution_status == 2  # feasible
+    m._solution = {'status': status_map.get(model_status, GRB.NUMERIC), 'sol_count': int(has_solution),
+                   'obj': info.objective_function_value if has_solution else np.nan,
+                   'x': np.array(h.getSolution().col_value) if has_solution else None,
+                   'runtime': runtime,
+                   'iterations': info.simplex_iteration_count + max(info.ipm_iteration_count, 0),
+                   'nodes': max(info.mip_node_count, 0) if m.IsMIP else 0}
+
+
+def optimize(m, args):
+    # solve the model with the backend of args.solver_backend, the solution is then read with get_values and
+    # get_solve_info whichever backend solved it
+    backend = args.solver_backend
+    if backend not in solver_backends:
+        raise ValueError(f'unknown solver_backend {backend}, supported: {solver_backends}')
+    m._solution = None
+    m._presolve_time = None
+    m._progress_time = None
+    with timed_phase('solve'):
+        if backend == 'gurobi':
+            if has_progress_hook():
+                m.optimize(progress_callback)
+            else:
+                m.optimize(presolve_callback if is_profiling() else None)
+        else:
+            solve_highs(m, backend)
+    solve_info = get_solve_info(m)
+    record_model(m, args, solve_info)
+    report_progress({'event': 'solved', 'model_name': m.ModelName, 'backend': backend,
+                     **{k: solve_info[k] for k in ['status', 'obj', 'runtime', 'iterations', 'nodes']}})
+
+
+def get_solve_info(m):
+    # status (as a Gurobi status code), objective, solve time, iterations and branch-and-bound nodes of the last
+    # optimize
+    if getattr(m, '_solution', None) is not None:
+        return {k: v for k, v in m._solution.items() if k != 'x'}
+    return {'status': m.Status, 'sol_count': m.SolCount, 'obj': m.ObjVal if m.SolCount > 0 else np.nan,
+            'runtime': m.Runtime, 'iterations': m.IterCount, 'nodes': m.NodeCount if m.IsMIP else 0}
+
+
+def get_values(m, variables):
+    # solution values of a Var, a list of Vars or an MVar (as an array of its shape)
+    solution = getattr(m, '_solution', None)
+    if solution is None:
+        if isinstance(variables, list):
+            return m.getAttr('X', variables)
+        return variables.X
+    if isinstance(variables, Var):
+        return solution['x'][variables.index]
+    if isinstance(variables, list):
+        return list(solution['x'][[v.index for v in variables]])
+    index = np.array([v.index for v in variables.reshape(-1).tolist()], dtype=int)
+    return solution['x'][index].reshape(variables.shape)
+
+
+def compare_backends(args, mg_name, backends=None):
+    # solve the same built model with each backend and compare objectives, capacities and solve times
+    from fixed_load_model import build_fix_load_model
+    from flex_pue_model import build_flex_pue_model
+    backends = backends or solver_backends
+    if args.fixed_load_sce:
+        m, handles = build_fix_load_model(args, mg_name)
+    else:
+        m, handles = build_flex_pue_model(args, mg_name)
+
+    comparison = []
+    for backend in backends:
+        args.solver_backend = backend
+        optimize(m, args)
+        solve_info = get_solve_info(m)
+        backend_results = {'backend': backend, **solve_info}
+        if solve_info['sol_count'] > 0:
+            cap_names = list(handles['cap_vars'])
+            backend_results.update(zip(cap_names, get_values(m, [handles['cap_vars'][k] for k in cap_names])))
+        comparison.append(backend_results)
+    comparison = pd.DataFrame(comparison)
+    comparison['obj_diff_rel'] = (comparison.obj - comparison.obj[0]) / comparison.obj[0]
+
+    if not os.path.exists(os.path.join(args.results_dir, mg_name)):
+        os.makedirs(os.path.join(args.results_dir, mg_name))
+    comparison.round(decimals=6).to_csv(os.path.join(args.results_dir, mg_name, 'backend_comparison.csv'),
+                                        index=False)
+    return comparison
+
+
+if __name__ == '__main__':
+
+    running_start_time = datetime.datetime.now()
+
+    args = get_args()
+    mg_list = ['agoro']
+
+    for mg_name in mg_list:
+        print(mg_name, 'name of mini-grid')
+        print(compare_backends(args, mg_name))
+
+    # showing the time used
+    running_end_time = datetime.datetime.now()
+    print(running_end_time - running_start_time)
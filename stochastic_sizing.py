@@ -0,0 +1,265 @@
+from gurobipy import *
+from fixed_load_model import build_fix_load_model, get_fix_load_inputs
+from flex_pue_model import build_flex_pue_model, get_flex_pue_inputs, get_operation_cost
+from results_processing import results_retrieval, process_results
+from results_store import write_results
+from solver_backend import optimize, get_solve_info, get_values
+from profiling import timed_phase, add_counter
+from utils import get_args
+from concurrent.futures import ThreadPoolExecutor
+import scipy.sparse as sp
+import numpy as np
+import pandas as pd
+import argparse
+import datetime
+import time
+import os
+
+# capacities shared by the scenario years, in the order of results_retrieval
+cap_names = ['solar_cap', 'diesel_cap', 'batt_la_energy_cap', 'batt_la_power_cap', 'batt_li_energy_cap',
+             'batt_li_power_cap']
+
+# processed results of each year in the stochastic report
+report_cols = ['LCOE', 'generation_cost', 'diesel_fuel_cost', 'avg_load_kw', 'peak_load_kw', 'avg_solar_gen_kw',
+               'avg_diesel_gen_kw', 'solar_unc_cf', 'solar_act_cf']
+
+
+def get_year_args(args):
+    # args and probability of each scenario year of stochastic_years. a year overrides parameters of args, usually
+    # solar_year and the load directories, its weight is normalized to a probability
+    stochastic_years = args.stochastic_years or {f'y{args.solar_year}': {}}
+    year_args, weights = dict(), []
+    for year_name, overrides in stochastic_years.items():
+        overrides = dict(overrides or {})
+        weights.append(float(overrides.pop('weight', 1.)))
+        year_args[year_name] = argparse.Namespace(**vars(args))
+        for k, v in overrides.items():
+            if not hasattr(args, k):
+                raise ValueError(f'unknown parameter {k} in stochastic year {year_name}')
+            setattr(year_args[year_name], k, v)
+    weights = np.array(weights)
+    if np.any(weights < 0) or np.sum(weights) <= 0:
+        raise ValueError('the weights of stochastic_years must be non-negative with a positive sum')
+    return year_args, weights / np.sum(weights)
+
+
+def get_year_inputs(args, mg_name, year_args):
+    # inputs of every scenario year, all over the same horizon
+    get_inputs = get_fix_load_inputs if args.fixed_load_sce else get_flex_pue_inputs
+    year_inputs = [get_inputs(a, mg_name) for a in year_args.values()]
+    horizons = {len(inputs[k]) for inputs in year_inputs for k in ['fixed_load', 'solar_po_hourly']}
+    if len(horizons) > 1:
+        raise ValueError(f'the load and solar series of the scenario years cover different horizons: {horizons}')
+    T = horizons.pop()
+    if not args.fixed_load_sce and T % 24:
+        raise ValueError('num_hour_flex_pue must be whole days for the stochastic model')
+    return year_inputs, T
+
+
+def stack_inputs(year_inputs):
+    # the inputs of the years one after the other as one horizon. years with fewer PUEs are padded with PUEs
+    # without load, which add no variables (see get_pue_groups)
+    stacked = dict()
+    for k, value in year_inputs[0].items():
+        if value is None:
+            stacked[k] = None
+        elif k == 'pue_daily_array':
+            num_pue = max(inputs[k].shape[0] for inputs in year_inputs)
+            stacked[k] = np.concatenate([np.pad(np.asarray(inputs[k], dtype=float),
+                                                ((0, num_pue - inputs[k].shape[0]), (0, 0), (0, 0)))
+                                         for inputs in year_inputs], axis=1)
+        else:
+            stacked[k] = np.concatenate([np.asarray(inputs[k], dtype=float) for inputs in year_inputs])
+    return stacked
+
+
+def build_extensive_model(args, mg_name, year_inputs, probs, env=None):
+    # extensive form: one set of capacities and the dispatch blocks of all S years, built in bulk as one stacked
+    # horizon of S * T hours whose battery levels wrap around within each year. the hourly costs are weighted by
+    # the year probabilities, so that the objective is the capital cost plus the expected dispatch cost
+    S = len(year_inputs)
+    T = len(year_inputs[0]['fixed_load'])
+    inputs = stack_inputs(year_inputs)
+    hour_weights = np.repeat(probs, T)
+    if args.fixed_load_sce:
+        m, handles = build_fix_load_model(args, mg_name, inputs, hour_weights, period_hours=T, env=env)
+    else:
+        m, handles = build_flex_pue_model(args, mg_name, inputs, hour_weights, period_hours=T, env=env)
+
+    # the builder limits the expected supply deficit, every year has to meet the limit on its own
+    m.remove(handles['deficit_constr'])
+    year_hours = sp.csr_matrix((np.ones(S * T), (np.repeat(np.arange(S), T), np.arange(S * T))), shape=(S, S * T))
+    year_load = year_hours @ inputs['fixed_load']
+    if not args.fixed_load_sce:
+        year_load += np.sum(inputs['pue_daily_array'][:, :, 0], axis=0).reshape(S, -1).sum(axis=1)
+    supply_deficit = handles['ts_vars']['supply_deficit']
+    if args.supply_deficit_sce:
+        deficit_constr = m.addConstr(year_hours @ supply_deficit <= args.allowed_supply_deficit_frac * year_load,
+                                     name='year_deficit')
+    else:
+        deficit_constr = m.addConstr(year_hours @ supply_deficit == 0, name='year_deficit')
+    m.update()
+    handles.update({'deficit_constr': deficit_constr, 'year_load': year_load, 'probs': probs, 'T': T,
+                    'num_years': S})
+    return m, handles
+
+
+def solve_extensive(args, mg_name, year_inputs, probs):
+    with timed_phase('build_model'):
+        m, handles = build_extensive_model(args, mg_name, year_inputs, probs)
+    optimize(m, args)
+    solve_info = get_solve_info(m)
+    if solve_info['sol_count'] == 0:
+        raise RuntimeError(f'extensive stochastic model failed with status {solve_info["status"]}')
+    with timed_phase('results_retrieval'):
+        caps_results, ts_results = results_retrieval(m, handles['cap_vars'], handles['ts_vars'])
+    ts_results['fixed_load_kw'] = handles['fixed_load']
+    m.dispose()
+    T = handles['T']
+    year_ts = [ts_results.iloc[s * T:(s + 1) * T].reset_index(drop=True) for s in range(len(year_inputs))]
+    return caps_results, year_ts, None
+
+
+def solve_progressive_hedging(args, mg_name, year_args, year_inputs, probs):
+    # scenario decomposition by progressive hedging: every year is sized on its own model, solved in parallel
+    # threads, with a proximal term 0.5 rho (x - xbar)^2 and the weights w on its capacities x that pull them
+    # towards the probability weighted mean xbar of the years. The weights are updated with w += rho (x - xbar)
+    # until the relative spread of the capacities is below ph_tol. rho is ph_rho times the capacity costs.
+    if args.solver_backend != 'gurobi':
+        raise ValueError('progressive hedging solves quadratic subproblems and needs solver_backend: gurobi')
+    S = len(year_inputs)
+    year_args = list(year_args.values())
+    num_workers = min(S, args.stochastic_workers or S)
+    threads = max(1, (os.cpu_count() or 1) // num_workers)
+    if args.solver_threads:
+        threads = min(threads, args.solver_threads)
+
+    # each year has its own Gurobi environment, an environment must not be used by two threads at once
+    envs, models, handles_list, cap_vars, objectives = [], [], [], [], []
+    with timed_phase('build_model'):
+        for s in range(S):
+            env = Env()
+            build = build_fix_load_model if args.fixed_load_sce else build_flex_pue_model
+            m, handles = build(year_args[s], mg_name, year_inputs[s], env=env)
+            m.setParam('OutputFlag', 0)
+            m.setParam('Threads', threads)
+            envs.append(env)
+            models.append(m)
+            handles_list.append(handles)
+            cap_vars.append([handles['cap_vars'][cap_name] for cap_name in cap_names])
+            objectives.append(m.getObjective())
+    cap_cost = np.array(models[0].getAttr('Obj', cap_vars[0]))
+    rho = args.ph_rho * cap_cost
+
+    def solve_year(s):
+        optimize(models[s], year_args[s])
+        solve_info = get_solve_info(models[s])
+        if solve_info['sol_count'] == 0:
+            raise RuntimeError(f'progressive hedging subproblem {s} failed with status {solve_info["status"]}')
+        return get_values(models[s], cap_vars[s])
+
+    ph_log = []
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        x = np.array(list(pool.map(solve_year, range(S))))
+        xbar = probs @ x
+        w = rho * (x - xbar)
+        # the quadratic part of the proximal term is set once, its linear part and the weights are objective
+        # coefficients of the capacities that change every iteration
+        for s in range(S):
+            models[s].setObjective(objectives[s] + 0.5 * quicksum(r * v * v for r, v in zip(rho, cap_vars[s])))
+        for iteration in range(args.ph_max_iter + 1):
+            gap = np.sqrt(probs @ np.sum((x - xbar) ** 2, axis=1)) / max(1., np.linalg.norm(xbar))
+            ph_log.append({'iteration': iteration, 'gap': gap, 'time_s': time.perf_counter() - start_time,
+                           **dict(zip(cap_names, xbar))})
+            print(f'progressive hedging iteration {iteration}: gap {gap:.2e}')
+            if gap <= args.ph_tol or iteration == args.ph_max_iter:
+                break
+            for s in range(S):
+                models[s].setAttr('Obj', cap_vars[s], cap_cost + w[s] - rho * xbar)
+            x = np.array(list(pool.map(solve_year, range(S))))
+            xbar = probs @ x
+            w += rho * (x - xbar)
+        add_counter('ph_iterations', iteration)
+
+        # dispatch of every year at the capacities xbar. the dispatch only penalizes the supply deficit, so that it
+        # stays feasible when the years did not fully agree
+        for s in range(S):
+            m = models[s]
+            m.setObjective(objectives[s])
+            for v, cap_value in zip(cap_vars[s], xbar):
+                v.VType = GRB.CONTINUOUS
+                v.LB = cap_value
+                v.UB = cap_value
+            m.remove(handles_list[s]['deficit_constr'])
+        list(pool.map(solve_year, range(S)))
+
+    year_ts = []
+    with timed_phase('results_retrieval'):
+        for s in range(S):
+            caps_results, ts_results = results_retrieval(models[s], handles_list[s]['cap_vars'],
+                                                         handles_list[s]['ts_vars'])
+            ts_results['fixed_load_kw'] = handles_list[s]['fixed_load']
+            year_ts.append(ts_results)
+    for m, env in zip(models, envs):
+        m.dispose()
+        env.dispose()
+    return caps_results, year_ts, pd.DataFrame(ph_log)
+
+
+def solve_stochastic(args, mg_name):
+    # capacities sized on the probability weighted scenario years of stochastic_years, by the extensive form or by
+    # progressive hedging (stochastic_method). Returns the capacities, the probability weighted hourly dispatch of
+    # the years, a report with the processed results of each year and the progressive hedging iterations.
+    year_args, probs = get_year_args(args)
+    year_inputs, T = get_year_inputs(args, mg_name, year_args)
+    add_counter('scenario_years', len(year_inputs))
+    start_time = time.perf_counter()
+    if args.stochastic_method == 'extensive':
+        caps_results, year_ts, ph_report = solve_extensive(args, mg_name, year_inputs, probs)
+    elif args.stochastic_method == 'progressive_hedging':
+        caps_results, year_ts, ph_report = solve_progressive_hedging(args, mg_name, year_args, year_inputs, probs)
+    else:
+        raise ValueError(f'unknown stochastic_method {args.stochastic_method}, supported: extensive, '
+                         f'progressive_hedging')
+    solve_time = time.perf_counter() - start_time
+
+    # objective of each year: capital cost of the shared capacities plus the cost of its dispatch
+    report = []
+    for (year_name, a), prob, ts_results in zip(year_args.items(), probs, year_ts):
+        processed_results = process_results(a, caps_results, ts_results)
+        capital_cost = processed_results[['solar_cost', 'diesel_cap_cost', 'battery_la_cost',
+                                          'battery_li_cost']].sum(axis=1)[0]
+        report.append({'scenario_year': year_name, 'weight': prob,
+                       'obj': capital_cost + get_operation_cost(a, ts_results),
+                       'unserved_kwh': np.sum(ts_results.supply_deficit_kw),
+                       **processed_results[report_cols].iloc[0].to_dict()})
+    report = pd.DataFrame(report)
+    ts_results = sum(prob * ts for prob, ts in zip(probs, year_ts))
+    expected = {'scenario_year': 'expected', 'weight': 1., 'obj': probs @ report.obj,
+                'unserved_kwh': probs @ report.unserved_kwh,
+                **process_results(args, caps_results, ts_results)[report_cols].iloc[0].to_dict(),
+                'solar_unc_cf': probs @ report.solar_unc_cf}
+    report = pd.concat([report, pd.DataFrame([expected])], ignore_index=True)
+    report['method'] = args.stochastic_method
+    report['solve_time_s'] = solve_time
+    return caps_results, ts_results, report, ph_report
+
+
+if __name__ == '__main__':
+
+    running_start_time = datetime.datetime.now()
+
+    args = get_args()
+    mg_list = ['agoro']
+
+    for mg_name in mg_list:
+        print(mg_name, 'name of mini-grid')
+        caps_results, ts_results, stochastic_report, ph_report = solve_stochastic(args, mg_name)
+        print(stochastic_report)
+        write_results(args, mg_name, ts_results, process_results(args, caps_results, ts_results),
+                      reports={'stochastic_report': stochastic_report, 'ph_report': ph_report})
+
+    # showing the time used
+    running_end_time = datetime.datetime.now()
+    print(running_end_time - running_start_time)
@@ -0,0 +1,70 @@
+from fixed_load_model import build_fix_load_model
+from flex_pue_model import build_flex_pue_model
+from site_template import build_site_template, apply_scenario
+from solver_backend import optimize, get_solve_info
+import argparse
+import pytest
+import yaml
+import os
+
+# scenarios of one site template, li before fixed_gen_caps left the LA battery capacity fixed to zero once
+scenarios = {'base': {},
+             'li': {'battery_li_ava': True, 'battery_la_ava': False},
+             'fixed_gen_caps': {'fixed_gen_caps': True, 'supply_deficit_sce': True,
+                                'allowed_supply_deficit_frac': 0.5},
+             'diesel': {'solar_ava': False, 'diesel_ava': True},
+             'deficit': {'supply_deficit_sce': True, 'allowed_supply_deficit_frac': 0.05},
+             'no_curtailment': {'curtailable_load_sce': False}}
+# with the deficit binaries the curtailable load scenario is part of the template, these share one without it
+binary_params = {'supply_deficit_binary_sce': True, 'curtailable_load_sce': False, 'supply_deficit_sce': True,
+                 'allowed_supply_deficit_frac': 0.9}
+binary_scenarios = {'binary': binary_params,
+                    'binary_li': {**binary_params, 'battery_li_ava': True, 'battery_la_ava': False},
+                    'binary_tight': {**binary_params, 'allowed_supply_deficit_frac': 0.2}}
+
+
+def get_test_args(model_type, params):
+    # params.yaml over two days with HiGHS, which needs no Gurobi license for the solve
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(code_dir, 'params.yaml')) as f:
+        args = argparse.Namespace(**yaml.load(f, Loader=yaml.FullLoader))
+    args.fixed_load_sce = model_type == 'fixed'
+    args.num_hour_fixed_load = args.num_hour_flex_pue = 48
+    args.solver_backend = 'highs'
+    for k, v in params.items():
+        setattr(args, k, v)
+    return args
+
+
+def solve_obj(m, args):
+    m.setParam('OutputFlag', 0)
+    optimize(m, args)
+    solve_info = get_solve_info(m)
+    assert solve_info['sol_count'] > 0
+    return solve_info['obj']
+
+
+@pytest.fixture(autouse=True)
+def code_dir(monkeypatch):
+    # the data paths of params.yaml are relative to the code directory
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize('scenarios', [scenarios, binary_scenarios], ids=['toggles', 'binary'])
+@pytest.mark.parametrize('model_type', ['fixed', 'flex'])
+def test_scenario_order(model_type, scenarios):
+    build_model = build_fix_load_model if model_type == 'fixed' else build_flex_pue_model
+    expected = dict()
+    for scenario_name, params in scenarios.items():
+        args = get_test_args(model_type, params)
+        m, handles = build_model(args, 'agoro')
+        expected[scenario_name] = solve_obj(m, args)
+        m.dispose()
+
+    for order in [list(scenarios), list(reversed(scenarios))]:
+        m, handles = build_site_template(get_test_args(model_type, scenarios[order[0]]), 'agoro')
+        for scenario_name in order:
+            args = get_test_args(model_type, scenarios[scenario_name])
+            apply_scenario(m, args, handles)
+            assert solve_obj(m, args) == pytest.approx(expected[scenario_name], rel=1e-6), scenario_name
+        m.dispose()
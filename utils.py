@@ -1,4 +1,4 @@
-import os, re, argparse, yaml
+import os, io, re, argparse, yaml, hashlib
 import numpy as np
 import pandas as pd
 from datetime import datetime, timezone, timedelta
@@ -17,40 +17,132 @@ def get_args():
         args.__dict__[k] = v
     return args
 
+# metadata and lookup tables of the binary input store, keyed by (file path, mtime)
+_input_store_memo = dict()
+
+def input_mtime(path):
+    # mtime of an input file, or the latest mtime of a directory and the files in it
+    if not os.path.isdir(path):
+        return os.stat(path).st_mtime_ns
+    return max([os.stat(path).st_mtime_ns] + [os.stat(os.path.join(path, name)).st_mtime_ns
+                                              for name in os.listdir(path)])
+
+def read_store_file(path):
+    key = (path, os.stat(path).st_mtime_ns)
+    if key not in _input_store_memo:
+        _input_store_memo[key] = pd.read_parquet(path)
+    return _input_store_memo[key]
+
+def get_store_path(args, source):
+    # path of the binary copy of a data_dir input written by ingest_inputs.py, None if missing or stale
+    if not args.input_store_dir:
+        return None
+    metadata_file = os.path.join(args.input_store_dir, 'metadata.parquet')
+    if not os.path.exists(metadata_file):
+        return None
+    metadata = read_store_file(metadata_file)
+    entry = metadata[metadata['source'] == source]
+    if entry.empty or entry['mtime_ns'].values[0] != input_mtime(os.path.join(args.data_dir, source)):
+        return None
+    return os.path.join(args.input_store_dir, entry['store_file'].values[0])
+
+def get_store_array(args, source):
+    store_path = get_store_path(args, source)
+    if store_path is None:
+        return None
+    return np.load(store_path, mmap_mode='r')
+
+def get_site_table(args, source):
+    # lookup table with one row per mini-grid, read from the input store when it has a current copy
+    store_path = get_store_path(args, source)
+    if store_path is not None:
+        return read_store_file(store_path)
+    return pd.read_csv(f'{args.data_dir}/{source}').set_index('mg_name')
+
 def get_fixed_load(args, mg_name):
-    fixed_load = np.array(pd.read_csv(f'{args.data_dir}/{args.fixed_load_dir}/{mg_name}_fixed_loads.csv', index_col=0))[:, 0]
+    fixed_load = get_store_array(args, f'{args.fixed_load_dir}/{mg_name}_fixed_loads.csv')
+    if fixed_load is None:
+        fixed_load = np.array(pd.read_csv(f'{args.data_dir}/{args.fixed_load_dir}/{mg_name}_fixed_loads.csv', index_col=0))[:, 0]
     return fixed_load
 
 def get_motor_cap_limit(args, mg_name):
-    caps = pd.read_csv(f'{args.data_dir}/{args.motor_cap_dir}')
-    caps = caps[caps['mg_name'] == mg_name]
-    return caps['motor_capacity'].values[0]
+    caps = get_site_table(args, args.motor_cap_dir)
+    return caps.at[mg_name, 'motor_capacity']
 
 def get_fixed_system_size(args, mg_name):
-    caps = pd.read_csv(f'{args.data_dir}/{args.system_capacity}')
-    caps = caps[caps['mg_name'] == mg_name]
-    return [caps['solar_cap_kw'].values[0], caps['batt_cap_kwh'].values[0], caps['inv_cap_kw'].values[0]]
+    caps = get_site_table(args, args.system_capacity)
+    return [caps.at[mg_name, 'solar_cap_kw'], caps.at[mg_name, 'batt_cap_kwh'], caps.at[mg_name, 'inv_cap_kw']]
 
 def get_curtailable_load(args, mg_name):
-    curtailable_load = np.array(pd.read_csv(f'{args.data_dir}/{args.curtailment_dir}/{mg_name}_curtailable_loads.csv', index_col=0))[:, 0]
+    curtailable_load = get_store_array(args, f'{args.curtailment_dir}/{mg_name}_curtailable_loads.csv')
+    if curtailable_load is None:
+        curtailable_load = np.array(pd.read_csv(f'{args.data_dir}/{args.curtailment_dir}/{mg_name}_curtailable_loads.csv', index_col=0))[:, 0]
     return curtailable_load
 
+def get_pue_ids(source_dir):
+    # IDs of the PUE daily load files of a site (file name without .csv), in file name order
+    return [name[:-len('.csv')] for name in sorted(os.listdir(source_dir))
+            if name.startswith('pue_daily') and name.endswith('.csv')]
+
+def read_pue_daily_files(source_dir, pue_ids):
+    # all PUE files of a site in one pass: the rows of the files are joined under the header of the first file and
+    # parsed by a single read_csv, then split back into one (days, 2) block per PUE
+    header, rows, num_rows = None, [], []
+    for pue_id in pue_ids:
+        with open(f'{source_dir}/{pue_id}.csv', 'rb') as f:
+            lines = [line for line in f.read().splitlines() if line.strip()]
+        if header is None:
+            header = lines[0]
+        elif lines[0] != header:
+            raise ValueError(f'{source_dir}/{pue_id}.csv: header {lines[0].decode()} is not {header.decode()}')
+        rows += lines[1:]
+        num_rows.append(len(lines) - 1)
+    if len(set(num_rows)) > 1:
+        raise ValueError(f'{source_dir}: the PUE files have different numbers of days '
+                         f'{dict(zip(pue_ids, num_rows))}')
+    pue_daily = np.array(pd.read_csv(io.BytesIO(b'\n'.join([header] + rows))), dtype=float)
+    if pue_daily.shape[1] != 2:
+        raise ValueError(f'{source_dir}: the PUE files have {pue_daily.shape[1]} columns instead of daily energy and '
+                         f'hourly cap')
+    return pue_daily.reshape(len(pue_ids), num_rows[0], 2)
+
 def get_flex_pue_ts(args, mg_name):
+    # fixed load, the (PUEs, days, 2) array of the daily energy and hourly cap of the PUEs and the IDs of the PUEs
     source_dir = f'{args.data_dir}/{args.flex_pue_dir}/{mg_name}'
+    pue_ids = get_pue_ids(source_dir)
+    fixed_load = get_store_array(args, f'{args.flex_pue_dir}/{mg_name}/fixed_loads.csv')
+    pue_daily_array = get_store_array(args, f'{args.flex_pue_dir}/{mg_name}')
+    if fixed_load is not None and pue_daily_array is not None:
+        return fixed_load, pue_daily_array, pue_ids
+
     fixed_load = np.array(pd.read_csv(f'{source_dir}/fixed_loads.csv').iloc[:, 1])
 
     # read the PUE daily loads
-    pue_list = [name.rstrip('.csv') for name in os.listdir(f'{source_dir}') if name.startswith('pue_daily')]
-    pue_daily_list = []
-    for pue_id in pue_list:
-        pue_daily_ts = np.array(pd.read_csv(f'{source_dir}/{pue_id}.csv'))
-        pue_daily_list.append(pue_daily_ts)
-    if pue_daily_list:
-        pue_daily_array = np.stack(pue_daily_list, axis=0)
+    if pue_ids:
+        pue_daily_array = read_pue_daily_files(source_dir, pue_ids)
     else:
-        pue_daily_array = np.zeros((1, len(fixed_load), 2))
-
-    return fixed_load, pue_daily_array
+        pue_daily_array = np.zeros((0, len(fixed_load) // 24, 2))
+
+    return fixed_load, pue_daily_array, pue_ids
+
+def validate_pue_daily_array(pue_daily_array, pue_ids, num_days, source):
+    # fail before the model build on PUE inputs the model can not use: too few days for the horizon, missing or
+    # negative values, or a daily energy above 24 hours at the hourly cap (the model would be infeasible)
+    if pue_daily_array.ndim != 3 or pue_daily_array.shape[2] != 2 or pue_daily_array.shape[0] != len(pue_ids):
+        raise ValueError(f'{source}: PUE array of shape {pue_daily_array.shape} for {len(pue_ids)} PUEs, expected '
+                         f'(PUEs, days, 2)')
+    if pue_daily_array.shape[1] < num_days:
+        raise ValueError(f'{source}: {pue_daily_array.shape[1]} days of PUE loads, the horizon has {num_days}')
+    daily_energy = pue_daily_array[:, :num_days, 0]
+    daily_cap = pue_daily_array[:, :num_days, 1]
+    checks = [(~np.isfinite(pue_daily_array[:, :num_days]).all(axis=2), 'missing values'),
+              ((daily_energy < 0) | (daily_cap < 0), 'negative values'),
+              (daily_energy > 24 * daily_cap * (1 + 1e-6) + 1e-6, 'daily energy above 24 hours at the hourly cap')]
+    for bad, problem in checks:
+        if bad.any():
+            pue_no, day = np.nonzero(bad)
+            bad_days = {pue_ids[n]: day[pue_no == n].tolist()[:5] for n in np.unique(pue_no)}
+            raise ValueError(f'{source}: {problem} on the days {bad_days}')
 
 def annualization_rate(i, years):
     return (i*(1+i)**years)/((1+i)**years-1)
@@ -71,16 +163,51 @@ def get_cap_cost(args, years):
     return solar_cap_cost, battery_la_cap_cost_kwh, battery_li_cap_cost_kwh, battery_inverter_cap_cost_kw, \
         diesel_cap_cost_kw
 
+# processed solar series of this process, keyed by (file path, mtime, region)
+_solar_ts_memo = dict()
+
+def get_solar_file(args, solar_region):
+    # solar potential of the region in the weather year args.solar_year
+    return f'uganda_solar_ts/{solar_region.lower()}_solar_{args.solar_year}.csv'
+
 def load_timeseries(args, solar_region):
     solar_region = solar_region.lower()
-    solar_po = pd.read_csv(f'{args.data_dir}/uganda_solar_ts/{solar_region}_solar_2019.csv')
+    solar_path = os.path.abspath(f'{args.data_dir}/{get_solar_file(args, solar_region)}')
+    key = (solar_path, os.stat(solar_path).st_mtime_ns, solar_region)
+    if key not in _solar_ts_memo:
+        solar_po_hourly = get_store_array(args, get_solar_file(args, solar_region))
+        if solar_po_hourly is None:
+            solar_po_hourly = load_cached_solar_ts(args, key)
+        if not isinstance(solar_po_hourly, np.memmap):
+            solar_po_hourly.flags.writeable = False
+        _solar_ts_memo[key] = solar_po_hourly
+    return _solar_ts_memo[key]
+
+def load_cached_solar_ts(args, key):
+    # on-disk cache of the processed hourly array, an edited file gets a new key through its mtime
+    cache_file = None
+    if args.cache_dir:
+        key_hash = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        cache_file = os.path.join(args.cache_dir, f'solar_{key[2]}_{key_hash}.npy')
+        if os.path.exists(cache_file):
+            return np.load(cache_file)
+
+    solar_po = pd.read_csv(key[0])
     solar_po = get_solar_ts(solar_po, args)
-    solar_po_hourly = np.array(solar_po)[:, 0]
+    solar_po_hourly = np.array(solar_po, dtype=float)[:, 0]
+
+    if cache_file:
+        # write to a temporary file first, parallel workers may be writing the same entry
+        os.makedirs(args.cache_dir, exist_ok=True)
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, solar_po_hourly)
+        os.replace(tmp_file, cache_file)
     return solar_po_hourly
 
 def get_solar_ts(solar_po, args):
-    solar_po.time = [datetime.strptime(k, "%Y%m%d:%H%M") for k in solar_po.time]
-    solar_po.time = solar_po.time.dt.tz_localize('UTC')
+    solar_po.time = pd.to_datetime(solar_po.time, format="%Y%m%d:%H%M", utc=True)
+    year = solar_po.time.dt.year.iloc[0]  # weather year of the file
     solar_po.time = solar_po.time.dt.tz_convert('Africa/Kampala')
 
     solar_po = solar_po[["time", "P"]]
@@ -90,19 +217,19 @@ def get_solar_ts(solar_po, args):
     # create a DataFrame with the new times
     new_times = pd.DataFrame({
         'time': [
-            datetime(2019, 1, 1, 0, 30, tzinfo=pytz.timezone('Etc/GMT-3')),
-            datetime(2019, 1, 1, 1, 30, tzinfo=pytz.timezone('Etc/GMT-3')),
-            datetime(2019, 1, 1, 2, 30, tzinfo=pytz.timezone('Etc/GMT-3')),
+            datetime(year, 1, 1, 0, 30, tzinfo=pytz.timezone('Etc/GMT-3')),
+            datetime(year, 1, 1, 1, 30, tzinfo=pytz.timezone('Etc/GMT-3')),
+            datetime(year, 1, 1, 2, 30, tzinfo=pytz.timezone('Etc/GMT-3')),
         ],
         'solar_po': [0, 0, 0]
     })
     solar_po = pd.concat([new_times, solar_po], ignore_index=True)
     solar_po.set_index('time', inplace=True)
 
-    period1 = solar_po[(solar_po.index >= pd.Timestamp("2019-03-01 00:00", tzinfo=pytz.timezone('Etc/GMT-3'))) &
-                       (solar_po.index <= pd.Timestamp("2019-12-31 23:59", tzinfo=pytz.timezone('Etc/GMT-3')))]
-    period2 = solar_po[(solar_po.index >= pd.Timestamp("2019-01-01 00:00", tzinfo=pytz.timezone('Etc/GMT-3'))) &
-                       (solar_po.index <= pd.Timestamp("2019-02-28 23:59", tzinfo=pytz.timezone('Etc/GMT-3')))]
+    period1 = solar_po[(solar_po.index >= pd.Timestamp(f"{year}-03-01 00:00", tzinfo=pytz.timezone('Etc/GMT-3'))) &
+                       (solar_po.index <= pd.Timestamp(f"{year}-12-31 23:59", tzinfo=pytz.timezone('Etc/GMT-3')))]
+    period2 = solar_po[(solar_po.index >= pd.Timestamp(f"{year}-01-01 00:00", tzinfo=pytz.timezone('Etc/GMT-3'))) &
+                       (solar_po.index <= pd.Timestamp(f"{year}-02-28 23:59", tzinfo=pytz.timezone('Etc/GMT-3')))]
 
     solar_po_sorted = pd.concat([period1, period2])
     solar_po_sorted = solar_po_sorted.reset_index(drop=True)